@@ -0,0 +1,222 @@
+import random
+import threading
+from collections import defaultdict
+
+from ldap3 import Server, Connection, MOCK_SYNC
+from ldap3.operation.search import MATCH_EQUAL
+from ldap3.strategy.mockSync import MockSyncStrategy
+
+BASE_DN = 'DC=bench,DC=local'
+BIND_DN = 'CN=svc-ldapsync,OU=Service,' + BASE_DN
+BIND_PASSWORD = 'bench'
+IN_CHAIN_RULE = '1.2.840.113556.1.4.1941'
+
+# Attribute with an index, used for equality filters and the in-chain rule
+INDEXED_ATTRIBUTES = ('samaccountname', 'cn', 'memberof', 'objectclass', 'distinguishedname')
+
+FIRST_NAMES = ['Anna', 'Ben', 'Clara', 'David', 'Emma', 'Felix', 'Greta', 'Hannes', 'Ida', 'Jonas', 'Katharina', 'Lukas']
+LAST_NAMES = ['Müller', 'Schmidt', 'Schneider', 'Fischer', 'Weber', 'Meyer', 'Wagner', 'Becker', 'Schulz', 'Hoffmann']
+DEPARTMENTS = ['Verwaltung', 'Informatik', 'Maschinenbau', 'Medien', 'Soziale Arbeit', 'Wirtschaft', 'Bibliothek', 'Rechenzentrum']
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+class IndexedMockSyncStrategy(MockSyncStrategy):
+    ''' ldap3 MOCK_SYNC strategy with indexed equality filters and `LDAP_MATCHING_RULE_IN_CHAIN`
+
+    The plain mock compares every filter term against every entry, which
+    makes directories with 10k+ entries unusable. The index lives on the
+    server object and is built by `SyntheticDirectory`.
+    '''
+
+    def _candidate_set(self, candidates):
+        cached = getattr(self, '_candidates_cache', None)
+        if cached is None or cached[0] is not candidates:
+            cached = (candidates, set(candidates))
+            self._candidates_cache = cached
+        return cached[1]
+
+    @staticmethod
+    def _assertion(node):
+        ''' Returns attribute, value and matching rule of a match node
+
+        The mock decodes extensible matches from the request into an equality
+        node with the printed ASN.1 structure as attribute and value.
+        '''
+
+        attr = node.assertion['attr']
+        value = _text(node.assertion['value'])
+        if not attr.startswith('ExtensibleMatch'):
+            return attr.lower(), value.lower(), None
+        lines = value.split('\n')
+        fields = dict(line.strip().split('=', 1) for line in lines[1:] if '=' in line)
+        return fields.get('type', '').lower(), fields.get('matchValue', '').lower(), lines[0].strip()
+
+    def evaluate_filter_node(self, node, candidates):
+        index = getattr(self.connection.server, 'synthetic_index', None)
+        if index is None or node.tag != MATCH_EQUAL:
+            return super().evaluate_filter_node(node, candidates)
+
+        attr, value, matching_rule = self._assertion(node)
+        if attr not in INDEXED_ATTRIBUTES:
+            return super().evaluate_filter_node(node, candidates)
+        if matching_rule is None:
+            matched = index[attr].get(value, set())
+        elif attr == 'memberof' and matching_rule == IN_CHAIN_RULE:
+            # Transitive members, nested groups are resolved by the server
+            matched = set()
+            groups = [value]
+            seen = set(groups)
+            while groups:
+                for dn in index['memberof'].get(groups.pop(), ()):
+                    matched.add(dn)
+                    if dn.lower() not in seen and dn in index['objectclass'].get('group', ()):
+                        seen.add(dn.lower())
+                        groups.append(dn.lower())
+        else:
+            return super().evaluate_filter_node(node, candidates)
+
+        candidate_set = self._candidate_set(candidates)
+        node.matched = matched & candidate_set
+        node.unmatched = candidate_set - node.matched
+
+
+class SyntheticConnection(Connection):
+    ''' Mock connection counting the searches it sends '''
+
+    def __init__(self, directory, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+        self.strategy.__class__ = IndexedMockSyncStrategy
+
+    def search(self, *args, **kwargs):
+        self.directory.count_search()
+        result = super().search(*args, **kwargs)
+        self.directory.count_entries(len(self.response or ()))
+        return result
+
+
+class SyntheticDirectory(object):
+    ''' Synthetic Active Directory for ldap3's MOCK_SYNC strategy
+
+    `users` accounts are spread over nested groups: one top group contains a
+    group per department, every department group contains `teams` team
+    groups and every user is a direct member of one team. Every tenth user is
+    additionally a direct member of its department group.
+    '''
+
+    def __init__(self, users, teams=10, seed=1):
+        self.users = users
+        self.teams = teams
+        self.random = random.Random(seed)
+        self.server = Server('bench.local')
+        self.usernames = []
+        self.top_group = 'bench-all'
+        self.top_group_dn = None
+
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.entries = 0
+
+    def count_search(self):
+        with self._lock:
+            self.searches += 1
+
+    def count_entries(self, count):
+        with self._lock:
+            self.entries += count
+
+    def reset_counters(self):
+        with self._lock:
+            self.searches = 0
+            self.entries = 0
+
+    def connect(self):
+        ''' Connection factory for `LdapConnectionPool` '''
+
+        connection = SyntheticConnection(self, self.server, user=BIND_DN, password=BIND_PASSWORD, client_strategy=MOCK_SYNC)
+        connection.bind()
+        return connection
+
+    def build(self):
+        ''' Creates all entries and the search index '''
+
+        loader = Connection(self.server, user=BIND_DN, password=BIND_PASSWORD, client_strategy=MOCK_SYNC)
+        add = loader.strategy.add_entry
+        add(BIND_DN, {'objectClass': ['top', 'person', 'user'], 'userPassword': BIND_PASSWORD, 'sAMAccountName': 'svc-ldapsync'})
+
+        # Groups
+        group_ou = 'OU=Groups,' + BASE_DN
+        self.top_group_dn = 'CN=%s,%s' % (self.top_group, group_ou)
+        members = defaultdict(list)
+        member_of = defaultdict(list)
+        team_dns = []
+        department_dns = []
+        for department in DEPARTMENTS:
+            department_dn = 'CN=bench-%s,%s' % (department.lower().replace(' ', '-'), group_ou)
+            department_dns.append(department_dn)
+            members[self.top_group_dn].append(department_dn)
+            member_of[department_dn].append(self.top_group_dn)
+            for team in range(self.teams):
+                team_dn = 'CN=bench-%s-team%02d,%s' % (department.lower().replace(' ', '-'), team, group_ou)
+                team_dns.append(team_dn)
+                members[department_dn].append(team_dn)
+                member_of[team_dn].append(department_dn)
+
+        # Users
+        user_ou = 'OU=Users,' + BASE_DN
+        for number in range(self.users):
+            first_name = self.random.choice(FIRST_NAMES)
+            last_name = self.random.choice(LAST_NAMES)
+            username = '%s%s%06d' % (first_name[0].lower(), last_name.lower()[:6], number)
+            department = DEPARTMENTS[number % len(DEPARTMENTS)]
+            dn = 'CN=%s %s %06d,%s' % (first_name, last_name, number, user_ou)
+            team_dn = team_dns[number % len(team_dns)]
+            groups = [team_dn]
+            if number % 10 == 0:
+                groups.append(department_dns[number % len(department_dns)])
+            for group_dn in groups:
+                members[group_dn].append(dn)
+            add(dn, {
+                'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+                'distinguishedName': dn,
+                'sAMAccountName': username,
+                'userPrincipalName': '%s@bench.local' % username,
+                'givenName': first_name,
+                'sn': last_name,
+                'displayName': '%s %s' % (first_name, last_name),
+                'mail': '%s.%s%06d@bench.local' % (first_name.lower(), last_name.lower(), number),
+                'department': department,
+                'title': self.random.choice(['Mitarbeiter', 'Professor', 'Student', 'Hilfskraft']),
+                'telephoneNumber': '+49 3727 58-%04d' % self.random.randint(0, 9999),
+                'description': 'Synthetischer Benutzer %d der Abteilung %s für Benchmarks' % (number, department),
+                'proxyAddresses': ['SMTP:%s@bench.local' % username, 'smtp:%s@alt.bench.local' % username],
+                'memberOf': groups,
+                'uSNChanged': str(1000 + number),
+                'whenChanged': '20240101000000.0Z',
+            })
+            self.usernames.append(username)
+
+        for group_dn in [self.top_group_dn] + department_dns + team_dns:
+            attributes = {
+                'objectClass': ['top', 'group'],
+                'distinguishedName': group_dn,
+                'sAMAccountName': group_dn.split(',')[0][3:],
+                'member': members[group_dn],
+            }
+            if member_of[group_dn]:
+                attributes['memberOf'] = member_of[group_dn]
+            add(group_dn, attributes)
+
+        self.build_index()
+        return self
+
+    def build_index(self):
+        index = {attr: defaultdict(set) for attr in INDEXED_ATTRIBUTES}
+        for dn, entry in self.server.dit.items():
+            for attr in INDEXED_ATTRIBUTES:
+                for value in entry.get(attr, ()):
+                    index[attr][_text(value).lower()].add(dn)
+        self.server.synthetic_index = index
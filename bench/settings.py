@@ -0,0 +1,45 @@
+# Minimale Django-Umgebung für die Benchmarks (ohne echten LDAP-Server)
+from bench.directory import BASE_DN, BIND_DN, BIND_PASSWORD
+
+LDAP_SYNC_CONNECTION = {
+    'uri': 'ldap://bench.local/' + BASE_DN,
+    'username': BIND_DN,
+    'password': BIND_PASSWORD,
+    'timeout': 3,
+    'pool_size': 8,
+}
+LDAP_SYNC_USER_ATTRIBUTES = {
+    'username': 'sAMAccountName',
+    'first_name': 'givenName',
+    'last_name': 'sn',
+    'email': 'mail',
+}
+LDAP_SYNC_DISABLE_INVALID_USER = True
+
+# Jede Abfrage soll das (simulierte) LDAP erreichen
+LDAP_SYNC_CACHE = {
+    'timeout': 0,
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django_ldapsync',
+)
+
+USE_TZ = True
+
+SECRET_KEY = 'fake-key'
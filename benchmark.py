@@ -0,0 +1,193 @@
+''' Benchmarks gegen ein synthetisches Verzeichnis (ldap3 MOCK_SYNC)
+
+Beispiel:
+    python3 ./benchmark.py --users 1000 10000 100000 --output results.jsonl
+    python3 ./benchmark.py --users 1000 --compare results.jsonl
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from io import StringIO
+
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'bench.settings'
+django.setup()
+
+from django.contrib.auth import get_user_model
+from django.core import management
+from django.db import connection
+from django.test.utils import override_settings
+
+from bench.directory import SyntheticDirectory
+from django_ldapsync import Ldap
+from django_ldapsync.groups import clear_group_graphs
+from django_ldapsync.ldap import LdapConnectionPool, set_connection_pool
+
+SCENARIOS = ['sync_user', 'sync_batch', 'sync_scan', 'sync_merge', 'import', 'pre_save', 'group_members', 'group_members_graph']
+
+
+class SqlCounter(object):
+    ''' Counts the executed SQL statements (see `connection.execute_wrapper`) '''
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def measure(directory, func, users, memory=True):
+    ''' Runs `func` and returns wall time, peak memory and query counts '''
+
+    gc.collect()
+    directory.reset_counters()
+    counter = SqlCounter()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        func()
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if memory else None
+    if memory:
+        tracemalloc.stop()
+    return {
+        'users': users,
+        'wall_seconds': round(wall, 4),
+        'users_per_second': round(users / wall, 1) if wall else None,
+        'peak_memory_bytes': peak,
+        'ldap_searches': directory.searches,
+        'ldap_entries': directory.entries,
+        'sql_queries': counter.queries,
+        'ldap_searches_per_user': round(directory.searches / users, 4) if users else None,
+        'sql_queries_per_user': round(counter.queries / users, 4) if users else None,
+    }
+
+
+def reset_users(usernames, missing=0):
+    ''' Creates Django users without attributes (and without LDAP lookups) '''
+
+    User = get_user_model()
+    User.objects.all().delete()
+    users = [User(username=username, is_active=True) for username in usernames]
+    users += [User(username='bench-missing-%06d' % number, is_active=True) for number in range(missing)]
+    User.objects.bulk_create(users, batch_size=1000)
+
+
+def run_size(size, scenarios, sample, memory):
+    directory = SyntheticDirectory(size).build()
+    set_connection_pool(LdapConnectionPool(directory.connect, size=8))
+    User = get_user_model()
+    sample_usernames = directory.usernames[:sample]
+    results = []
+
+    def record(name, func, users):
+        result = measure(directory, func, users, memory=memory)
+        result.update({'scenario': name, 'directory_size': size})
+        results.append(result)
+        print(format_result(result))
+
+    quiet = {'stdout': StringIO(), 'stderr': StringIO()}
+    for mode in ('user', 'batch', 'scan', 'merge'):
+        name = 'sync_' + mode
+        if name not in scenarios:
+            continue
+        # Per user lookups are measured on a sample, the mock answers every search in O(directory size)
+        usernames = sample_usernames if mode == 'user' else directory.usernames
+        missing = max(1, len(usernames) // 20)
+        reset_users(usernames, missing)
+        record(name, lambda: management.call_command('ldap_sync', mode=mode, **quiet), len(usernames) + missing)
+
+    if 'import' in scenarios:
+        User.objects.all().delete()
+        record('import', lambda: management.call_command('ldap_import', group=directory.top_group, **quiet), size)
+
+    if 'pre_save' in scenarios:
+        User.objects.all().delete()
+
+        def create_users():
+            for username in sample_usernames:
+                User.objects.create(username=username)
+        record('pre_save', create_users, len(sample_usernames))
+
+    if 'group_members' in scenarios:
+        record('group_members', lambda: Ldap().get_group_members(directory.top_group_dn), size)
+
+    if 'group_members_graph' in scenarios:
+        clear_group_graphs()
+        with override_settings(LDAP_SYNC_GROUP_STRATEGY='graph'):
+            record('group_members_graph', lambda: Ldap().get_group_members(directory.top_group_dn), size)
+
+    set_connection_pool(None)
+    return results
+
+
+def format_result(result):
+    memory = '%8.1f MiB' % (result['peak_memory_bytes'] / 1024 / 1024) if result['peak_memory_bytes'] is not None else '       - MiB'
+    return '%-20s %8d Nutzer %9.3fs %10.1f/s %s  LDAP/Nutzer %7.4f  SQL/Nutzer %7.4f' % (
+        result['scenario'], result['users'], result['wall_seconds'], result['users_per_second'] or 0, memory,
+        result['ldap_searches_per_user'] or 0, result['sql_queries_per_user'] or 0,
+    )
+
+
+def compare(results, baseline_file, tolerance):
+    ''' Returns the results which got worse than the baseline by more than `tolerance` '''
+
+    baseline = {}
+    with open(baseline_file) as handle:
+        for line in handle:
+            if line.strip():
+                result = json.loads(line)
+                baseline[(result['scenario'], result['directory_size'])] = result
+
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['scenario'], result['directory_size']))
+        if not previous:
+            continue
+        for key in ('wall_seconds', 'peak_memory_bytes', 'ldap_searches', 'sql_queries'):
+            if result[key] is None or previous.get(key) is None:
+                continue
+            if result[key] > previous[key] * (1 + tolerance) and result[key] - previous[key] > 1:
+                regressions.append('%s/%d: %s %s -> %s' % (result['scenario'], result['directory_size'], key, previous[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000], help="Größen des Verzeichnisses (Default: 1000)")
+    parser.add_argument('--scenario', choices=SCENARIOS, nargs='+', default=SCENARIOS, help="Auszuführende Szenarien")
+    parser.add_argument('--sample', type=int, default=1000, help="Anzahl Nutzer für Einzelabfragen (sync_user, pre_save)")
+    parser.add_argument('--no-memory', action='store_true', help="Speicherverbrauch nicht messen (tracemalloc verlangsamt die Messung)")
+    parser.add_argument('--output', help="Ergebnisse als JSON-Lines in diese Datei schreiben")
+    parser.add_argument('--compare', help="Mit den Ergebnissen aus dieser Datei vergleichen")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Erlaubte Verschlechterung beim Vergleich (Default: 0.2)")
+    args = parser.parse_args()
+
+    management.call_command('migrate', verbosity=0)
+    results = []
+    with override_settings(LDAP_SYNC_PRE_SAVE_POLICY='always'):
+        for size in args.users:
+            results += run_size(size, args.scenario, min(args.sample, size), not args.no_memory)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            for result in results:
+                handle.write(json.dumps(result) + '\n')
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,13 @@
-from .ldap import Ldap
+# `Ldap` and `AsyncLdap` are imported on first access, so `ldap3` is only
+# loaded when it is used
+def __getattr__(name):
+    if name == 'Ldap':
+        from .ldap import Ldap
+        return Ldap
+    if name == 'AsyncLdap':
+        from .async_ldap import AsyncLdap
+        return AsyncLdap
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 default_app_config = 'django_ldapsync.apps.MainAppConfig'
@@ -1,21 +1,92 @@
+import logging
+
 from django.apps import AppConfig
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.signals import setting_changed
 from django.db.models.signals import pre_save
-from .ldap import Ldap
+from .conf import PRE_SAVE_POLICY_ALWAYS, PRE_SAVE_POLICY_STALE, get_config, reset_config
+from .prefetch import get_prefetched_attributes, is_ldap_lookup_suppressed
+from .refresh import schedule_refresh
+
+logger = logging.getLogger(__name__)
+
+def _refreshed_cache_key(username):
+    return 'django_ldapsync:refreshed:%s' % username.lower()
+
+def remember_refresh(username):
+    ''' Remember the refresh for the `stale` policy '''
+
+    config = get_config()
+    if config.pre_save_policy == PRE_SAVE_POLICY_STALE:
+        cache.set(_refreshed_cache_key(username), True, config.pre_save_max_age)
+
+def needs_ldap_lookup(instance, update_fields=None):
+    ''' Decides whether a save of `instance` has to fetch the attributes from LDAP '''
 
-def set_attributes_from_ldap(sender, instance, **kwargs):
-    ''' Gets Attributes from LDAP ands Sync with user '''
+    config = get_config()
+    # Only fields which are actually written can change
+    if update_fields is not None and config.mapped_fields.isdisjoint(update_fields):
+        return False
 
-    ldap = Ldap()
+    policy = config.pre_save_policy
+    if policy == PRE_SAVE_POLICY_ALWAYS or instance._state.adding:
+        return True
+    if policy == PRE_SAVE_POLICY_STALE:
+        username = getattr(instance, instance.USERNAME_FIELD)
+        return cache.get(_refreshed_cache_key(username)) is None
+    return False
+
+def set_attributes_from_ldap(sender, instance, update_fields=None, using=None, **kwargs):
+    ''' Gets Attributes from LDAP ands Sync with user
+
+    If the lookup fails (server not reachable, no pooled connection) the
+    attributes stay unchanged and the refresh is not remembered.
+    '''
+
+    if is_ldap_lookup_suppressed() or not needs_ldap_lookup(instance, update_fields):
+        return
+
+    # Attributes the caller already has (see `prefetch.py`)
     username = getattr(instance, instance.USERNAME_FIELD)
-    attributes = ldap.get_django_attributes_for_user(username)
+    attributes = get_prefetched_attributes(username)
+    if attributes is None:
+        # Existing users are saved with their current attributes and refreshed
+        # in the background, only new users wait for LDAP
+        if not instance._state.adding and get_config().background_refresh['enabled']:
+            schedule_refresh(username, using=using)
+            return
+
+        # Imported here, `ldap3` is only loaded when it is needed
+        from ldap3.core.exceptions import LDAPException
+        from .breaker import CircuitOpen
+        from .ldap import Ldap
+        ldap = Ldap()
+        try:
+            attributes = ldap.get_django_attributes_for_user(username, required=True)
+        except CircuitOpen as error:
+            # Already logged when the circuit opened
+            logger.debug("LDAP lookup of %s skipped, attributes unchanged: %s", username, error)
+            return
+        except LDAPException as error:
+            logger.warning("LDAP lookup of %s failed, attributes unchanged: %s", username, error)
+            return
     for key, value in attributes.items():
-        setattr(instance, key, value)
+        if update_fields is None or key in update_fields:
+            setattr(instance, key, value)
+
+    # Only a lookup covering all mapped fields makes the user fresh
+    if update_fields is None or get_config().mapped_fields.issubset(update_fields):
+        remember_refresh(username)
 
 class MainAppConfig(AppConfig):
     name = 'django_ldapsync'
+    default_auto_field = 'django.db.models.AutoField'
 
     def ready(self):
         super(MainAppConfig, self).ready()
+        # Validate the settings at startup, they are read again only after a change
+        get_config()
+        setting_changed.connect(reset_config, dispatch_uid='django_ldapsync.reset_config')
         User = get_user_model()
         pre_save.connect(set_attributes_from_ldap, User, dispatch_uid='django_ldapsync.set_attributes_from_ldap')
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .cache import AttributeCache, MISSING, get_attribute_cache
+from .ldap import Ldap, get_connection_pool
+
+_executor = None
+_executor_pid = None
+_executor_size = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    ''' Returns the thread pool running the blocking LDAP calls of `AsyncLdap`
+
+    It has one thread per pooled connection, so at most `pool_size` calls
+    block a thread. Open iterations hold a connection without a thread,
+    `get_gate()` keeps both together within the pool.
+    '''
+
+    global _executor, _executor_pid, _executor_size
+
+    size = get_connection_pool().size
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid() or _executor_size != size:
+            if _executor is not None and _executor_pid == os.getpid():
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='django_ldapsync')
+            _executor_pid = os.getpid()
+            _executor_size = size
+        return _executor
+
+
+_gates = weakref.WeakKeyDictionary()
+_gates_lock = threading.Lock()
+
+
+def get_gate():
+    ''' Returns the semaphore of the running event loop for the connections used by `AsyncLdap`
+
+    Every running call and every open iteration (which keeps its connection
+    between pages) holds one of `pool_size` permits, so no call waits for a
+    pooled connection held by another one. Synchronous code of the same
+    process sharing the pool can still make them wait up to `timeout`.
+    '''
+
+    loop = asyncio.get_running_loop()
+    size = get_connection_pool().size
+    with _gates_lock:
+        gate_size, gate = _gates.get(loop, (None, None))
+        if gate_size != size:
+            gate = asyncio.Semaphore(size)
+            _gates[loop] = (size, gate)
+        return gate
+
+
+class AsyncLdap(object):
+    ''' Asyncio counterpart of `Ldap` for async views, middleware and backends
+
+    ldap3 only offers blocking sockets, so every directory operation runs on
+    a dedicated thread pool sized to the connection pool (see `get_executor()`)
+    instead of Django's single `sync_to_async` thread. Many lookups can be
+    awaited concurrently without blocking the event loop, beyond `pool_size`
+    they wait for each other in the event loop (see `get_gate()`). Cache hits
+    in the per-process tier are answered without a thread hop.
+    '''
+
+    def __init__(self):
+        self.ldap = Ldap()
+
+    async def _run(self, func, *args, **kwargs):
+        async with get_gate():
+            return await self._call(func, *args, **kwargs)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+    async def aget_user(self, username, attributes=None):
+        ''' See `Ldap.get_user()` '''
+
+        if attributes is None:
+            return await self._run(self.ldap.get_user, username)
+        return await self._run(self.ldap.get_user, username, attributes=attributes)
+
+    async def aget_django_attributes_for_user(self, username, refresh=False):
+        ''' See `Ldap.get_django_attributes_for_user()` '''
+
+        if not refresh:
+            model_attrs = get_attribute_cache().local.get(AttributeCache.normalize(username))
+            if model_attrs is not MISSING:
+                return dict(model_attrs)
+        return await self._run(self.ldap.get_django_attributes_for_user, username, refresh=refresh)
+
+    async def aget_dn(self, common_name: str, object_class=None):
+        ''' See `Ldap.get_dn()` '''
+
+        return await self._run(self.ldap.get_dn, common_name, object_class=object_class)
+
+    async def aget_dns(self, common_names, object_class=None):
+        ''' See `Ldap.get_dns()` '''
+
+        return await self._run(self.ldap.get_dns, common_names, object_class=object_class)
+
+    async def aiter_group_members(self, group_dn: str, attributes=None, page_size=None):
+        ''' Async generator over the members of a group, see `Ldap.iter_group_members()`
+
+        Every page is fetched on the thread pool. The paged search is bound to
+        its connection, it stays borrowed between the pages (taking one permit
+        of `get_gate()`) and is returned when the iteration ends or is aborted.
+        '''
+
+        page_size = page_size or self.ldap.LDAP_PAGE_SIZE
+        async with get_gate():
+            chunks = self.ldap.iter_group_member_chunks(group_dn, page_size, attributes=attributes, page_size=page_size)
+            try:
+                while True:
+                    chunk = await self._call(next, chunks, None)
+                    if chunk is None:
+                        break
+                    for member in chunk:
+                        yield member
+            finally:
+                await self._call(chunks.close)
+
+    async def aget_group_members(self, group_dn: str):
+        ''' See `Ldap.get_group_members()` '''
+
+        return [member async for member in self.aiter_group_members(group_dn)]
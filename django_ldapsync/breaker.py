@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+
+from ldap3.core.exceptions import LDAPException
+
+from .conf import DEFAULT_LDAP_BREAKER_FAILURES, DEFAULT_LDAP_BREAKER_RESET_SECONDS
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(LDAPException):
+    ''' Raised instead of connecting or searching while the directory is considered unreachable '''
+
+
+class CircuitBreaker(object):
+    ''' Stops connecting to an unreachable directory for a while
+
+    Shared by all connections of the pool. After `failure_threshold` failed
+    connects or searches in a row the circuit opens and `allow()` fails
+    immediately with `CircuitOpen`. After `reset_seconds` it is half open: a
+    single caller probes the directory, its success closes the circuit, its
+    failure opens it again. A probe which reports nothing within
+    `reset_seconds` is replaced by the next caller, `cancel_probe()` frees
+    the slot at once.
+    '''
+
+    def __init__(self, failure_threshold=DEFAULT_LDAP_BREAKER_FAILURES, reset_seconds=DEFAULT_LDAP_BREAKER_RESET_SECONDS):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+
+        # Counters
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == STATE_OPEN and now - self._opened_at >= self.reset_seconds:
+            return STATE_HALF_OPEN
+        return self._state
+
+    def _reject(self, since, now):
+        self.rejected += 1
+        retry_in = max(0.0, since + self.reset_seconds - now)
+        raise CircuitOpen("LDAP server not reachable, next attempt in %.1f seconds" % retry_in)
+
+    def allow(self):
+        ''' Raises `CircuitOpen` unless the caller may contact the directory, e.g. before connecting
+
+        Returns `True` if the caller is the probe of the half open circuit, it
+        must then report its result (or call `cancel_probe()`).
+        '''
+
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == STATE_CLOSED:
+                return False
+            if state == STATE_OPEN:
+                self._reject(self._opened_at, now)
+            # Half open: only one probe at a time
+            if self._state == STATE_HALF_OPEN and now - self._probe_started < self.reset_seconds:
+                self._reject(self._probe_started, now)
+            self._state = STATE_HALF_OPEN
+            self._probe_started = now
+            return True
+
+    def cancel_probe(self):
+        ''' Lets the next caller probe, e.g. if the probe could not contact the directory at all '''
+
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probe_started = 0.0
+
+    def check(self):
+        ''' Like `allow()`, but does not take the probe, e.g. before an operation on a connection already held '''
+
+        with self._lock:
+            now = time.monotonic()
+            if self._current_state(now) == STATE_OPEN:
+                self._reject(self._opened_at, now)
+
+    def record_success(self):
+        with self._lock:
+            if self._state != STATE_CLOSED:
+                logger.info("LDAP server reachable again, circuit closed")
+            self._state = STATE_CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            self._failures += 1
+            if self._state == STATE_HALF_OPEN or (self._state == STATE_CLOSED and self._failures >= self.failure_threshold):
+                self._state = STATE_OPEN
+                self._opened_at = now
+                self.opened += 1
+                logger.warning(
+                    "LDAP server failed %d times in a row, circuit opened for %s seconds", self._failures, self.reset_seconds,
+                )
+
+    def stats(self):
+        ''' Returns state and counters, e.g. for a health check '''
+
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            return {
+                'state': state,
+                'failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'retry_in': max(0.0, self._opened_at + self.reset_seconds - now) if state == STATE_OPEN else 0.0,
+            }
@@ -0,0 +1,221 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+from django.core.cache import caches
+
+from .conf import get_config
+
+MISSING = object()
+
+
+class LRUCache(object):
+    ''' Bounded, thread-safe in-process cache with a timeout per entry '''
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if not timeout or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class AttributeCache(object):
+    ''' Two tier cache for the Django attributes of LDAP users.
+
+    The first tier is a per-process `LRUCache`, the optional second tier a
+    Django cache (`alias`) shared by all workers. Users which do not exist in
+    LDAP are cached as an empty dict for `negative_timeout` seconds.
+    '''
+
+    KEY_PREFIX = 'django_ldapsync:attrs:'
+
+    def __init__(self, timeout, negative_timeout, max_entries, alias=None):
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.local = LRUCache(max_entries, timeout)
+        self.shared = caches[alias] if alias else None
+        self._lock = threading.Lock()
+
+        # Counters for the shared tier
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @staticmethod
+    def normalize(username):
+        ''' Usernames are looked up case-insensitive and without domain '''
+
+        return username.split('@')[0].lower()
+
+    def _shared_key(self, key):
+        return self.KEY_PREFIX + quote(key, safe='')
+
+    def get(self, username):
+        ''' Returns the cached attributes, an empty dict for unknown users or `None` '''
+
+        key = self.normalize(username)
+        attributes = self.local.get(key)
+        if attributes is not MISSING:
+            return attributes
+
+        if self.shared is not None:
+            attributes = self.shared.get(self._shared_key(key))
+            with self._lock:
+                if attributes is None:
+                    self.shared_misses += 1
+                else:
+                    self.shared_hits += 1
+            if attributes is not None:
+                self.local.set(key, attributes, self._timeout_for(attributes))
+                return attributes
+        return None
+
+    def _timeout_for(self, attributes):
+        return self.timeout if attributes else self.negative_timeout
+
+    def set(self, username, attributes):
+        key = self.normalize(username)
+        timeout = self._timeout_for(attributes)
+        if not timeout:
+            return
+        self.local.set(key, attributes, timeout)
+        if self.shared is not None:
+            self.shared.set(self._shared_key(key), attributes, timeout)
+
+    def invalidate(self, username):
+        key = self.normalize(username)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self._shared_key(key))
+
+    def clear(self):
+        ''' Clears the in-process tier '''
+
+        self.local.clear()
+
+    def stats(self):
+        with self._lock:
+            shared = {
+                'hits': self.shared_hits,
+                'misses': self.shared_misses,
+            } if self.shared is not None else None
+        return {
+            'local': self.local.stats(),
+            'shared': shared,
+        }
+
+
+_cache = None
+_cache_key = None
+_cache_lock = threading.Lock()
+
+
+def get_attribute_cache():
+    ''' Returns the attribute cache of this process for the current settings '''
+
+    global _cache, _cache_key
+
+    config = get_config().attribute_cache
+    with _cache_lock:
+        if _cache is None or _cache_key != config:
+            _cache = AttributeCache(
+                timeout=config['timeout'],
+                negative_timeout=config['negative_timeout'],
+                max_entries=config['max_entries'],
+                alias=config['alias'],
+            )
+            _cache_key = config
+        return _cache
+
+
+def invalidate_user_attributes(username):
+    ''' Removes the cached attributes of a user, e.g. after a change in LDAP '''
+
+    get_attribute_cache().invalidate(username)
+
+
+class DnCache(LRUCache):
+    ''' Per-process cache for the DNs of common names, unknown names are cached as `None` '''
+
+    def __init__(self, timeout, negative_timeout, max_entries):
+        super().__init__(max_entries, timeout)
+        self.negative_timeout = negative_timeout
+
+    @staticmethod
+    def make_key(common_name, object_class=None):
+        return ((object_class or '').lower(), common_name.lower())
+
+    def set_dn(self, key, dn):
+        self.set(key, dn, self.timeout if dn else self.negative_timeout)
+
+
+_dn_cache = None
+_dn_cache_key = None
+
+
+def get_dn_cache():
+    ''' Returns the DN cache of this process for the current settings '''
+
+    global _dn_cache, _dn_cache_key
+
+    config = get_config().dn_cache
+    # DNs are only valid for the server and search base they were read from
+    key = (config, get_config().uris)
+    with _cache_lock:
+        if _dn_cache is None or _dn_cache_key != key:
+            _dn_cache = DnCache(
+                timeout=config['timeout'],
+                negative_timeout=config['negative_timeout'],
+                max_entries=config['max_entries'],
+            )
+            _dn_cache_key = key
+        return _dn_cache
@@ -0,0 +1,98 @@
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import SyncCheckpoint
+
+ORDER_PK = 'pk'
+ORDER_RECENT_LOGIN_FIRST = 'recent-login-first'
+ORDERS = (ORDER_PK, ORDER_RECENT_LOGIN_FIRST)
+
+DEFAULT_SAVE_EVERY = 100
+DEFAULT_INACTIVE_EVERY = 7
+
+
+def order_users(queryset, order):
+    ''' Orders the users of a pass, the order is the resume position of a checkpoint '''
+
+    if order == ORDER_RECENT_LOGIN_FIRST:
+        return queryset.order_by(F('last_login').desc(nulls_last=True), 'pk')
+    return queryset.order_by('pk')
+
+
+def users_after(order, last_login, last_pk):
+    ''' Returns the filter for the users behind `(last_login, last_pk)` in `order` '''
+
+    if order == ORDER_RECENT_LOGIN_FIRST:
+        # Users without login come last
+        if last_login is None:
+            return Q(last_login__isnull=True, pk__gt=last_pk)
+        return Q(last_login__lt=last_login) | Q(last_login=last_login, pk__gt=last_pk) | Q(last_login__isnull=True)
+    return Q(pk__gt=last_pk)
+
+
+def inactive_users(before):
+    ''' Returns the filter for users without login since `before` '''
+
+    return Q(last_login__lt=before) | Q(last_login__isnull=True)
+
+
+class Checkpoint(object):
+    ''' Position and counters of a pass over the users in `order`, stored in `SyncCheckpoint`
+
+    `advance()` is called for every user of the pass and saves the position
+    every `save_every` users, `finish()` starts the next pass. A run that is
+    killed resumes behind the last saved user, so at most `save_every` users
+    are processed twice. The position is stored as text, the primary key of
+    the users may be of any type (e.g. `UUIDField`).
+    '''
+
+    def __init__(self, name, order=ORDER_PK, save_every=DEFAULT_SAVE_EVERY):
+        self.order = order
+        self.save_every = max(1, save_every)
+        self.record, _ = SyncCheckpoint.objects.get_or_create(name=name)
+        if self.record.pass_started is None:
+            self.record.pass_started = timezone.now()
+        self._unsaved = 0
+
+    @property
+    def resuming(self):
+        return self.record.last_pk is not None
+
+    def sweeps_inactive(self, every):
+        ''' Whether the current pass includes inactive users, only every `every`-th pass does '''
+
+        return self.record.pass_number % max(1, every) == 0
+
+    def filter(self, queryset):
+        ''' Orders `queryset` and skips the users already processed in this pass '''
+
+        if self.resuming:
+            # Compared as a value of the primary key, e.g. `10` after `9`
+            last_pk = queryset.model._meta.pk.to_python(self.record.last_pk)
+            queryset = queryset.filter(users_after(self.order, self.record.last_login, last_pk))
+        return order_users(queryset, self.order)
+
+    def advance(self, pk, last_login=None, processed=True, changed=False):
+        record = self.record
+        record.last_pk = str(pk)
+        record.last_login = last_login
+        record.processed += int(processed)
+        record.changed += int(changed)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        self.record.save()
+        self._unsaved = 0
+
+    def finish(self):
+        ''' Marks the pass as complete, the next run starts a new one from the beginning '''
+
+        record = self.record
+        record.pass_number += 1
+        record.last_pk = record.last_login = None
+        record.processed = record.changed = 0
+        record.pass_started = None
+        record.pass_finished = timezone.now()
+        self.save()
@@ -0,0 +1,300 @@
+import os
+import threading
+from dataclasses import dataclass
+from functools import cached_property
+from types import MappingProxyType
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+
+# Default-Settings
+DEFAULT_LDAP_SYNC_USER_ATTRIBUTES = {
+    'username': 'sAMAccountName',
+    'first_name': 'givenName',
+    'last_name': 'sn',
+    'email': 'mail',
+}
+DEFAULT_LDAP_TIMEOUT = 5
+DEFAULT_LDAP_POOL_SIZE = 10
+DEFAULT_LDAP_POOL_IDLE_TIMEOUT = 300
+DEFAULT_LDAP_POOL_MAX_LIFETIME = 3600
+DEFAULT_LDAP_PAGE_SIZE = 500
+
+SERVER_STRATEGY_FIRST = 'first'
+SERVER_STRATEGY_ROUND_ROBIN = 'round_robin'
+SERVER_STRATEGY_LOWEST_LATENCY = 'lowest_latency'
+SERVER_STRATEGIES = (SERVER_STRATEGY_FIRST, SERVER_STRATEGY_ROUND_ROBIN, SERVER_STRATEGY_LOWEST_LATENCY)
+DEFAULT_LDAP_SERVER_STRATEGY = SERVER_STRATEGY_FIRST
+DEFAULT_LDAP_SERVER_PROBE_INTERVAL = 30
+DEFAULT_LDAP_SERVER_MAX_FAILURES = 3
+DEFAULT_LDAP_SERVER_EJECT_SECONDS = 60
+# Circuit breaker for the whole directory, see `breaker.py`
+DEFAULT_LDAP_BREAKER_FAILURES = 5
+DEFAULT_LDAP_BREAKER_RESET_SECONDS = 30
+
+# Schema of the server: read on every new connection, never, or once into a file
+SERVER_INFO_SCHEMA = 'schema'
+SERVER_INFO_NONE = 'none'
+SERVER_INFO_CACHE = 'cache'
+DEFAULT_LDAP_SERVER_INFO = SERVER_INFO_SCHEMA
+
+GROUP_STRATEGY_IN_CHAIN = 'in_chain'
+GROUP_STRATEGY_GRAPH = 'graph'
+DEFAULT_LDAP_SYNC_GROUP_STRATEGY = GROUP_STRATEGY_IN_CHAIN
+DEFAULT_LDAP_SYNC_GROUP_CACHE_TIMEOUT = 300
+
+# Wann werden die Attribute beim Speichern aus dem LDAP geholt?
+PRE_SAVE_POLICY_ALWAYS = 'always'
+PRE_SAVE_POLICY_CREATE = 'create'
+PRE_SAVE_POLICY_STALE = 'stale'
+DEFAULT_PRE_SAVE_POLICY = PRE_SAVE_POLICY_ALWAYS
+DEFAULT_PRE_SAVE_MAX_AGE = 24 * 60 * 60
+
+DEFAULT_LDAP_SYNC_CACHE = {
+    'timeout': 60,
+    'negative_timeout': 30,
+    'max_entries': 1000,
+    'alias': None,
+}
+
+DEFAULT_LDAP_SYNC_DN_CACHE = {
+    'timeout': 3600,
+    'negative_timeout': 60,
+    'max_entries': 1000,
+}
+
+DEFAULT_LDAP_SYNC_BACKGROUND_REFRESH = {
+    'enabled': False,
+    'backend': 'django_ldapsync.refresh.ThreadRefreshBackend',
+    'max_queue': 1000,
+    'workers': 1,
+}
+
+DEFAULT_LDAP_SYNC_RATE_LIMIT = {
+    'rate': None,
+    'burst': 10,
+    'latency_threshold': None,
+    'min_rate': 0.1,
+    'retries': 3,
+    'backoff_base': 0.2,
+    'backoff_max': 10.0,
+}
+
+# Filters, `%s` must be escaped with `escape_filter_chars()`
+USER_FILTER = '(sAMAccountName=%s)'
+SCAN_FILTER = '(&(objectClass=user)(sAMAccountName=*)%s)'
+
+
+@dataclass(frozen=True, eq=False)
+class LdapSyncConfig(object):
+    ''' Validated settings of the app, built once by `get_config()` '''
+
+    uris: tuple
+    username: str
+    password: str
+    timeout: float
+    receive_timeout: float
+    pool_size: int
+    pool_idle_timeout: float
+    pool_max_lifetime: float
+    server_strategy: str
+    server_probe_interval: float
+    server_max_failures: int
+    server_eject_seconds: float
+    server_slow_threshold: float
+    breaker_failures: int
+    breaker_reset_seconds: float
+    server_info: str
+    schema_file: str
+    # Django field -> LDAP attribute
+    user_attributes: MappingProxyType
+    # `(django_field, ldap_attribute, max_length)` in mapping order
+    attribute_rules: tuple
+    # Mapped LDAP attributes, `search_attributes` includes `sAMAccountName`
+    ldap_attributes: tuple
+    search_attributes: tuple
+    mapped_fields: frozenset
+    page_size: int
+    group_strategy: str
+    group_cache_timeout: float
+    pre_save_policy: str
+    pre_save_max_age: int
+    attribute_cache: MappingProxyType
+    dn_cache: MappingProxyType
+    background_refresh: MappingProxyType
+    rate_limit: MappingProxyType
+    fingerprints: bool
+    incremental: bool
+
+    @property
+    def uri(self):
+        ''' First URI, its search base is used for all servers '''
+
+        return self.uris[0]
+
+    @cached_property
+    def params(self):
+        ''' Parsed first URI, `ldap3` is only imported here '''
+
+        from ldap3.utils.uri import parse_uri
+        return parse_uri(self.uri)
+
+    @cached_property
+    def max_lengths(self):
+        ''' `max_length` of the mapped fields '''
+
+        return MappingProxyType({field_name: max_length for field_name, _, max_length in self.attribute_rules})
+
+    @cached_property
+    def connection_key(self):
+        ''' Values the connection pool depends on '''
+
+        return (
+            self.uris, self.username, self.password, self.timeout, self.receive_timeout,
+            self.pool_size, self.pool_idle_timeout, self.pool_max_lifetime,
+            self.server_strategy, self.server_probe_interval, self.server_max_failures,
+            self.server_eject_seconds, self.server_slow_threshold, self.breaker_failures, self.breaker_reset_seconds,
+            self.server_info, self.schema_file, self.search_attributes,
+        )
+
+
+def _merged(defaults, name):
+    config = dict(defaults)
+    config.update(getattr(settings, name, None) or {})
+    return MappingProxyType(config)
+
+
+def _choice(name, value, choices):
+    if value not in choices:
+        raise ImproperlyConfigured("%s must be one of %s, not %r" % (name, ', '.join(choices), value))
+    return value
+
+
+def _flag(name, default):
+    value = getattr(settings, name, default)
+    if not isinstance(value, bool):
+        raise ImproperlyConfigured("%s must be True or False, not %r" % (name, value))
+    return value
+
+
+def default_schema_file(host):
+    ''' Schema cache of a server below the cache directory of the user (`$XDG_CACHE_HOME` or `~/.cache`) '''
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'django_ldapsync', '%s.schema.json' % host)
+
+
+def build_config():
+    ''' Reads and validates the settings, raises `ImproperlyConfigured` '''
+
+    from django.contrib.auth import get_user_model
+
+    connection = getattr(settings, 'LDAP_SYNC_CONNECTION', None)
+    if not connection:
+        raise ImproperlyConfigured("LDAP_SYNC_CONNECTION is not set")
+    for key in ('uri', 'username', 'password'):
+        if key not in connection:
+            raise ImproperlyConfigured("LDAP_SYNC_CONNECTION['%s'] is not set" % key)
+
+    uris = connection['uri']
+    uris = tuple(uris) if isinstance(uris, (list, tuple)) else (uris,)
+    if not uris:
+        raise ImproperlyConfigured("LDAP_SYNC_CONNECTION['uri'] must not be empty")
+    for uri in uris:
+        parts = urlsplit(uri)
+        if parts.scheme.lower() not in ('ldap', 'ldaps') or not parts.hostname:
+            raise ImproperlyConfigured("Invalid LDAP URI %r" % uri)
+
+    user_attributes = dict(getattr(settings, 'LDAP_SYNC_USER_ATTRIBUTES', DEFAULT_LDAP_SYNC_USER_ATTRIBUTES))
+    User = get_user_model()
+    attribute_rules = []
+    for field_name, ldap_attribute in user_attributes.items():
+        try:
+            field = User._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured("LDAP_SYNC_USER_ATTRIBUTES: %s has no field %r" % (User.__name__, field_name))
+        attribute_rules.append((field_name, ldap_attribute, field.max_length))
+    schema_file = connection.get('schema_file') or default_schema_file(urlsplit(uris[0]).hostname)
+    ldap_attributes = tuple(user_attributes.values())
+    timeout = connection.get('timeout', DEFAULT_LDAP_TIMEOUT)
+    search_attributes = ldap_attributes if 'sAMAccountName' in ldap_attributes else ldap_attributes + ('sAMAccountName',)
+
+    return LdapSyncConfig(
+        uris=uris,
+        username=connection['username'],
+        password=connection['password'],
+        timeout=timeout,
+        receive_timeout=connection.get('receive_timeout', timeout),
+        pool_size=connection.get('pool_size', DEFAULT_LDAP_POOL_SIZE),
+        pool_idle_timeout=connection.get('pool_idle_timeout', DEFAULT_LDAP_POOL_IDLE_TIMEOUT),
+        pool_max_lifetime=connection.get('pool_max_lifetime', DEFAULT_LDAP_POOL_MAX_LIFETIME),
+        server_strategy=_choice(
+            "LDAP_SYNC_CONNECTION['server_strategy']",
+            connection.get('server_strategy', DEFAULT_LDAP_SERVER_STRATEGY), SERVER_STRATEGIES,
+        ),
+        server_probe_interval=connection.get('server_probe_interval', DEFAULT_LDAP_SERVER_PROBE_INTERVAL),
+        server_max_failures=connection.get('server_max_failures', DEFAULT_LDAP_SERVER_MAX_FAILURES),
+        server_eject_seconds=connection.get('server_eject_seconds', DEFAULT_LDAP_SERVER_EJECT_SECONDS),
+        server_slow_threshold=connection.get('server_slow_threshold'),
+        breaker_failures=connection.get('breaker_failures', DEFAULT_LDAP_BREAKER_FAILURES),
+        breaker_reset_seconds=connection.get('breaker_reset_seconds', DEFAULT_LDAP_BREAKER_RESET_SECONDS),
+        server_info=_choice(
+            "LDAP_SYNC_CONNECTION['server_info']",
+            connection.get('server_info', DEFAULT_LDAP_SERVER_INFO),
+            (SERVER_INFO_SCHEMA, SERVER_INFO_NONE, SERVER_INFO_CACHE),
+        ),
+        schema_file=schema_file,
+        user_attributes=MappingProxyType(user_attributes),
+        attribute_rules=tuple(attribute_rules),
+        ldap_attributes=ldap_attributes,
+        search_attributes=search_attributes,
+        mapped_fields=frozenset(user_attributes),
+        page_size=getattr(settings, 'LDAP_SYNC_PAGE_SIZE', DEFAULT_LDAP_PAGE_SIZE),
+        group_strategy=_choice(
+            'LDAP_SYNC_GROUP_STRATEGY',
+            getattr(settings, 'LDAP_SYNC_GROUP_STRATEGY', DEFAULT_LDAP_SYNC_GROUP_STRATEGY),
+            (GROUP_STRATEGY_IN_CHAIN, GROUP_STRATEGY_GRAPH),
+        ),
+        group_cache_timeout=getattr(settings, 'LDAP_SYNC_GROUP_CACHE_TIMEOUT', DEFAULT_LDAP_SYNC_GROUP_CACHE_TIMEOUT),
+        pre_save_policy=_choice(
+            'LDAP_SYNC_PRE_SAVE_POLICY',
+            getattr(settings, 'LDAP_SYNC_PRE_SAVE_POLICY', DEFAULT_PRE_SAVE_POLICY),
+            (PRE_SAVE_POLICY_ALWAYS, PRE_SAVE_POLICY_CREATE, PRE_SAVE_POLICY_STALE),
+        ),
+        pre_save_max_age=getattr(settings, 'LDAP_SYNC_PRE_SAVE_MAX_AGE', DEFAULT_PRE_SAVE_MAX_AGE),
+        attribute_cache=_merged(DEFAULT_LDAP_SYNC_CACHE, 'LDAP_SYNC_CACHE'),
+        dn_cache=_merged(DEFAULT_LDAP_SYNC_DN_CACHE, 'LDAP_SYNC_DN_CACHE'),
+        background_refresh=_merged(DEFAULT_LDAP_SYNC_BACKGROUND_REFRESH, 'LDAP_SYNC_BACKGROUND_REFRESH'),
+        rate_limit=_merged(DEFAULT_LDAP_SYNC_RATE_LIMIT, 'LDAP_SYNC_RATE_LIMIT'),
+        fingerprints=_flag('LDAP_SYNC_FINGERPRINTS', False),
+        incremental=_flag('LDAP_SYNC_INCREMENTAL', False),
+    )
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    ''' Returns the config of the current settings, built on first use '''
+
+    global _config
+
+    config = _config
+    if config is None:
+        with _config_lock:
+            if _config is None:
+                _config = build_config()
+            config = _config
+    return config
+
+
+def reset_config(setting=None, **kwargs):
+    ''' Drops the config, receiver of `setting_changed` '''
+
+    global _config
+
+    if setting is None or setting.startswith('LDAP_SYNC_') or setting == 'AUTH_USER_MODEL':
+        with _config_lock:
+            _config = None
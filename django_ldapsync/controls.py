@@ -0,0 +1,66 @@
+from ldap3.protocol.controls import build_control
+from ldap3.protocol.rfc4511 import AttributeDescription, MatchingRuleId, ResultCode
+from pyasn1.codec.ber import decoder
+from pyasn1.error import PyAsn1Error
+from pyasn1.type import namedtype, tag, univ
+
+# Server side sorting (RFC 2891)
+SORT_REQUEST_CONTROL = '1.2.840.113556.1.4.473'
+SORT_RESPONSE_CONTROL = '1.2.840.113556.1.4.474'
+
+
+class SortKey(univ.Sequence):
+    # SortKey ::= SEQUENCE {
+    #     attributeType   AttributeDescription,
+    #     orderingRule    [0] MatchingRuleId OPTIONAL,
+    #     reverseOrder    [1] BOOLEAN DEFAULT FALSE }
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('attributeType', AttributeDescription()),
+        namedtype.OptionalNamedType('orderingRule', MatchingRuleId().subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0))),
+        namedtype.DefaultedNamedType('reverseOrder', univ.Boolean(False).subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 1))),
+    )
+
+
+class SortKeyList(univ.SequenceOf):
+    # SortKeyList ::= SEQUENCE OF SortKey
+    componentType = SortKey()
+
+
+class SortResult(univ.Sequence):
+    # SortResult ::= SEQUENCE {
+    #     sortResult      ENUMERATED,
+    #     attributeType   [0] AttributeDescription OPTIONAL }
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('sortResult', ResultCode()),
+        namedtype.OptionalNamedType('attributeType', AttributeDescription().subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0))),
+    )
+
+
+def sort_control(*attributes, criticality=False):
+    ''' Returns a sort request control ordering the entries by `attributes` '''
+
+    key_list = SortKeyList()
+    for position, attribute in enumerate(attributes):
+        key = SortKey()
+        key['attributeType'] = AttributeDescription(attribute)
+        key_list.setComponentByPosition(position, key)
+    return build_control(SORT_REQUEST_CONTROL, criticality, key_list)
+
+
+def sort_result(result):
+    ''' Returns the result code of the sort response control in a search result, `None` if the server ignored the request '''
+
+    control = (result.get('controls') or {}).get(SORT_RESPONSE_CONTROL)
+    if not control:
+        return None
+    value = control.get('value')
+    if isinstance(value, dict):
+        return value.get('sort_result')
+    try:
+        decoded, _ = decoder.decode(bytes(value), asn1Spec=SortResult())
+    except (PyAsn1Error, TypeError):
+        return None
+    return int(decoded['sortResult'])
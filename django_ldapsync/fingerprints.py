@@ -0,0 +1,89 @@
+import datetime
+import hashlib
+import json
+
+from django.db import connections, router
+from django.db.models import Q
+from django.utils import timezone
+
+from .ldap import chunked
+from .models import UserFingerprint
+
+# Stored fingerprint of a user in `values()` of the user model
+FINGERPRINT_FIELD = 'ldap_fingerprint__fingerprint'
+
+
+def compute_fingerprint(attributes):
+    ''' Returns a compact hash of the Django-Attributes a user should have
+
+    The attributes are already truncated to the fields (see
+    `Ldap.to_django_attributes()`), the order of the keys does not matter.
+    '''
+
+    data = json.dumps(sorted(attributes.items()), ensure_ascii=False, default=str, separators=(',', ':'))
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def stale_users(max_age, now=None):
+    ''' Returns the filter for users not synced for `max_age` seconds, or never '''
+
+    before = (now or timezone.now()) - datetime.timedelta(seconds=max_age)
+    return Q(ldap_fingerprint__isnull=True) | Q(ldap_fingerprint__synced__lt=before)
+
+
+def store_fingerprints(changed, unchanged, batch_size, now=None):
+    ''' Writes the fingerprints of `(user_id, fingerprint)` pairs and marks the `unchanged` user ids as synced '''
+
+    now = now or timezone.now()
+    features = connections[router.db_for_write(UserFingerprint)].features
+    # MySQL updates on any unique conflict and refuses a target
+    unique_fields = ['user'] if features.supports_update_conflicts_with_target else None
+    for batch in chunked(changed, batch_size):
+        UserFingerprint.objects.bulk_create(
+            [UserFingerprint(user_id=user_id, fingerprint=fingerprint, synced=now) for user_id, fingerprint in batch],
+            update_conflicts=True, unique_fields=unique_fields, update_fields=['fingerprint', 'synced'],
+        )
+    for batch in chunked(unchanged, batch_size):
+        UserFingerprint.objects.filter(user_id__in=batch).update(synced=now)
+
+
+class FingerprintTracker(object):
+    ''' Compares the LDAP attributes of users with their stored fingerprints and collects the new ones
+
+    The `user_dict`s must contain `pk` and `FINGERPRINT_FIELD`. With `skip`
+    users matching their fingerprint are not compared field by field (local
+    changes of the mapped fields are then kept until LDAP changes). Pass
+    `Spool`s as `changed` and `unchanged` to keep the memory constant.
+    '''
+
+    def __init__(self, skip=True, batch_size=500, changed=None, unchanged=None):
+        self.skip = skip
+        self.batch_size = batch_size
+        self.changed = [] if changed is None else changed
+        self.unchanged = [] if unchanged is None else unchanged
+        self.skipped = 0
+
+    def matches(self, user_dict, attributes):
+        ''' Records the fingerprint of `attributes`, returns `True` if the user can be skipped '''
+
+        fingerprint = compute_fingerprint(attributes)
+        matched = fingerprint == user_dict.get(FINGERPRINT_FIELD)
+        if matched:
+            self.unchanged.append(user_dict['pk'])
+        else:
+            self.changed.append((user_dict['pk'], fingerprint))
+        if matched and self.skip:
+            self.skipped += 1
+            return True
+        return False
+
+    def __len__(self):
+        return len(self.changed) + len(self.unchanged)
+
+    def save(self):
+        ''' Writes the collected fingerprints, call it after the changes of the users are written '''
+
+        store_fingerprints(self.changed, self.unchanged, self.batch_size)
+        if isinstance(self.changed, list):
+            # Lists are emptied, so `save()` can be called repeatedly
+            self.changed, self.unchanged = [], []
@@ -0,0 +1,137 @@
+import threading
+import time
+
+from .conf import get_config
+
+
+def _first(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+class GroupGraph(object):
+    ''' Nesting graph of all groups below the search base
+
+    Built from the direct `member` values of every group (ldap3 fetches
+    ranged values of large groups automatically, see `auto_range`). Members
+    which are groups themselves are expanded on the client, cycles in the
+    nesting are tolerated. DNs are compared case-insensitive.
+    '''
+
+    def __init__(self, groups):
+        # `groups` maps the DN of every group to its direct members
+        names = {dn.lower() for dn in groups}
+        self.subgroups = {}
+        self.members = {}
+        for dn, members in groups.items():
+            key = dn.lower()
+            self.subgroups[key] = []
+            self.members[key] = []
+            for member in members:
+                if member.lower() in names:
+                    self.subgroups[key].append(member.lower())
+                else:
+                    self.members[key].append(member)
+        self.created = time.monotonic()
+
+    @classmethod
+    def build(cls, ldap, page_size=None):
+        ''' Reads all groups with one paged search, raises if it is incomplete (see `Ldap.paged_search()`) '''
+
+        groups = {}
+        for attributes in ldap.paged_search('(objectClass=group)', ['distinguishedName', 'member'], page_size=page_size):
+            dn = _first(attributes.get('distinguishedName'))
+            if dn:
+                groups[dn] = attributes.get('member') or []
+        return cls(groups)
+
+    def __contains__(self, group_dn):
+        return group_dn.lower() in self.subgroups
+
+    def __len__(self):
+        return len(self.subgroups)
+
+    def expand(self, group_dn, memo=None):
+        ''' Returns the DNs of all members of a group which are no groups, including nested groups
+
+        `memo` maps already expanded groups to their result, it is updated
+        and lets many groups share the work of common subgroups.
+        '''
+
+        root = group_dn.lower()
+        if memo is not None and root in memo:
+            return memo[root]
+        if root not in self.subgroups:
+            return set()
+
+        result = set()
+        seen = {root}
+        stack = [root]
+        while stack:
+            key = stack.pop()
+            result.update(self.members[key])
+            for subgroup in self.subgroups[key]:
+                if subgroup in seen:
+                    continue
+                seen.add(subgroup)
+                if memo is not None and subgroup in memo:
+                    # Complete result of the subgroup, no need to descend
+                    result.update(memo[subgroup])
+                else:
+                    stack.append(subgroup)
+        if memo is not None:
+            memo[root] = result
+        return result
+
+    def expand_many(self, group_dns):
+        ''' Returns the members of many groups (see `expand()`) by group DN '''
+
+        memo = {}
+        return {group_dn: self.expand(group_dn, memo) for group_dn in group_dns}
+
+
+def membership_diff(desired, current):
+    ''' Compares the members of groups, returns `(added, removed)` member sets by group
+
+    `desired` and `current` map groups to sets of members, groups missing in
+    `current` have no members yet. Unchanged groups are left out.
+    '''
+
+    diff = {}
+    for group, members in desired.items():
+        existing = current.get(group, set())
+        added, removed = members - existing, existing - members
+        if added or removed:
+            diff[group] = (added, removed)
+    return diff
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_group_graph(ldap, refresh=False):
+    ''' Returns the cached group graph of the server, rebuilt after `LDAP_SYNC_GROUP_CACHE_TIMEOUT` seconds
+
+    A failed build raises and caches nothing, an incomplete graph would hide
+    nested memberships until it expires.
+    '''
+
+    timeout = get_config().group_cache_timeout
+    key = (ldap.LDAP_SYNC_URI, ldap.LDAP_PARAMS['base'])
+    # Only one thread builds the graph, the others wait for its result
+    with _graphs_lock:
+        graph = _graphs.get(key)
+        if refresh or graph is None or time.monotonic() - graph.created >= timeout:
+            # Only stored once the search completed
+            graph = GroupGraph.build(ldap)
+            _graphs[key] = graph
+        return graph
+
+
+def clear_group_graphs():
+    ''' Drops all cached group graphs, e.g. after a change of the group structure '''
+
+    with _graphs_lock:
+        _graphs.clear()
@@ -1,165 +1,999 @@
+import datetime
 import logging
+import os
 import ssl
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
 
 import ldap3
 from ldap3 import Server, Connection, SYNC
-from ldap3.core.exceptions import LDAPException
+from ldap3.core.exceptions import LDAPException, LDAPBindError, LDAPOperationResult
+from ldap3.core.results import RESULT_SUCCESS
 from ldap3.core.tls import Tls
-from ldap3.utils.uri import parse_uri
+from ldap3.protocol.formatters.formatters import format_time
+from ldap3.protocol.rfc4512 import SchemaInfo
 from ldap3.utils.conv import escape_filter_chars
 
-from django.conf import settings
-from django.contrib.auth import get_user_model
 from django.utils.functional import cached_property
 
-# Default-Settings
-DEFAULT_LDAP_SYNC_USER_ATTRIBUTES = {
-    'username': 'sAMAccountName',
-    'first_name': 'givenName',
-    'last_name': 'sn',
-    'email': 'mail',
-}
-DEFAULT_LDAP_TIMEOUT = 5
+from .breaker import STATE_OPEN, CircuitBreaker, CircuitOpen
+from .cache import MISSING, AttributeCache, DnCache, get_attribute_cache, get_dn_cache
+from .conf import (
+    DEFAULT_LDAP_POOL_IDLE_TIMEOUT, DEFAULT_LDAP_POOL_MAX_LIFETIME, DEFAULT_LDAP_POOL_SIZE, DEFAULT_LDAP_TIMEOUT,
+    GROUP_STRATEGY_GRAPH, SCAN_FILTER, SERVER_INFO_CACHE, SERVER_INFO_NONE, SERVER_INFO_SCHEMA, USER_FILTER, get_config,
+)
+from .controls import sort_control, sort_result
+from .groups import get_group_graph
+from .servers import ServerSelector
+from .stats import instrument, response_size
+from .throttle import OVERLOAD_RESULTS, backoff_delay, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
+
+
+def decode_text(raw_value):
+    ''' Formatter for the mapped attributes, decodes the raw bytes without looking at the schema '''
+
+    return bytes(raw_value).decode('utf-8', 'replace')
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+_unsafe_directories = set()
+
+
+def _is_private_directory(directory):
+    ''' Whether `directory` belongs to this user and nobody else may write to it
+
+    Files in it can not be planted or swapped by other users, e.g. in the
+    shared temporary directory. A warning is logged once per directory.
+    '''
+
+    try:
+        status = os.stat(directory)
+    except OSError:
+        return False
+    private = not status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    if hasattr(os, 'getuid'):
+        private = private and status.st_uid == os.getuid()
+    if not private and directory not in _unsafe_directories:
+        _unsafe_directories.add(directory)
+        logger.warning("Schema cache directory %s is writable by other users, the schema is read from the server", directory)
+    return private
+
+
+def load_schema(path):
+    ''' Returns the schema stored in `path` (parsed once per process), `None` if there is none '''
+
+    with _schemas_lock:
+        schema = _schemas.get(path)
+        if schema is None and os.path.exists(path) and _is_private_directory(os.path.dirname(path)):
+            try:
+                schema = SchemaInfo.from_file(path)
+            except (OSError, ValueError, KeyError, TypeError):
+                logger.warning("Schema cache %s is not readable, the schema is read from the server", path)
+                return None
+            _schemas[path] = schema
+        return schema
+
+
+def save_schema(schema, path):
+    ''' Stores the schema in `path` for other connections and processes
+
+    The directory is created private to this user, the file is written to a
+    new temporary file next to it and then renamed.
+    '''
+
+    directory = os.path.dirname(path)
+    temporary = None
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if _is_private_directory(directory):
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.schema-', suffix='.tmp', delete=False, encoding='utf-8') as temporary:
+                temporary.write(schema.to_json())
+            os.replace(temporary.name, path)
+    except OSError as error:
+        logger.warning("Schema cache %s not written: %s", path, error)
+        if temporary is not None and os.path.exists(temporary.name):
+            os.unlink(temporary.name)
+    with _schemas_lock:
+        _schemas[path] = schema
+
+
+def create_connection(params, user, password, timeout, server_info=SERVER_INFO_SCHEMA, schema_file=None, formatter=None,
+                      receive_timeout=None):
+    ''' Opens a new bound connection to the LDAP server
+
+    `timeout` limits connecting, `receive_timeout` every response of the
+    server (`None` waits forever).
+    `server_info` controls the schema (see `LDAP_SYNC_CONNECTION`): ldap3
+    reads it on every new connection (`schema`), it is not used at all
+    (`none`) or read once and then loaded from `schema_file` (`cache`).
+    `formatter` maps attribute names to functions decoding their raw values.
+    '''
+
+    # Verbindungsparameter für den LDAP-Server
+    server_options = {
+        'host': params['host'],
+        'use_ssl': False,
+        'port': params['port'],
+        'connect_timeout': timeout,
+    }
+    if params['ssl']:
+        server_options['use_ssl'] = True
+        server_options['tls'] = Tls(validate=ssl.CERT_REQUIRED)
+
+    schema = None
+    get_info = ldap3.SCHEMA
+    if server_info == SERVER_INFO_NONE:
+        get_info = ldap3.NONE
+    elif server_info == SERVER_INFO_CACHE:
+        schema = load_schema(schema_file)
+        if schema is not None:
+            get_info = ldap3.NONE
+
+    # Authentifizierung am Server
+    ldap_server = Server(get_info=get_info, formatter=dict(formatter) if formatter else None, **server_options)
+    if schema is not None:
+        ldap_server.attach_schema_info(schema)
+    connection_options = {
+        'server': ldap_server,
+        'user': user,
+        'password': password,
+        'client_strategy': SYNC,
+        'receive_timeout': receive_timeout,
+    }
+    connection = Connection(**connection_options)
+    # Open and bind separately (instead of `auto_bind`) to measure both steps
+    with instrument('connect'):
+        connection.open()
+    with instrument('bind') as operation:
+        if not connection.bind():
+            operation.failed = True
+            raise LDAPBindError("Bind as %s failed: %s" % (user, connection.result.get('description')))
+    # The schema was read while binding
+    if server_info == SERVER_INFO_CACHE and schema is None and ldap_server.schema:
+        save_schema(ldap_server.schema, schema_file)
+    return connection
+
+
+def chunked(iterable, size):
+    ''' Yields lists of up to `size` items, consuming `iterable` lazily '''
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def result_error(result):
+    ''' Returns the `LDAPOperationResult` (subclass) for the error `result` of an operation '''
+
+    return LDAPOperationResult(
+        result=result['result'], description=result.get('description'), dn=result.get('dn'),
+        message=result.get('message'), response_type=result.get('type'),
+    )
+
+
+class LdapPoolTimeout(LDAPException):
+    ''' Raised when no pooled connection became available in time '''
+
+
+class LdapUnavailable(LDAPException):
+    ''' Raised by operations which must not silently return nothing if the server is unreachable '''
+
+
+class LdapSortUnavailable(Exception):
+    ''' Raised by sorted searches before the first entry if the server does not sort the result '''
+
+
+class _PoolEntry(object):
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class LdapConnectionPool(object):
+    ''' Thread-safe pool of bound connections, shared by all `Ldap` instances of a process.
+
+    `factory` is called without arguments and must return a bound connection.
+    Connections are handed out to one thread at a time, idle connections are
+    reused (last in, first out) until they exceed `idle_timeout` or
+    `max_lifetime`. At most `size` connections exist at the same time, further
+    borrowers wait up to `wait_timeout` seconds.
+
+    With a `selector` (see `servers.py`) connections to servers it no longer
+    accepts are not reused. With a `breaker` (see `breaker.py`) no connection
+    is handed out while the circuit is open, `CircuitOpen` is raised instead;
+    the probe of the half open circuit always opens a new connection.
+    '''
+
+    def __init__(self, factory, size=DEFAULT_LDAP_POOL_SIZE, idle_timeout=DEFAULT_LDAP_POOL_IDLE_TIMEOUT,
+                 max_lifetime=DEFAULT_LDAP_POOL_MAX_LIFETIME, wait_timeout=DEFAULT_LDAP_TIMEOUT, selector=None, breaker=None):
+        self.factory = factory
+        self.selector = selector
+        self.breaker = breaker
+        self.size = max(1, int(size))
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+
+        self._lock = threading.Condition()
+        self._idle = []
+        self._in_use = {}
+        self._opening = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.rebinds = 0
+        self.discarded = 0
+        self.failures = 0
+
+    def _is_expired(self, entry, now):
+        if entry.connection.closed:
+            return True
+        if self.idle_timeout is not None and now - entry.last_used > self.idle_timeout:
+            return True
+        if self.max_lifetime is not None and now - entry.created > self.max_lifetime:
+            return True
+        if self.selector is not None and not self.selector.accepts(entry.connection):
+            return True
+        return False
+
+    def _close(self, connection):
+        try:
+            connection.unbind()
+        except Exception:
+            pass
+
+    def acquire(self):
+        ''' Borrows a connection, creating a new one if the pool has room for it '''
+
+        # Idle connections date from before the outage, the probe connects anew
+        probe = self.breaker is not None and self.breaker.allow()
+        expired = []
+        deadline = time.monotonic() + self.wait_timeout if self.wait_timeout is not None else None
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    entry = self._idle.pop()
+                    if probe or self._is_expired(entry, now):
+                        expired.append(entry.connection)
+                        self.discarded += 1
+                        continue
+                    self._in_use[id(entry.connection)] = entry
+                    self.hits += 1
+                    break
+                else:
+                    entry = None
+                if entry is not None:
+                    break
+                if len(self._in_use) + self._opening < self.size:
+                    self._opening += 1
+                    self.misses += 1
+                    break
+                remaining = deadline - now if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    if probe:
+                        self.breaker.cancel_probe()
+                    raise LdapPoolTimeout("No LDAP connection available within %s seconds" % self.wait_timeout)
+                self.waits += 1
+                self._lock.wait(remaining)
+
+        # Close expired connections and open new ones outside of the lock
+        for connection in expired:
+            self._close(connection)
+        if entry is not None:
+            return entry.connection
+
+        try:
+            connection = self.factory()
+        except Exception:
+            with self._lock:
+                self._opening -= 1
+                self.failures += 1
+                self._lock.notify()
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        if self.breaker is not None:
+            self.breaker.record_success()
+        with self._lock:
+            self._opening -= 1
+            self._in_use[id(connection)] = _PoolEntry(connection)
+        return connection
+
+    def release(self, connection, discard=False):
+        ''' Returns a borrowed connection, broken connections should be discarded '''
+
+        with self._lock:
+            entry = self._in_use.pop(id(connection), None)
+            if entry is not None and not discard and not connection.closed and (self.selector is None or self.selector.accepts(connection)):
+                entry.last_used = time.monotonic()
+                self._idle.append(entry)
+                connection = None
+            elif entry is not None:
+                self.discarded += 1
+            self._lock.notify()
+        if connection is not None:
+            self._close(connection)
+
+    @contextmanager
+    def connection(self):
+        ''' Borrows a connection for the duration of the block.
+
+        If the block fails with an `LDAPException` the connection is discarded
+        instead of being returned to the pool.
+        '''
+
+        connection = self.acquire()
+        try:
+            yield connection
+        except CircuitOpen:
+            # Rejected before it was used, the connection is fine
+            self.release(connection)
+            raise
+        except LDAPException:
+            self.release(connection, discard=True)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def rebind(self, connection):
+        ''' Re-establishes a connection after a failed operation '''
+
+        if self.breaker is not None:
+            self.breaker.check()
+        with self._lock:
+            self.rebinds += 1
+        try:
+            connection.unbind()
+        except Exception:
+            pass
+        try:
+            connection.bind()
+        except LDAPException:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+
+    def clear(self):
+        ''' Closes all idle connections '''
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self.discarded += len(idle)
+        for entry in idle:
+            self._close(entry.connection)
+        if self.selector is not None:
+            self.selector.close()
+
+    def stats(self):
+        ''' Returns the pool counters, e.g. to size the pool '''
+
+        with self._lock:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'rebinds': self.rebinds,
+                'discarded': self.discarded,
+                'failures': self.failures,
+            }
+
+
+_pool = None
+_pool_key = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    ''' Returns the connection pool of this process for the current settings '''
+
+    global _pool, _pool_key, _pool_pid
+
+    config = get_config()
+    key = config.connection_key
+    with _pool_lock:
+        # Connections must not be shared with forked worker processes
+        if _pool is not None and (_pool_key != key or _pool_pid != os.getpid()):
+            if _pool_pid == os.getpid():
+                _pool.clear()
+            _pool = None
+        if _pool is None:
+            selector = ServerSelector(
+                config.uris,
+                partial(
+                    create_connection, user=config.username, password=config.password, timeout=config.timeout,
+                    receive_timeout=config.receive_timeout,
+                    server_info=config.server_info, schema_file=config.schema_file,
+                    formatter={attribute: decode_text for attribute in config.search_attributes},
+                ),
+                strategy=config.server_strategy,
+                probe_interval=config.server_probe_interval,
+                max_failures=config.server_max_failures,
+                eject_seconds=config.server_eject_seconds,
+                slow_threshold=config.server_slow_threshold,
+            )
+            breaker = None
+            if config.breaker_failures:
+                breaker = CircuitBreaker(config.breaker_failures, config.breaker_reset_seconds)
+            _pool = LdapConnectionPool(
+                selector.connect,
+                size=config.pool_size,
+                idle_timeout=config.pool_idle_timeout,
+                max_lifetime=config.pool_max_lifetime,
+                wait_timeout=config.timeout,
+                selector=selector,
+                breaker=breaker,
+            )
+            _pool_key = key
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def set_connection_pool(pool):
+    ''' Replaces the connection pool of this process, e.g. with one using a custom factory '''
+
+    global _pool, _pool_key, _pool_pid
+
+    with _pool_lock:
+        if _pool is not None and _pool is not pool and _pool_pid == os.getpid():
+            _pool.clear()
+        _pool = pool
+        _pool_key = get_config().connection_key if pool is not None else None
+        _pool_pid = os.getpid()
+
 
 class Ldap(object):
     def __init__(self):
         ''' Modul initialisieren'''
 
         # Logger
-        self.logger = logging.getLogger(__name__)
-
-        # Get Settings
-        self.LDAP_SYNC_URI = settings.LDAP_SYNC_CONNECTION['uri']
-        self.LDAP_PARAMS = parse_uri(self.LDAP_SYNC_URI)
-        self.LDAP_SYNC_BASE_USER = settings.LDAP_SYNC_CONNECTION['username']
-        self.LDAP_SYNC_BASE_PASS = settings.LDAP_SYNC_CONNECTION['password']
-        self.LDAP_TIMEOUT = getattr(settings.LDAP_SYNC_CONNECTION, 'timeout', DEFAULT_LDAP_TIMEOUT)
-        self.LDAP_SYNC_USER_ATTRIBUTES = getattr(settings, 'LDAP_SYNC_USER_ATTRIBUTES', DEFAULT_LDAP_SYNC_USER_ATTRIBUTES)
-
-        # Check MaxLength
-        User = get_user_model()
-        self.USER_MODEL_ATTRS_MAX_LENGTH = {}
-        for field_name in self.LDAP_SYNC_USER_ATTRIBUTES.keys():
-            field = User._meta.get_field(field_name)
-            self.USER_MODEL_ATTRS_MAX_LENGTH[field_name] = field.max_length
+        self.logger = logger
+
+        # Settings are read and checked once (see `conf.py`)
+        self.config = config = get_config()
+        self.LDAP_SYNC_URI = config.uri
+        self.LDAP_PARAMS = config.params
+        self.LDAP_SYNC_BASE_USER = config.username
+        self.LDAP_SYNC_BASE_PASS = config.password
+        self.LDAP_TIMEOUT = config.timeout
+        self.LDAP_SYNC_USER_ATTRIBUTES = config.user_attributes
+        self.LDAP_PAGE_SIZE = config.page_size
+        self.LDAP_GROUP_STRATEGY = config.group_strategy
+        self.USER_MODEL_ATTRS_MAX_LENGTH = config.max_lengths
+
+    @cached_property
+    def pool(self):
+        ''' Shared connection pool of this process '''
+
+        return get_connection_pool()
 
     @cached_property
     def connection(self):
-        ''' Connecion '''
-
-        # Verbindungsparameter für den LDAP-Server
-        server_options = {
-            'host': self.LDAP_PARAMS['host'],
-            'use_ssl': False,
-            'port': self.LDAP_PARAMS['port'],
-            'connect_timeout': self.LDAP_TIMEOUT,
-        }
-        if self.LDAP_PARAMS['ssl']:
-            server_options['use_ssl'] = True
-            server_options['tls'] = Tls(validate=ssl.CERT_REQUIRED)
-
-        # Authentifizierung am Server
-        ldap_server = Server(**server_options)
-        connection_options = {
-            'server': ldap_server,
-            'auto_bind': True,
-            'user': self.LDAP_SYNC_BASE_USER,
-            'password': self.LDAP_SYNC_BASE_PASS,
-            'client_strategy': SYNC,
-        }
+        ''' Connection borrowed from the pool for the lifetime of this instance (see `close()`) '''
+
         try:
-            return Connection(**connection_options)
+            return self.pool.acquire()
+        except CircuitOpen as error:
+            # Already logged when the circuit opened
+            self.logger.debug("%s", error)
+            return None
         except LDAPException:
             self.logger.warning("LDAP connection failed, LDAP updates will not be available.")
             return None
 
+    def close(self):
+        ''' Returns a connection held by this instance to the pool '''
+
+        conn = self.__dict__.pop('connection', None)
+        if conn is not None:
+            self.pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def borrow_connection(self, required=False):
+        ''' Yields a pooled connection for a single operation, or `None` if the server is unreachable
+
+        With `required` the error of the pool (e.g. `LdapPoolTimeout` or
+        `CircuitOpen`) is raised instead of yielding `None`.
+        '''
+
+        # An instance holding its own connection keeps using it
+        if 'connection' in self.__dict__:
+            if self.connection is None and required:
+                raise LdapUnavailable("LDAP server not reachable")
+            yield self.connection
+            return
+
+        try:
+            conn = self.pool.acquire()
+        except CircuitOpen as error:
+            if required:
+                raise
+            self.logger.debug("%s", error)
+            yield None
+            return
+        except LDAPException:
+            if required:
+                raise
+            self.logger.warning("LDAP connection failed, LDAP updates will not be available.")
+            yield None
+            return
+        try:
+            yield conn
+        except CircuitOpen:
+            self.pool.release(conn)
+            raise
+        except LDAPException:
+            self.pool.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.pool.release(conn)
+            raise
+        else:
+            self.pool.release(conn)
+
+    def is_available(self):
+        ''' Checks whether a connection to the LDAP server can be established, `False` while the circuit is open '''
+
+        breaker = getattr(self.pool, 'breaker', None)
+        if breaker is not None and breaker.state == STATE_OPEN:
+            return False
+        with self.borrow_connection() as conn:
+            return conn is not None
+
     def get_username_key(self):
         ''' Return LDAP-Key which represents Django-Username '''
 
         return self.LDAP_SYNC_USER_ATTRIBUTES['username']
 
-    def get_django_attributes_for_user(self, username):
-        ''' Return Django-Attributes for User '''
+    def get_django_attributes_for_user(self, username, refresh=False, required=False):
+        ''' Return Django-Attributes for User
+
+        Results are cached (see `LDAP_SYNC_CACHE`), `refresh=True` bypasses the
+        cached value and stores the fresh one. `{}` means the user is unknown,
+        or the search failed (server not reachable, error result) and nothing
+        is cached; with `required` the latter raises an `LDAPException` (e.g.
+        `LdapPoolTimeout` or `LDAPOperationResult`) instead.
+        '''
+
+        cache = get_attribute_cache()
+        if not refresh:
+            model_attrs = cache.get(username)
+            if model_attrs is not None:
+                return dict(model_attrs)
 
         # Get from LDAP
-        ldap_attributes = list(self.LDAP_SYNC_USER_ATTRIBUTES.values())
-        ldap_user = self.get_user(username, attributes=ldap_attributes)
+        ldap_user = self._get_user(username, attributes=list(self.config.ldap_attributes), required=required)
+        if ldap_user is None:
+            # Search failed, don't cache
+            return {}
 
         # Return for Django (use Mapping)
+        model_attrs = self.to_django_attributes(ldap_user)
+        cache.set(username, model_attrs)
+        return dict(model_attrs)
+
+    def to_django_attributes(self, ldap_user):
+        ''' Converts LDAP-Attributes to Django-Attributes (use Mapping) '''
+
         model_attrs = {}
-        for django_key, ldap_key in self.LDAP_SYNC_USER_ATTRIBUTES.items():
-            if ldap_key in ldap_user and ldap_user[ldap_key]:
+        for django_key, ldap_key, max_length in self.config.attribute_rules:
+            value = ldap_user.get(ldap_key)
+            # Without schema information single values are returned as list
+            if isinstance(value, list):
+                value = value[0] if value else None
+            if value:
                 # Limit the LDAP value to the `max_length` of the field. Otherwise
                 # we run into validation errors.
-                model_attrs[django_key] = ldap_user[ldap_key][0:self.USER_MODEL_ATTRS_MAX_LENGTH[django_key]]
+                model_attrs[django_key] = value[0:max_length]
         return model_attrs
 
+    def _search(self, conn, operation='search', **search_kwargs):
+        ''' Runs `conn.search()` within the rate limit and records it in the stats registry (see `stats.py`)
+
+        Raises `CircuitOpen` without searching while the circuit breaker of
+        the pool is open. Errors and overload results (`busy`, `unavailable`,
+        `timeLimitExceeded`) count as failures of the breaker.
+        '''
+
+        breaker = getattr(self.pool, 'breaker', None)
+        if breaker is not None:
+            breaker.check()
+        limiter = get_rate_limiter()
+        limiter.acquire()
+        selector = getattr(self.pool, 'selector', None)
+        try:
+            with instrument(operation) as measurement:
+                result = conn.search(**search_kwargs)
+                measurement.entries, measurement.bytes = response_size(conn.response)
+                measurement.failed = conn.result is not None and conn.result.get('result') != RESULT_SUCCESS
+        except LDAPException:
+            if selector is not None:
+                selector.record(conn, failed=True)
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        code = conn.result.get('result') if conn.result else None
+        if breaker is not None:
+            # An overloaded server answers, but is as unusable as an unreachable
+            # one; any other answer, even an error result, shows it works
+            if code in OVERLOAD_RESULTS:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        # Only single lookups are a fair latency sample, pages depend on their size
+        latency = measurement.duration if operation == 'search' else None
+        limiter.record(code, latency)
+        if selector is not None:
+            selector.record(conn, latency=latency)
+        return result
+
+    def paged_search(self, search_filter, attributes, page_size=None, search_base=None, sort_by=None):
+        ''' Yields the attributes of all entries matching the filter, fetched page by page
+
+        With `sort_by` the server sorts the entries by this attribute
+        (RFC 2891), `LdapSortUnavailable` is raised if it does not. A page
+        ending with an error result raises `LDAPOperationResult` after its
+        entries, the search is incomplete.
+        '''
+
+        with self.borrow_connection() as conn:
+            if not conn:
+                raise LdapUnavailable("LDAP server not reachable")
+            search_kwargs = {
+                'search_base': search_base or self.LDAP_PARAMS['base'],
+                'search_scope': ldap3.SUBTREE,
+                'search_filter': search_filter,
+                'attributes': attributes,
+                'paged_size': page_size or self.LDAP_PAGE_SIZE,
+                'get_operational_attributes': False,
+                'controls': [sort_control(sort_by)] if sort_by else None,
+            }
+            cookie = None
+            while True:
+                self._search(conn, operation='paged_search_page', paged_cookie=cookie, **search_kwargs)
+                # Keep the page, the next request replaces `conn.response`
+                response, result = conn.response or [], conn.result
+                if sort_by and cookie is None and sort_result(result) != RESULT_SUCCESS:
+                    raise LdapSortUnavailable("Server did not sort by %s: %s" % (sort_by, result.get('description')))
+                try:
+                    cookie = result['controls'][PAGED_RESULTS_CONTROL]['value']['cookie']
+                except (KeyError, TypeError):
+                    cookie = None
+
+                for entry in response:
+                    if entry['type'] == 'searchResEntry':
+                        yield entry['attributes']
+                # Whatever `raise_exceptions` says, an error result (e.g. a
+                # time or size limit) truncates the search: callers must not
+                # treat the entries missing as deleted
+                if result['result'] != RESULT_SUCCESS:
+                    raise result_error(result)
+                if not cookie:
+                    break
+
+    def get_server_state(self):
+        ''' Returns name, highest committed USN and current time of the server (RootDSE)
+
+        Values the server does not provide are `None`.
+        '''
+
+        state = {
+            'server': self.LDAP_PARAMS['host'],
+            'highest_usn': None,
+            'current_time': None,
+        }
+        with self.borrow_connection() as conn:
+            if not conn:
+                raise LdapUnavailable("LDAP server not reachable")
+            # The USN is local to each server, name the one this connection belongs to
+            selector = getattr(self.pool, 'selector', None)
+            server = selector.server_of(conn) if selector is not None else None
+            if server is not None:
+                state['server'] = server.params['host']
+            try:
+                self._search(
+                    conn,
+                    search_base='',
+                    search_scope=ldap3.BASE,
+                    search_filter='(objectClass=*)',
+                    attributes=['dnsHostName', 'highestCommittedUSN', 'currentTime'],
+                )
+            except LDAPException:
+                self.logger.debug("RootDSE not readable, using defaults")
+                return state
+            if not conn.response or 'attributes' not in conn.response[0]:
+                return state
+            root_dse = conn.response[0]['attributes']
+
+        def first(value):
+            if isinstance(value, list):
+                return value[0] if value else None
+            return value
+
+        if first(root_dse.get('dnsHostName')):
+            state['server'] = first(root_dse.get('dnsHostName'))
+        if first(root_dse.get('highestCommittedUSN')) is not None:
+            state['highest_usn'] = int(first(root_dse.get('highestCommittedUSN')))
+        current_time = first(root_dse.get('currentTime'))
+        if isinstance(current_time, (str, bytes)):
+            # Without schema the value is not converted
+            current_time = format_time(current_time.encode() if isinstance(current_time, str) else current_time)
+        if isinstance(current_time, datetime.datetime):
+            state['current_time'] = current_time
+        return state
+
+    def iter_users(self, usernames=None, batch_size=None, changed_since_usn=None, changed_since=None, sort=False):
+        ''' Yields the mapped LDAP-Attributes of many users.
+
+        With `usernames` the users are searched in batches of `batch_size`
+        names per `(|(sAMAccountName=a)(sAMAccountName=b)...)` filter, without
+        all user objects below the search base are scanned. The scan can be
+        limited to entries changed after an USN (`uSNChanged`) or a point in
+        time (`whenChanged`), with `sort` the server returns it ordered by
+        `sAMAccountName` (see `paged_search()`).
+        '''
+
+        attributes = list(self.config.search_attributes)
+        if usernames is None:
+            if changed_since_usn is not None:
+                change_filter = '(uSNChanged>=%d)' % (changed_since_usn + 1)
+            elif changed_since is not None:
+                change_filter = '(whenChanged>=%s)' % changed_since.astimezone(datetime.timezone.utc).strftime('%Y%m%d%H%M%S.0Z')
+            else:
+                change_filter = ''
+            search_filter = SCAN_FILTER % change_filter
+            yield from self.paged_search(search_filter, attributes, sort_by='sAMAccountName' if sort else None)
+            return
+
+        for batch in chunked(usernames, batch_size or self.LDAP_PAGE_SIZE):
+            name_filters = ''.join(
+                USER_FILTER % escape_filter_chars(username).split('@')[0]
+                for username in batch
+            )
+            yield from self.paged_search('(|%s)' % name_filters, attributes)
+
+    def get_django_attributes_for_users(self, usernames=None, batch_size=None, **changed_since):
+        ''' Returns the Django-Attributes of many users, keyed by the normalized username
+
+        See `iter_users()` for the meaning of the arguments, the keys are built
+        with `AttributeCache.normalize()`.
+        '''
+
+        result = {}
+        for ldap_user in self.iter_users(usernames, batch_size=batch_size, **changed_since):
+            account_name = ldap_user.get('sAMAccountName')
+            if isinstance(account_name, list):
+                account_name = account_name[0] if account_name else None
+            if account_name:
+                result[AttributeCache.normalize(account_name)] = self.to_django_attributes(ldap_user)
+        return result
+
     def get_user(self, username, attributes=ldap3.ALL_ATTRIBUTES):
         ''' Returns the specified user from LDAP, without doing any conversion. '''
 
+        return self._get_user(username, attributes) or {}
+
+    def _get_user(self, username, attributes, required=False):
+        ''' Like `get_user()`, but returns `None` if the server is not reachable or answers with an error (raises with `required`)
+
+        `{}` is only returned for a successful search without entries.
+        '''
+
         cleaned_username = escape_filter_chars(username).split('@')[0]
         search_kwargs = {
             'search_base': self.LDAP_PARAMS['base'],
-            'search_filter': '(sAMAccountName=%s)' %cleaned_username,
+            'search_filter': USER_FILTER % cleaned_username,
             'attributes': attributes,
         }
 
-        conn = self.connection
-        if not conn:
-            return {}
-        try:
+        rate_limit = self.config.rate_limit
+        with self.borrow_connection(required=required) as conn:
+            if not conn:
+                return None
             self.logger.debug("Suche Nutzer: " + username)
-            result = conn.search(**search_kwargs)
-        except LDAPException:
-            # Try one more time before raising the exception
-            # @TODO: Catch exception in User.pre_save()
-            try:
-                conn.unbind()
-            except:
-                pass
-            conn.bind()
-            result = conn.search(**search_kwargs)
+            for attempt in range(rate_limit['retries'] + 1):
+                last_attempt = attempt == rate_limit['retries']
+                try:
+                    result = self._search(conn, **search_kwargs)
+                except CircuitOpen:
+                    # No retries against an unreachable server
+                    if required:
+                        raise
+                    return None
+                except LDAPException:
+                    # @TODO: Catch exception in User.pre_save()
+                    if last_attempt:
+                        raise
+                    time.sleep(backoff_delay(attempt, rate_limit['backoff_base'], rate_limit['backoff_max']))
+                    try:
+                        with instrument('rebind_retry'):
+                            self.pool.rebind(conn)
+                    except LDAPException:
+                        pass
+                    continue
+                # The rate limiter already paused before the next attempt
+                if last_attempt or not conn.result or conn.result.get('result') not in OVERLOAD_RESULTS:
+                    break
 
-        if not result or not conn.response[0] or 'attributes' not in conn.response[0]:
-            return {}
-        else:
-            return conn.response[0]['attributes']
+            # Retries used up (or an error which is not retried), the user is
+            # not known to be missing
+            error = conn.result or {}
+            if error.get('result', RESULT_SUCCESS) != RESULT_SUCCESS:
+                if required:
+                    raise result_error(error)
+                self.logger.warning("LDAP search for %s failed: %s", username, error.get('description'))
+                return None
+            if not result or not conn.response or 'attributes' not in conn.response[0]:
+                return {}
+            else:
+                return conn.response[0]['attributes']
 
-    def get_dn(self, common_name: str):
-        ''' Returns DistinguishedName from CommonName '''
+    def get_dn(self, common_name: str, object_class=None):
+        ''' Returns DistinguishedName from CommonName
 
-        # Search for CN
-        self.connection.search(
-            search_base=self.LDAP_PARAMS['base'],
-            search_scope=ldap3.SUBTREE,
-            search_filter=f"(cn={common_name})",
-            attributes=['DistinguishedName']
-        )
+        Results (including unknown names) are cached, see `LDAP_SYNC_DN_CACHE`.
+        `object_class` limits the search, e.g. to `group`.
+        '''
 
-        # Return
-        if len(self.connection.response) == 0:
-            return None
-        return self.connection.response[0]['attributes']['DistinguishedName']
+        return self.get_dns([common_name], object_class=object_class)[common_name]
+
+    def get_dns(self, common_names, object_class=None):
+        ''' Returns the DistinguishedNames of many CommonNames, `None` for unknown names
+
+        Names missing in the cache are searched with one
+        `(|(cn=a)(cn=b)...)` filter per page.
+        '''
+
+        cache = get_dn_cache()
+        result = {}
+        missing = {}
+        for common_name in common_names:
+            key = DnCache.make_key(common_name, object_class)
+            dn = cache.get(key)
+            if dn is MISSING:
+                missing.setdefault(common_name.lower(), []).append(common_name)
+            else:
+                result[common_name] = dn
+
+        found = {}
+        for batch in chunked(list(missing), self.LDAP_PAGE_SIZE):
+            search_filter = '(|%s)' % ''.join('(cn=%s)' % escape_filter_chars(name) for name in batch)
+            if object_class:
+                search_filter = '(&(objectClass=%s)%s)' % (escape_filter_chars(object_class), search_filter)
+            for attributes in self.paged_search(search_filter, ['cn', 'distinguishedName']):
+                common_name = attributes.get('cn')
+                distinguished_name = attributes.get('distinguishedName')
+                # Without schema information single values are returned as list
+                if isinstance(common_name, list):
+                    common_name = common_name[0] if common_name else None
+                if isinstance(distinguished_name, list):
+                    distinguished_name = distinguished_name[0] if distinguished_name else None
+                if common_name and distinguished_name:
+                    found.setdefault(common_name.lower(), distinguished_name)
+
+        for lower_name, names in missing.items():
+            dn = found.get(lower_name)
+            cache.set_dn(DnCache.make_key(lower_name, object_class), dn)
+            for common_name in names:
+                result[common_name] = dn
+        return result
+
+    def find_groups(self, pattern):
+        ''' Returns the DNs of all groups whose CommonName matches `pattern` by CommonName, `*` is a wildcard '''
+
+        cn_filter = '*'.join(escape_filter_chars(part) for part in pattern.split('*'))
+        groups = {}
+        for attributes in self.paged_search('(&(objectClass=group)(cn=%s))' % cn_filter, ['cn', 'distinguishedName']):
+            common_name = attributes.get('cn')
+            distinguished_name = attributes.get('distinguishedName')
+            if isinstance(common_name, list):
+                common_name = common_name[0] if common_name else None
+            if isinstance(distinguished_name, list):
+                distinguished_name = distinguished_name[0] if distinguished_name else None
+            if common_name and distinguished_name:
+                groups[common_name] = distinguished_name
+        return groups
+
+    def iter_group_members(self, group_dn: str, attributes=None, page_size=None, strategy=None):
+        ''' Yields the members of a group (including nested groups) page by page
+
+        Only one page of `page_size` entries is held in memory, `attributes`
+        defaults to the mapped LDAP-Attributes. Nested groups are resolved by
+        the server or the cached group graph (`strategy`, defaults to
+        `LDAP_SYNC_GROUP_STRATEGY`).
+        '''
+
+        if attributes is None:
+            attributes = list(self.config.ldap_attributes)
+        if (strategy or self.LDAP_GROUP_STRATEGY) == GROUP_STRATEGY_GRAPH:
+            member_dns = get_group_graph(self).expand(group_dn)
+            yield from self.iter_users_by_dn(sorted(member_dns), attributes, page_size=page_size)
+            return
+        search_filter = f"(&(objectClass=user)(memberOf:1.2.840.113556.1.4.1941:={group_dn}))"
+        yield from self.paged_search(search_filter, attributes, page_size=page_size)
+
+    def iter_group_member_chunks(self, group_dn: str, chunk_size, attributes=None, page_size=None):
+        ''' Like `iter_group_members()`, but yields lists of up to `chunk_size` members '''
+
+        return chunked(self.iter_group_members(group_dn, attributes=attributes, page_size=page_size), chunk_size)
+
+    def iter_users_by_dn(self, dns, attributes, page_size=None):
+        ''' Yields the attributes of the users with the given DNs, `page_size` DNs per search '''
+
+        page_size = page_size or self.LDAP_PAGE_SIZE
+        for batch in chunked(dns, page_size):
+            dn_filters = ''.join('(distinguishedName=%s)' % escape_filter_chars(dn) for dn in batch)
+            yield from self.paged_search('(&(objectClass=user)(|%s))' % dn_filters, attributes, page_size=page_size)
 
     def get_group_members(self, group_dn: str):
         ''' Returns all Members from a specific group '''
 
-        # Search for Group-Members
-        attributes = list(self.LDAP_SYNC_USER_ATTRIBUTES.values())
-        search_filter = f"(&(objectClass=user)(memberOf:1.2.840.113556.1.4.1941:={group_dn}))"
-        entry_generator = self.connection.extend.standard.paged_search(
-            search_base=self.LDAP_PARAMS['base'],
-            search_scope=ldap3.SUBTREE,
-            search_filter=search_filter,
-            attributes=attributes,
-            paged_size=500,
-            generator=True,
-            get_operational_attributes=False,
-        )
-
-        # Ergebnisse parsen
-        member_list = []
-        for entry in entry_generator:
-            if entry['type'] == 'searchResEntry':
-              member_list.append(entry['attributes'])
-        return member_list
+        return list(self.iter_group_members(group_dn))
+
+    def get_members_of_groups(self, group_dns, attributes=None, strategy=None):
+        ''' Returns the members of many groups by group DN
+
+        With the `graph` strategy every user is read only once, even if it is
+        a member of many of the groups. `strategy` overrides
+        `LDAP_SYNC_GROUP_STRATEGY`.
+        '''
+
+        if attributes is None:
+            attributes = list(self.config.ldap_attributes)
+        if (strategy or self.LDAP_GROUP_STRATEGY) != GROUP_STRATEGY_GRAPH:
+            return {group_dn: list(self.iter_group_members(group_dn, attributes, strategy=strategy)) for group_dn in group_dns}
+
+        member_dns = get_group_graph(self).expand_many(group_dns)
+        all_dns = set().union(*member_dns.values()) if member_dns else set()
+        search_attributes = list(attributes)
+        if 'distinguishedName' not in search_attributes:
+            search_attributes.append('distinguishedName')
+        users = {}
+        for user in self.iter_users_by_dn(sorted(all_dns), search_attributes):
+            dn = user.get('distinguishedName')
+            if isinstance(dn, list):
+                dn = dn[0] if dn else None
+            if dn:
+                users[dn.lower()] = user
+        return {
+            group_dn: [users[dn.lower()] for dn in sorted(dns) if dn.lower() in users]
+            for group_dn, dns in member_dns.items()
+        }
@@ -1,10 +1,14 @@
 from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import Group
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from django_ldapsync import Ldap
+from django_ldapsync.stats import RunStats
 
 class Command(BaseCommand):
+    DEFAULT_BATCH_SIZE = 500
     help = "Import LDAP-Group"
 
     def add_arguments(self, parser):
@@ -12,37 +16,97 @@ class Command(BaseCommand):
           dest='group_name',
           help="Groupname"
         )
+        parser.add_argument('-b', '--batch-size',
+          default=self.DEFAULT_BATCH_SIZE,
+          dest='batch_size',
+          type=int,
+          help="Number of rows per bulk insert. Default: {}".format(self.DEFAULT_BATCH_SIZE),
+        )
 
     def handle(self, *args, **options):
         ''' Import Users from LDAP-Group '''
 
         # Settings
         username_lower = getattr(settings, 'LDAP_SYNC_ALWAYS_LOWER_USERNAME', True)
+        batch_size = options.get('batch_size')
 
         # Read Group-Members
+        run_stats = RunStats()
         ldap = Ldap()
+        if not ldap.connection:
+          self.stderr.write("No LDAP-Connection, Abort")
+          return
         group_name = options.get('group_name', None)
-        group_name_dn = ldap.get_dn(group_name)
+        with run_stats.phase('search'):
+          group_name_dn = ldap.get_dn(group_name, object_class='group')
         if not group_name_dn:
           self.stdout.write(f"ERROR: Group '{group_name}' not found in LDAP")
           return
-        members = ldap.get_group_members(group_name_dn)
 
-        # Member Lookup/Creation
-        User = get_user_model()
+        # Members are processed in chunks, memory depends on the batch size only
+        member_count = created_count = linked_count = 0
+        with connection.execute_wrapper(run_stats), transaction.atomic():
+          django_group, _ = Group.objects.get_or_create(name=group_name)
+          chunks = ldap.iter_group_member_chunks(group_name_dn, batch_size, page_size=batch_size)
+          while True:
+            with run_stats.phase('search'):
+              chunk = next(chunks, None)
+            if chunk is None:
+              break
+
+            with run_stats.phase('import'):
+              new_users = self.get_new_users(ldap, chunk, username_lower)
+              created, linked = self.import_chunk(new_users, django_group, batch_size)
+            member_count += len(new_users)
+            created_count += created
+            linked_count += linked
+
+        self.stdout.write(
+          f"Imported group '{group_name}': {member_count} members, {created_count} users created, "
+          f"{linked_count} memberships added"
+        )
+        if options.get('verbosity') > 0:
+          for line in run_stats.summary(member_count):
+            self.stdout.write(line)
+
+    def get_new_users(self, ldap, members, username_lower):
+        ''' Returns the Django-Attributes of the members by username '''
+
+        new_users = {}
         for member in members:
+          attrs = ldap.to_django_attributes(member)
+          if not attrs.get('username'):
+            continue
+          if not username_lower:
+            attrs['username'] = attrs['username'].lower()
+          new_users[attrs['username']] = attrs
+        return new_users
 
-          # Which Field ist the Username
-          username_key = ldap.LDAP_SYNC_USER_ATTRIBUTES['username']
+    def import_chunk(self, new_users, django_group, batch_size):
+        ''' Creates missing users and memberships, returns both counts '''
+
+        User = get_user_model()
+        Membership = User.groups.through
+        filter_args = {User.USERNAME_FIELD + '__in': list(new_users)}
+        user_ids = dict(User.objects.filter(**filter_args).values_list(User.USERNAME_FIELD, 'pk'))
 
-          # User
-          username = member[username_key] if username_lower else member[username_key].lower()
-          obj, created = User.objects.get_or_create(username=username)
-          if created:
-            obj.set_unusable_password()
-            obj.save()
+        # Attributes of the new users are taken from the group search
+        missing_users = [
+          User(password=make_password(None), **attrs)
+          for username, attrs in new_users.items() if username not in user_ids
+        ]
+        if missing_users:
+          User.objects.bulk_create(missing_users, batch_size=batch_size)
+          filter_args = {User.USERNAME_FIELD + '__in': [getattr(obj, User.USERNAME_FIELD) for obj in missing_users]}
+          user_ids.update(User.objects.filter(**filter_args).values_list(User.USERNAME_FIELD, 'pk'))
 
-          # Group
-          if not obj.groups.filter(name=group_name).exists():
-            django_group, _ = Group.objects.get_or_create(name=group_name)
-            django_group.user_set.add(obj)
+        # Group
+        member_ids = set(Membership.objects.filter(
+          group=django_group, user_id__in=user_ids.values(),
+        ).values_list('user_id', flat=True))
+        missing_memberships = [
+          Membership(user_id=user_id, group_id=django_group.pk)
+          for user_id in user_ids.values() if user_id not in member_ids
+        ]
+        Membership.objects.bulk_create(missing_memberships, batch_size=batch_size, ignore_conflicts=True)
+        return len(missing_users), len(missing_memberships)
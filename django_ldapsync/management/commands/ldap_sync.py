@@ -1,11 +1,42 @@
+import datetime
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
 from django_ldapsync import Ldap
+from django_ldapsync.cache import AttributeCache
+from django_ldapsync.checkpoint import (
+    DEFAULT_INACTIVE_EVERY, ORDER_PK, ORDER_RECENT_LOGIN_FIRST, ORDERS, Checkpoint, inactive_users, order_users,
+)
+from django_ldapsync.conf import get_config
+from django_ldapsync.fingerprints import FINGERPRINT_FIELD, FingerprintTracker, stale_users
+from django_ldapsync.ldap import LdapSortUnavailable, chunked
+from django_ldapsync.merge import (
+    DEFAULT_SORT_CHUNK_SIZE, Spool, UnsortedInput, external_sort, iter_db_records, iter_ldap_records,
+    merge_join, verify_sorted,
+)
+from django_ldapsync.models import SyncState
+from django_ldapsync.sharding import (
+    DEFAULT_LEASE_SECONDS, LeaseLost, LeaseUnavailable, ShardLease, parse_shard, shard_of, shard_summary,
+)
+from django_ldapsync.stats import RunStats
+from ldap3.core.exceptions import LDAPException
 
 class Command(BaseCommand):
+    # Lease of the shard of the running sync, see `check_lease()`
+    lease = None
     DEFAULT_EXCLUDE_REGEX = '.*(_|-|^)api(_|-|$).*'
+    DEFAULT_BATCH_SIZE = 500
+    MODE_USER = 'user'
+    MODE_BATCH = 'batch'
+    MODE_SCAN = 'scan'
+    MODE_MERGE = 'merge'
     help = "Updates the attributes of all Django users from the LDAP server."
 
     def add_arguments(self, parser):
@@ -25,6 +56,105 @@ class Command(BaseCommand):
                       here for usernames that you want to ignore during the sync.\n\
                       Default: \"{}\"".format(self.DEFAULT_EXCLUDE_REGEX),
             )
+        parser.add_argument('-m', '--mode',
+                default=self.MODE_USER,
+                choices=[self.MODE_USER, self.MODE_BATCH, self.MODE_SCAN, self.MODE_MERGE],
+                help="'user' searches every user on its own, 'batch' searches many users \
+                      per (|(sAMAccountName=a)(sAMAccountName=b)...) filter and 'scan' reads \
+                      all users below the search base with one paged search. 'merge' streams \
+                      the database and the directory ordered by username with constant memory. \
+                      Default: \"{}\"".format(self.MODE_USER),
+            )
+        parser.add_argument('-b', '--batch-size',
+                default=self.DEFAULT_BATCH_SIZE,
+                dest='batch_size',
+                type=int,
+                help="Number of users per LDAP filter and per database update in the \
+                      'batch' and 'scan' modes. Default: {}".format(self.DEFAULT_BATCH_SIZE),
+            )
+        parser.add_argument('--sort-chunk-size',
+                default=DEFAULT_SORT_CHUNK_SIZE,
+                dest='sort_chunk_size',
+                type=int,
+                help="Number of users sorted in memory in the 'merge' mode if the server \
+                      or the database order can not be used. Default: {}".format(DEFAULT_SORT_CHUNK_SIZE),
+            )
+        parser.add_argument('-w', '--workers',
+                default=1,
+                type=int,
+                help="Number of concurrent LDAP lookups in the 'user' mode. Every worker \
+                      borrows its own connection from the pool, at most 'pool_size' - 1 \
+                      workers are used. Default: 1",
+            )
+        parser.add_argument('-i', '--incremental',
+                action='store_true',
+                help="Only read the LDAP entries changed since the last run (uSNChanged or \
+                      whenChanged). The first run per server is a full pass. \
+                      Enabled by default with LDAP_SYNC_INCREMENTAL = True.",
+            )
+        parser.add_argument('-f', '--full',
+                action='store_true',
+                help="Force a complete pass, even if incremental syncs are enabled.",
+            )
+        parser.add_argument('-s', '--shard',
+                metavar='K/N',
+                help="Only sync the users of shard K of N (by a stable hash of the \
+                      username), e.g. 1/3 on the first of three hosts. A lease in the \
+                      database prevents overlapping runs of the same shard.",
+            )
+        parser.add_argument('--lease-seconds',
+                default=DEFAULT_LEASE_SECONDS,
+                dest='lease_seconds',
+                type=int,
+                help="Lifetime of the shard lease, it is renewed while the run is alive. \
+                      Default: {}".format(DEFAULT_LEASE_SECONDS),
+            )
+        parser.add_argument('--max-duration',
+                dest='max_duration',
+                metavar='seconds',
+                type=float,
+                help="Stop the 'user' mode after this many seconds and store a checkpoint, \
+                      the next run resumes the pass behind the last processed user. \
+                      Implies --resume.",
+            )
+        parser.add_argument('--resume',
+                action='store_true',
+                help="Store the position of the 'user' mode in the database and resume \
+                      an interrupted pass. Checkpointed passes never use --incremental.",
+            )
+        parser.add_argument('--order',
+                default=ORDER_PK,
+                choices=ORDERS,
+                help="Order of the users in the 'user' mode, '{}' syncs the users who \
+                      logged in last first. Default: \"{}\"".format(ORDER_RECENT_LOGIN_FIRST, ORDER_PK),
+            )
+        parser.add_argument('--inactive-days',
+                dest='inactive_days',
+                metavar='days',
+                type=int,
+                help="Users without login for this many days (or never) are only synced \
+                      every --inactive-every passes. Implies --resume.",
+            )
+        parser.add_argument('--inactive-every',
+                default=DEFAULT_INACTIVE_EVERY,
+                dest='inactive_every',
+                metavar='passes',
+                type=int,
+                help="Every how many passes inactive users are synced. Default: {}".format(DEFAULT_INACTIVE_EVERY),
+            )
+        parser.add_argument('--stale-after',
+                dest='stale_after',
+                metavar='seconds',
+                type=int,
+                help="Only sync users not synced for this many seconds (or never), in \
+                      the 'user' and 'batch' modes. Requires LDAP_SYNC_FINGERPRINTS.",
+            )
+        parser.add_argument('--ignore-fingerprints',
+                action='store_true',
+                dest='ignore_fingerprints',
+                help="Compare all fields even if the LDAP attributes match the stored \
+                      fingerprint, e.g. after the mapped fields were changed in Django.",
+            )
 
     def handle(self, *args, **options):
         verbosity = options.get('verbosity')
@@ -40,45 +170,521 @@ class Command(BaseCommand):
         else:
             exclude_usernames = set()
 
+        shard = options.get('shard')
+        if shard:
+            try:
+                shard_index, shard_count = parse_shard(shard)
+            except ValueError as error:
+                raise CommandError(error)
+            shard = options['shard'] = '%d/%d' % (shard_index, shard_count)
+
         User = get_user_model()
+        fingerprints = get_config().fingerprints
+        if options.get('stale_after') is not None:
+            if not fingerprints:
+                raise CommandError("--stale-after requires LDAP_SYNC_FINGERPRINTS = True")
+            if options.get('mode') not in (self.MODE_USER, self.MODE_BATCH):
+                raise CommandError("--stale-after requires the 'user' or 'batch' mode")
+        if options.get('max_duration') or options.get('inactive_days'):
+            options['resume'] = True
+        if options.get('resume') or options.get('order', ORDER_PK) != ORDER_PK:
+            if options.get('mode') != self.MODE_USER:
+                raise CommandError("--max-duration, --resume, --order and --inactive-days require the 'user' mode")
+            uses_login = options.get('order') == ORDER_RECENT_LOGIN_FIRST or options.get('inactive_days')
+            if uses_login and 'last_login' not in {field.name for field in User._meta.get_fields()}:
+                raise CommandError("%s has no last_login field" % User.__name__)
+        deadline = None
+        if options.get('max_duration'):
+            deadline = time.monotonic() + options['max_duration']
+
         ldap = Ldap()
         if not ldap.connection:
             self.stderr.write("No LDAP-Connection, Abort")
             return
+        # `ldap` holds one pooled connection for the whole run, every worker
+        # needs another one without waiting for it
+        max_workers = max(1, ldap.pool.size - 1)
+        if options.get('workers', 1) > max_workers:
+            if verbosity > 0:
+                self.stderr.write("--workers limited to %d by the pool size of %d" % (max_workers, ldap.pool.size))
+            options['workers'] = max_workers
 
         values = list(ldap.LDAP_SYNC_USER_ATTRIBUTES.keys())
         values.append(User.USERNAME_FIELD)
         if sync_is_active:
             values.append('is_active')
+        if fingerprints:
+            # Joined, the stored fingerprint is compared instead of the fields
+            values.append(FINGERPRINT_FIELD)
 
-        for user_dict in User.objects.all().values(*values).iterator():
-            username = user_dict[User.USERNAME_FIELD]
+        def is_excluded(username):
+            self.check_lease()
+            if shard and shard_of(username, shard_count) != shard_index:
+                return True
+            return username in exclude_usernames or bool(exclude_regex and exclude_regex.match(username))
 
-            if username in exclude_usernames:
-                if verbosity > 2:
-                    self.stdout.write('Ignoring {}'.format(username))
-                continue
+        def iter_user_dicts(*extra_values):
+            for user_dict in self.get_users(options).values(*values, *extra_values).iterator():
+                username = user_dict[User.USERNAME_FIELD]
 
-            if exclude_regex and exclude_regex.match(username):
-                if verbosity > 2:
-                    self.stdout.write('Ignoring {}'.format(username))
-                continue
+                if is_excluded(username):
+                    if verbosity > 2:
+                        self.stdout.write('Ignoring {}'.format(username))
+                    continue
+
+                yield user_dict
+
+        lease = None
+        if shard:
+            lease = ShardLease(shard, options.get('lease_seconds') or DEFAULT_LEASE_SECONDS)
+            try:
+                lease.acquire()
+            except LeaseUnavailable as error:
+                self.stderr.write(str(error))
+                return
+        self.lease = lease
+
+        run_stats = RunStats()
+        user_count = 0
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(run_stats):
+                user_count = self.sync(ldap, iter_user_dicts, is_excluded, values, sync_is_active, verbosity, options, run_stats, deadline)
+        except LeaseLost as error:
+            # The shard belongs to another run now, its state is not touched
+            lease.release(user_count, time.perf_counter() - start, failed=True)
+            raise CommandError(error)
+        except BaseException:
+            if lease:
+                lease.release(user_count, time.perf_counter() - start, failed=True)
+            raise
+        finally:
+            self.lease = None
+        if lease:
+            lease.release(user_count, time.perf_counter() - start)
+        if verbosity > 0:
+            for line in run_stats.summary(user_count):
+                self.stdout.write(line)
+            if shard:
+                finished, users, rate = shard_summary(shard_count)
+                self.stdout.write('Shards: %d of %d finished, %d users, %.1f users/s combined' % (finished, shard_count, users, rate))
+
+    def sync(self, ldap, iter_user_dicts, is_excluded, values, sync_is_active, verbosity, options, run_stats, deadline=None):
+        ''' Runs the sync in the selected mode, returns the number of processed users '''
+
+        User = get_user_model()
+        if options.get('resume'):
+            # A pass may span several runs, a high-water mark of one of them
+            # would miss the changes made before it to users processed earlier
+            with run_stats.phase('sync'):
+                return self.sync_checkpointed(ldap, values, is_excluded, sync_is_active, verbosity, options, deadline)
+
+        # Read the high-water mark before searching, so changes made during
+        # this run are picked up again by the next one
+        with run_stats.phase('state'):
+            server_state = ldap.get_server_state()
+            # Every shard has its own high-water mark
+            state_key = server_state['server']
+            if options.get('shard'):
+                state_key = '%s#%s' % (state_key, options['shard'])
+            incremental = options.get('incremental') or get_config().incremental
+            previous_state = None
+            if incremental and not options.get('full'):
+                previous_state = SyncState.objects.filter(server=state_key).first()
+
+        if previous_state and (previous_state.highest_usn is not None or previous_state.when_changed):
+            if previous_state.highest_usn is not None and server_state['highest_usn'] is not None:
+                changed_since = {'changed_since_usn': previous_state.highest_usn}
+            else:
+                when_changed = previous_state.when_changed
+                if timezone.is_naive(when_changed):
+                    when_changed = timezone.make_aware(when_changed)
+                changed_since = {'changed_since': when_changed}
+            if verbosity > 1:
+                self.stdout.write('Incremental sync of %s since %s' % (server_state['server'], list(changed_since.values())[0]))
+            with run_stats.phase('search'):
+                ldap_users = self.search_users(ldap, **changed_since)
+            with run_stats.phase('update'):
+                user_count = self.sync_bulk(ldap, list(iter_user_dicts('pk')), ldap_users, sync_is_active, verbosity, options, deactivate=False)
+        elif options.get('mode') == self.MODE_MERGE:
+            with run_stats.phase('sync'):
+                user_count = self.sync_merge(ldap, values, is_excluded, sync_is_active, verbosity, options)
+        elif options.get('mode') == self.MODE_USER:
+            with run_stats.phase('sync'):
+                user_dicts = order_users(self.get_users(options), options.get('order', ORDER_PK)).values(*values, 'pk').iterator()
+                user_count = self.sync_per_user(
+                    ldap, user_dicts, is_excluded, sync_is_active, verbosity, options.get('workers'),
+                    fingerprints=self.get_fingerprint_tracker(options),
+                )
+        else:
+            with run_stats.phase('read'):
+                user_dicts = list(iter_user_dicts('pk'))
+            with run_stats.phase('search'):
+                if options.get('mode') == self.MODE_SCAN:
+                    ldap_users = self.search_users(ldap)
+                else:
+                    usernames = [user_dict[User.USERNAME_FIELD] for user_dict in user_dicts]
+                    ldap_users = self.search_users(ldap, usernames, batch_size=options.get('batch_size'))
+            with run_stats.phase('update'):
+                user_count = self.sync_bulk(ldap, user_dicts, ldap_users, sync_is_active, verbosity, options)
+
+        # Store the new high-water mark, without USN `whenChanged` is used
+        # (one minute earlier to tolerate replication and clock skew)
+        with run_stats.phase('state'):
+            self.check_lease()
+            when_changed = server_state['current_time'] or timezone.now()
+            if not settings.USE_TZ:
+                when_changed = timezone.make_naive(when_changed)
+            SyncState.objects.update_or_create(server=state_key, defaults={
+                'highest_usn': server_state['highest_usn'],
+                'when_changed': when_changed - datetime.timedelta(minutes=1),
+            })
+        return user_count
+
+    def check_lease(self):
+        ''' Raises `LeaseLost` if the run lost the lease of its shard, call it before writing '''
+
+        if self.lease is not None:
+            self.lease.check()
+
+    def get_users(self, options):
+        ''' Returns the users to sync, without the ones synced within `--stale-after` seconds '''
+
+        queryset = get_user_model().objects.all()
+        if options.get('stale_after') is not None:
+            queryset = queryset.filter(stale_users(options['stale_after']))
+        return queryset
+
+    def get_fingerprint_tracker(self, options, **kwargs):
+        ''' Returns a `FingerprintTracker`, or `None` without LDAP_SYNC_FINGERPRINTS '''
+
+        if not get_config().fingerprints:
+            return None
+        return FingerprintTracker(
+            skip=not options.get('ignore_fingerprints'),
+            batch_size=options.get('batch_size') or self.DEFAULT_BATCH_SIZE,
+            **kwargs
+        )
+
+    def get_changes(self, user_dict, attrs, sync_is_active, fingerprints=None):
+        ''' Returns the attributes to update, or `None` if the user is unchanged
+
+        With a `FingerprintTracker` users whose attributes match their stored
+        fingerprint are not compared field by field.
+        '''
+
+        if sync_is_active:
+            if attrs:
+                attrs['is_active'] = True
+            else:
+                attrs['is_active'] = False
+
+        if fingerprints is not None and fingerprints.matches(user_dict, attrs):
+            return None
+        for attr in attrs:
+            if user_dict[attr] != attrs[attr]:
+                return attrs
+        return None
+
+    def lookup_user(self, ldap, username):
+        ''' Returns the Django-Attributes of a user, `{}` if the user is not in LDAP
+
+        Raises `CommandError` if the lookup failed (server unreachable, no
+        pooled connection in time), the user must not be treated as missing
+        (and deactivated).
+        '''
+
+        try:
+            return ldap.get_django_attributes_for_user(username, refresh=True, required=True)
+        except LDAPException as error:
+            raise CommandError("LDAP lookup of %s failed, abort: %s" % (username, error))
+
+    def search_users(self, ldap, usernames=None, **kwargs):
+        ''' Returns the Django-Attributes of many users (see `Ldap.get_django_attributes_for_users()`)
+
+        Raises `CommandError` if the search failed or is incomplete (e.g. an
+        error result of a page), users missing in the result must not be
+        deactivated.
+        '''
 
-            attrs = ldap.get_django_attributes_for_user(username)
-            if sync_is_active:
-                if attrs:
-                    attrs['is_active'] = True
+        try:
+            return ldap.get_django_attributes_for_users(usernames, **kwargs)
+        except LDAPException as error:
+            raise CommandError("LDAP search failed, abort: %s" % error)
+
+    def lookup_per_user(self, ldap, user_dicts, is_excluded, workers=1):
+        ''' Yields `(user_dict, attrs)` in the order of `user_dicts`, `attrs` is `None` for excluded users
+
+        With more than one worker up to `2 * workers` lookups are in flight,
+        every worker thread uses its own `Ldap` instance.
+        '''
+
+        User = get_user_model()
+        if workers <= 1:
+            for user_dict in user_dicts:
+                username = user_dict[User.USERNAME_FIELD]
+                if is_excluded(username):
+                    yield user_dict, None
                 else:
-                    attrs['is_active'] = False
+                    yield user_dict, self.lookup_user(ldap, username)
+            return
+
+        local = threading.local()
+
+        def lookup(username):
+            if not hasattr(local, 'ldap'):
+                local.ldap = Ldap()
+            return self.lookup_user(local.ldap, username)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ldap_sync') as executor:
+            pending = deque()
+            for user_dict in user_dicts:
+                username = user_dict[User.USERNAME_FIELD]
+                future = None if is_excluded(username) else executor.submit(lookup, username)
+                pending.append((user_dict, future))
+                while len(pending) > 2 * workers or (pending and pending[0][1] is None):
+                    user_dict, future = pending.popleft()
+                    yield user_dict, future.result() if future else None
+            while pending:
+                user_dict, future = pending.popleft()
+                yield user_dict, future.result() if future else None
+
+    def sync_checkpointed(self, ldap, values, is_excluded, sync_is_active, verbosity, options, deadline=None):
+        ''' Runs or resumes a pass of the 'user' mode until it is complete or `deadline` is reached '''
+
+        order = options.get('order', ORDER_PK)
+        name = '%s#%s' % (order, options['shard']) if options.get('shard') else order
+        checkpoint = Checkpoint(name, order, save_every=options.get('batch_size') or self.DEFAULT_BATCH_SIZE)
+
+        queryset = checkpoint.filter(self.get_users(options))
+        inactive_days = options.get('inactive_days')
+        if inactive_days and not checkpoint.sweeps_inactive(options.get('inactive_every') or 1):
+            queryset = queryset.exclude(inactive_users(timezone.now() - datetime.timedelta(days=inactive_days)))
+        extra_values = ['pk']
+        if order == ORDER_RECENT_LOGIN_FIRST:
+            extra_values.append('last_login')
+        if verbosity > 1 and checkpoint.resuming:
+            self.stdout.write('Resuming pass %d behind user %s' % (checkpoint.record.pass_number, checkpoint.record.last_pk))
+
+        stopped = []
+
+        def until_deadline(user_dicts):
+            for user_dict in user_dicts:
+                if deadline is not None and time.monotonic() >= deadline:
+                    stopped.append(True)
+                    return
+                yield user_dict
 
-            changed = False
-            for attr in attrs:
-                if user_dict[attr] != attrs[attr]:
-                    changed = True
-                    break
+        user_dicts = until_deadline(queryset.values(*values, *extra_values).iterator())
+        user_count = self.sync_per_user(
+            ldap, user_dicts, is_excluded, sync_is_active, verbosity, options.get('workers'), checkpoint,
+            fingerprints=self.get_fingerprint_tracker(options),
+        )
+        record = checkpoint.record
+        self.check_lease()
+        if stopped:
+            checkpoint.save()
+            if verbosity > 0:
+                self.stdout.write('Time is up, pass %d stopped after %d users (%d changed), the next run resumes behind user %s' % (
+                    record.pass_number, record.processed, record.changed, record.last_pk))
+        else:
+            if verbosity > 0:
+                self.stdout.write('Pass %d finished: %d users, %d changed' % (record.pass_number, record.processed, record.changed))
+            checkpoint.finish()
+        return user_count
+
+    def sync_per_user(self, ldap, user_dicts, is_excluded, sync_is_active, verbosity, workers=1, checkpoint=None,
+                      fingerprints=None):
+        ''' Searches and updates every user on its own, the database is only written by this thread
 
-            if changed:
+        The position of every user is passed on to `checkpoint`, `user_dicts`
+        must then contain `pk` (and `last_login` if ordered by it). The
+        fingerprints are written every `batch_size` users.
+        '''
+
+        User = get_user_model()
+        user_count = 0
+        for user_dict, attrs in self.lookup_per_user(ldap, user_dicts, is_excluded, workers):
+            username = user_dict[User.USERNAME_FIELD]
+            if attrs is None:
+                if verbosity > 2:
+                    self.stdout.write('Ignoring {}'.format(username))
+                if checkpoint is not None:
+                    checkpoint.advance(user_dict['pk'], user_dict.get('last_login'), processed=False)
+                continue
+            user_count += 1
+
+            attrs = self.get_changes(user_dict, attrs, sync_is_active, fingerprints)
+            self.check_lease()
+            if attrs:
                 filter_args = {User.USERNAME_FIELD: username}
                 if verbosity > 1:
                     self.stdout.write('Updating %s: %s' %(username, attrs))
                 User.objects.filter(**filter_args).update(**attrs)
+            if checkpoint is not None:
+                checkpoint.advance(user_dict['pk'], user_dict.get('last_login'), changed=bool(attrs))
+            if fingerprints is not None and len(fingerprints) >= fingerprints.batch_size:
+                fingerprints.save()
+        if fingerprints is not None:
+            self.check_lease()
+            fingerprints.save()
+            self.write_skipped(fingerprints, verbosity)
+        return user_count
+
+    def write_skipped(self, fingerprints, verbosity):
+        if verbosity > 1 and fingerprints.skipped:
+            self.stdout.write('Skipped %d users with unchanged fingerprint' % fingerprints.skipped)
+
+    def sync_bulk(self, ldap, user_dicts, ldap_users, sync_is_active, verbosity, options, deactivate=True):
+        ''' Joins the users read from LDAP with the database in memory
+
+        Without `deactivate` only the users contained in `ldap_users` are
+        processed (incremental sync). Returns the number of processed users.
+        '''
+
+        User = get_user_model()
+        pairs = (
+            (user_dict, ldap_users.get(AttributeCache.normalize(user_dict[User.USERNAME_FIELD])))
+            for user_dict in user_dicts
+        )
+        return self.apply_changes(ldap, pairs, sync_is_active, verbosity, options, deactivate=deactivate)
+
+    def sync_merge(self, ldap, values, is_excluded, sync_is_active, verbosity, options):
+        ''' Streams database and LDAP users ordered by username and merge-joins them
+
+        The database is read with `order_by()` and the directory with server
+        side sorting. If the server refuses to sort, or an order does not match
+        the normalized usernames (e.g. because of the database collation),
+        that side is sorted on the client in chunks of `--sort-chunk-size`
+        spooled to temporary files. Memory does not depend on the number of
+        users. Returns the number of processed users.
+        '''
+
+        sort_ldap = sort_db = False
+        while True:
+            try:
+                return self.merge_users(ldap, values, is_excluded, sync_is_active, verbosity, options, sort_db, sort_ldap)
+            except LDAPException as error:
+                # Raised while reading, before any change was written
+                raise CommandError("LDAP search failed, abort: %s" % error)
+            except LdapSortUnavailable as error:
+                sort_ldap = True
+                reason = error
+            except UnsortedInput as error:
+                if error.side == 'ldap' and not sort_ldap:
+                    sort_ldap = True
+                elif error.side == 'database' and not sort_db:
+                    sort_db = True
+                else:
+                    raise
+                reason = error
+            # Changes are only written after both streams were read, the
+            # failed pass wrote nothing
+            if verbosity > 1:
+                self.stdout.write('Sorting on the client: %s' % reason)
+
+    def merge_users(self, ldap, values, is_excluded, sync_is_active, verbosity, options, sort_db=False, sort_ldap=False):
+        ''' One pass of `sync_merge()` '''
+
+        User = get_user_model()
+        chunk_size = options.get('sort_chunk_size') or DEFAULT_SORT_CHUNK_SIZE
+        columns = ['pk'] + list(values)
+        username_index = columns.index(User.USERNAME_FIELD)
+
+        def rows():
+            queryset = User.objects.values_list(*columns).order_by(User.USERNAME_FIELD)
+            for row in queryset.iterator(chunk_size=options.get('batch_size')):
+                if is_excluded(row[username_index]):
+                    if verbosity > 2:
+                        self.stdout.write('Ignoring {}'.format(row[username_index]))
+                    continue
+                yield row
+
+        db_records = iter_db_records(rows(), username_index)
+        if sort_db:
+            db_records = external_sort(db_records, chunk_size)
+        else:
+            db_records = verify_sorted(db_records, 'database')
+        if sort_ldap:
+            ldap_records = external_sort(iter_ldap_records(ldap, ldap.iter_users()), chunk_size)
+        else:
+            ldap_records = verify_sorted(iter_ldap_records(ldap, ldap.iter_users(sort=True)), 'ldap')
+
+        pairs = (
+            (dict(zip(columns, db_record.row)), dict(ldap_record.attrs) if ldap_record else None)
+            for db_record, ldap_record in merge_join(db_records, ldap_records)
+        )
+        # The changes are written after both streams are read, so the
+        # database cursor is not modified while it is iterated
+        changed_users = Spool()
+        missing_usernames = Spool()
+        fingerprints = self.get_fingerprint_tracker(options, changed=Spool(), unchanged=Spool())
+        try:
+            return self.apply_changes(
+                ldap, pairs, sync_is_active, verbosity, options,
+                changed_users=changed_users, missing_usernames=missing_usernames, fingerprints=fingerprints,
+            )
+        finally:
+            changed_users.close()
+            missing_usernames.close()
+            if fingerprints is not None:
+                fingerprints.changed.close()
+                fingerprints.unchanged.close()
+
+    def apply_changes(self, ldap, pairs, sync_is_active, verbosity, options, deactivate=True,
+                      changed_users=None, missing_usernames=None, fingerprints=None):
+        ''' Writes the changes of `(user_dict, attrs)` pairs, `attrs` is `None` for users not found in LDAP
+
+        Changes are collected in `changed_users` and `missing_usernames`
+        (lists by default) and written after all pairs are processed, with
+        `bulk_update` and deactivations in batches of `batch_size`, followed
+        by the fingerprints. Without `deactivate` users not found in LDAP are
+        skipped. Returns the number of processed users.
+        '''
+
+        User = get_user_model()
+        batch_size = options.get('batch_size')
+        update_fields = list(ldap.LDAP_SYNC_USER_ATTRIBUTES.keys())
+        if sync_is_active:
+            update_fields.append('is_active')
+
+        if changed_users is None:
+            changed_users = []
+        if missing_usernames is None:
+            missing_usernames = []
+        if fingerprints is None:
+            fingerprints = self.get_fingerprint_tracker(options)
+        user_count = 0
+        for user_dict, attrs in pairs:
+            username = user_dict[User.USERNAME_FIELD]
+            if attrs is None:
+                if not deactivate:
+                    continue
+                attrs = {}
+            user_count += 1
+            attrs = self.get_changes(user_dict, dict(attrs), sync_is_active, fingerprints)
+            if not attrs:
+                continue
+            if verbosity > 1:
+                self.stdout.write('Updating %s: %s' %(username, attrs))
+            if len(attrs) == 1 and attrs.get('is_active') is False:
+                missing_usernames.append(username)
+                continue
+
+            fields = {field: user_dict[field] for field in update_fields}
+            fields.update(attrs)
+            changed_users.append((user_dict['pk'], fields))
+
+        # Apply changes without triggering `pre_save`
+        for batch in chunked(changed_users, batch_size):
+            self.check_lease()
+            User.objects.bulk_update([User(pk=pk, **fields) for pk, fields in batch], update_fields, batch_size=batch_size)
+        for batch in chunked(missing_usernames, batch_size):
+            self.check_lease()
+            filter_args = {User.USERNAME_FIELD + '__in': batch}
+            User.objects.filter(**filter_args).update(is_active=False)
+        if fingerprints is not None:
+            self.check_lease()
+            fingerprints.save()
+            self.write_skipped(fingerprints, verbosity)
+        return user_count
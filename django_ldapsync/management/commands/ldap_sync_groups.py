@@ -0,0 +1,162 @@
+from django.contrib.auth.models import Group
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django_ldapsync import Ldap
+from django_ldapsync.cache import AttributeCache
+from django_ldapsync.conf import GROUP_STRATEGY_GRAPH, GROUP_STRATEGY_IN_CHAIN
+from django_ldapsync.groups import membership_diff
+from django_ldapsync.ldap import chunked
+from django_ldapsync.stats import RunStats
+from ldap3.core.exceptions import LDAPException
+
+class Command(BaseCommand):
+    DEFAULT_BATCH_SIZE = 500
+    help = "Reconciles the members of Django groups with LDAP groups, memberships are added and removed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('groups',
+                metavar='group',
+                nargs='*',
+                help="CommonNames of the LDAP groups, the Django groups have the same name.",
+            )
+        parser.add_argument('-p', '--pattern',
+                action='append',
+                dest='patterns',
+                default=[],
+                help="Also reconcile all LDAP groups whose CommonName matches this pattern, \
+                      '*' is a wildcard (e.g. 'app-*'). May be given several times.",
+            )
+        parser.add_argument('--strategy',
+                default=GROUP_STRATEGY_GRAPH,
+                choices=[GROUP_STRATEGY_GRAPH, GROUP_STRATEGY_IN_CHAIN],
+                help="'graph' reads all groups and their members with one set of paged \
+                      searches, 'in_chain' lets the server resolve nested groups with one \
+                      search per group. Default: \"{}\"".format(GROUP_STRATEGY_GRAPH),
+            )
+        parser.add_argument('-n', '--dry-run',
+                action='store_true',
+                dest='dry_run',
+                help="Only print the number of memberships to add and remove.",
+            )
+        parser.add_argument('-b', '--batch-size',
+                default=self.DEFAULT_BATCH_SIZE,
+                dest='batch_size',
+                type=int,
+                help="Number of rows per bulk insert and delete. Default: {}".format(self.DEFAULT_BATCH_SIZE),
+            )
+
+    def handle(self, *args, **options):
+        verbosity = options.get('verbosity')
+        batch_size = options.get('batch_size')
+        if not options.get('groups') and not options.get('patterns'):
+            raise CommandError("Give at least one group or --pattern")
+
+        ldap = Ldap()
+        if not ldap.connection:
+            self.stderr.write("No LDAP-Connection, Abort")
+            return
+
+        run_stats = RunStats()
+        with run_stats.phase('search'):
+            try:
+                group_dns = self.get_group_dns(ldap, options.get('groups'), options.get('patterns'))
+                members = ldap.get_members_of_groups(
+                    list(group_dns.values()), attributes=[ldap.get_username_key()], strategy=options.get('strategy'),
+                )
+            except LDAPException as error:
+                # An incomplete member list would remove the missing members
+                raise CommandError("LDAP search failed, nothing changed: %s" % error)
+
+        with connection.execute_wrapper(run_stats):
+            with run_stats.phase('read'):
+                desired, unknown = self.get_desired_members(ldap, group_dns, members)
+                current = self.get_current_members(group_dns)
+                diff = membership_diff(desired, current)
+
+            added_count = sum(len(added) for added, _ in diff.values())
+            removed_count = sum(len(removed) for _, removed in diff.values())
+            if verbosity > 1:
+                for name, (added, removed) in sorted(diff.items()):
+                    self.stdout.write('%s: +%d -%d' % (name, len(added), len(removed)))
+            self.stdout.write(
+                "%d groups, %d memberships to add, %d to remove, %d members without Django user" % (
+                    len(group_dns), added_count, removed_count, len(unknown))
+            )
+            if options.get('dry_run'):
+                self.stdout.write("Dry run, nothing changed")
+                return
+
+            with run_stats.phase('update'), transaction.atomic():
+                self.apply_diff(diff, batch_size)
+
+        if verbosity > 0:
+            for line in run_stats.summary(sum(len(user_ids) for user_ids in desired.values())):
+                self.stdout.write(line)
+
+    def get_group_dns(self, ldap, names, patterns):
+        ''' Returns the DNs of the named groups and the groups matching a pattern by name '''
+
+        group_dns = {}
+        for name, dn in ldap.get_dns(names, object_class='group').items():
+            if dn:
+                group_dns[name] = dn
+            else:
+                # Never reconcile against an empty member list of an unknown group
+                self.stderr.write("Group '%s' not found in LDAP, skipped" % name)
+        for pattern in patterns:
+            group_dns.update(ldap.find_groups(pattern))
+        return group_dns
+
+    def get_desired_members(self, ldap, group_dns, members):
+        ''' Returns the user ids of the LDAP members by group name, and the usernames without Django user '''
+
+        User = get_user_model()
+        user_ids = {
+            AttributeCache.normalize(username): pk
+            for username, pk in User.objects.values_list(User.USERNAME_FIELD, 'pk').iterator()
+        }
+        desired = {}
+        unknown = set()
+        for name, dn in group_dns.items():
+            desired[name] = set()
+            for member in members.get(dn, ()):
+                username = ldap.to_django_attributes(member).get('username')
+                if not username:
+                    continue
+                user_id = user_ids.get(AttributeCache.normalize(username))
+                if user_id is None:
+                    unknown.add(username)
+                else:
+                    desired[name].add(user_id)
+        return desired, unknown
+
+    def get_current_members(self, group_dns):
+        ''' Returns the user ids of the existing Django groups by name '''
+
+        Membership = get_user_model().groups.through
+        current = {}
+        rows = Membership.objects.filter(group__name__in=list(group_dns)).values_list('group__name', 'user_id')
+        for name, user_id in rows.iterator():
+            current.setdefault(name, set()).add(user_id)
+        return current
+
+    def apply_diff(self, diff, batch_size):
+        ''' Creates missing Django groups and writes the memberships on the through table '''
+
+        Membership = get_user_model().groups.through
+        group_ids = dict(Group.objects.filter(name__in=list(diff)).values_list('name', 'pk'))
+        missing_groups = [Group(name=name) for name in diff if name not in group_ids]
+        if missing_groups:
+            Group.objects.bulk_create(missing_groups, batch_size=batch_size)
+            group_ids.update(Group.objects.filter(name__in=[group.name for group in missing_groups]).values_list('name', 'pk'))
+
+        new_memberships = (
+            Membership(group_id=group_ids[name], user_id=user_id)
+            for name, (added, _) in diff.items() for user_id in added
+        )
+        for batch in chunked(new_memberships, batch_size):
+            Membership.objects.bulk_create(batch, ignore_conflicts=True)
+        for name, (_, removed) in diff.items():
+            for batch in chunked(sorted(removed), batch_size):
+                Membership.objects.filter(group_id=group_ids[name], user_id__in=batch).delete()
@@ -0,0 +1,167 @@
+import heapq
+import pickle
+import tempfile
+from operator import attrgetter
+
+from .cache import AttributeCache
+from .ldap import chunked
+
+DEFAULT_SORT_CHUNK_SIZE = 50000
+
+# Records per pickle in the spool files
+_SPOOL_BATCH_SIZE = 1000
+
+_key = attrgetter('key')
+
+
+class UnsortedInput(Exception):
+    ''' Raised when a stream expected in key order is not, `side` names the stream '''
+
+    def __init__(self, side, key, previous):
+        super().__init__("%s stream not sorted: %r after %r" % (side, key, previous))
+        self.side = side
+
+
+class DbRecord(object):
+    ''' Row of the user table, `row` holds the selected values in query order '''
+
+    __slots__ = ('key', 'row')
+
+    def __init__(self, key, row):
+        self.key = key
+        self.row = row
+
+    def __getstate__(self):
+        return (self.key, self.row)
+
+    def __setstate__(self, state):
+        self.key, self.row = state
+
+
+class LdapRecord(object):
+    ''' Mapped Django-Attributes of an LDAP user as `(field, value)` pairs '''
+
+    __slots__ = ('key', 'attrs')
+
+    def __init__(self, key, attrs):
+        self.key = key
+        self.attrs = attrs
+
+    def __getstate__(self):
+        return (self.key, self.attrs)
+
+    def __setstate__(self, state):
+        self.key, self.attrs = state
+
+
+def iter_db_records(rows, username_index):
+    ''' Wraps rows of `values_list()`, the key is the normalized username '''
+
+    for row in rows:
+        yield DbRecord(AttributeCache.normalize(row[username_index]), row)
+
+
+def iter_ldap_records(ldap, ldap_users):
+    ''' Wraps the entries of `Ldap.iter_users()`, the key is the normalized `sAMAccountName` '''
+
+    for ldap_user in ldap_users:
+        account_name = ldap_user.get('sAMAccountName')
+        if isinstance(account_name, list):
+            account_name = account_name[0] if account_name else None
+        if account_name:
+            attrs = tuple(ldap.to_django_attributes(ldap_user).items())
+            yield LdapRecord(AttributeCache.normalize(account_name), attrs)
+
+
+def verify_sorted(records, side):
+    ''' Passes the records through, raises `UnsortedInput` as soon as a key is out of order '''
+
+    previous = None
+    for record in records:
+        if previous is not None and record.key < previous:
+            raise UnsortedInput(side, record.key, previous)
+        previous = record.key
+        yield record
+
+
+def external_sort(records, chunk_size=DEFAULT_SORT_CHUNK_SIZE):
+    ''' Yields the records ordered by key with at most `chunk_size` records in memory
+
+    Inputs larger than one chunk are sorted in chunks, spooled to temporary
+    files and merged.
+    '''
+
+    spools = []
+    try:
+        for chunk in chunked(records, chunk_size):
+            chunk.sort(key=_key)
+            if not spools and len(chunk) < chunk_size:
+                # Everything fits into memory
+                yield from chunk
+                return
+            spool = Spool()
+            for record in chunk:
+                spool.append(record)
+            spools.append(spool)
+            del chunk
+        yield from heapq.merge(*spools, key=_key)
+    finally:
+        for spool in spools:
+            spool.close()
+
+
+def merge_join(db_records, ldap_records):
+    ''' Yields `(db_record, ldap_record)` for every database record, `ldap_record` is `None` if it is missing
+
+    Both streams must be ordered by key. LDAP users without a database row
+    are skipped, several rows with the same key match the same LDAP record.
+    Records behind the last LDAP record are only yielded as missing once
+    `ldap_records` is exhausted; an error of it (e.g. an incomplete search)
+    propagates.
+    '''
+
+    ldap_records = iter(ldap_records)
+    ldap_record = next(ldap_records, None)
+    for db_record in db_records:
+        while ldap_record is not None and ldap_record.key < db_record.key:
+            ldap_record = next(ldap_records, None)
+        if ldap_record is not None and ldap_record.key == db_record.key:
+            yield db_record, ldap_record
+        else:
+            yield db_record, None
+
+
+class Spool(object):
+    ''' Append-only sequence of picklable items in a temporary file '''
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._batch = []
+        self.count = 0
+
+    def append(self, item):
+        self._batch.append(item)
+        self.count += 1
+        if len(self._batch) >= _SPOOL_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            pickle.dump(self._batch, self._file, pickle.HIGHEST_PROTOCOL)
+            self._batch = []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self._flush()
+        self._file.seek(0)
+        while True:
+            try:
+                batch = pickle.load(self._file)
+            except EOFError:
+                return
+            yield from batch
+
+    def close(self):
+        self._file.close()
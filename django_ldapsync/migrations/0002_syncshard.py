@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_ldapsync', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(max_length=32, unique=True)),
+                ('owner', models.CharField(blank=True, max_length=255)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('users', models.IntegerField(default=0)),
+                ('seconds', models.FloatField(default=0)),
+                ('failed', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
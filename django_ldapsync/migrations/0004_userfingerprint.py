@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_ldapsync', '0003_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFingerprint',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ldap_fingerprint', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('synced', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
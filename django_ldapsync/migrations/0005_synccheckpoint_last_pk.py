@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_ldapsync', '0004_userfingerprint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='synccheckpoint',
+            name='last_pk',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.db import models
+
+class SyncState(models.Model):
+    ''' High-water mark of the last `ldap_sync` run per LDAP server '''
+
+    server = models.CharField(max_length=255, unique=True)
+    highest_usn = models.BigIntegerField(null=True, blank=True)
+    when_changed = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.server
+
+class SyncShard(models.Model):
+    ''' Lease and statistics of the last `ldap_sync --shard` run per shard '''
+
+    shard = models.CharField(max_length=32, unique=True)
+    owner = models.CharField(max_length=255, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    users = models.IntegerField(default=0)
+    seconds = models.FloatField(default=0)
+    failed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.shard
+
+class SyncCheckpoint(models.Model):
+    ''' Position and counters of the current `ldap_sync` pass, to resume an interrupted run '''
+
+    name = models.CharField(max_length=255, unique=True)
+    pass_number = models.IntegerField(default=0)
+    # Any type of primary key, as text (see `Checkpoint.filter()`)
+    last_pk = models.CharField(max_length=255, null=True, blank=True)
+    last_login = models.DateTimeField(null=True, blank=True)
+    processed = models.IntegerField(default=0)
+    changed = models.IntegerField(default=0)
+    pass_started = models.DateTimeField(null=True, blank=True)
+    pass_finished = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+class UserFingerprint(models.Model):
+    ''' Hash of the LDAP attributes last synced to a user and the time they were confirmed '''
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='ldap_fingerprint',
+    )
+    fingerprint = models.CharField(max_length=32)
+    synced = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.fingerprint
@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .cache import AttributeCache
+
+# Context variables are local to a thread and to an asyncio task, threads
+# started inside a block do not see its values (unless the context is copied)
+_prefetched = ContextVar('django_ldapsync_prefetched', default=None)
+_suppressed = ContextVar('django_ldapsync_suppressed', default=False)
+
+
+@contextmanager
+def prefetched_attributes(attributes):
+    ''' Saves within the block use these Django-Attributes instead of asking LDAP
+
+    `attributes` maps usernames to attribute dicts as returned by
+    `Ldap.get_django_attributes_for_user()`; an empty dict marks a user known
+    to be missing in LDAP. Users not in the mapping are looked up as usual,
+    nested blocks add to the outer mapping.
+    '''
+
+    prefetched = dict(_prefetched.get() or {})
+    for username, user_attributes in attributes.items():
+        prefetched[AttributeCache.normalize(username)] = dict(user_attributes)
+    token = _prefetched.set(prefetched)
+    try:
+        yield
+    finally:
+        _prefetched.reset(token)
+
+
+@contextmanager
+def suppress_ldap_lookup():
+    ''' Saves within the block keep the attributes of the user, LDAP is not asked '''
+
+    token = _suppressed.set(True)
+    try:
+        yield
+    finally:
+        _suppressed.reset(token)
+
+
+def get_prefetched_attributes(username):
+    ''' Returns a copy of the prefetched attributes of a user, `None` if there are none '''
+
+    prefetched = _prefetched.get()
+    if prefetched is None:
+        return None
+    attributes = prefetched.get(AttributeCache.normalize(username))
+    return dict(attributes) if attributes is not None else None
+
+
+def is_ldap_lookup_suppressed():
+    return _suppressed.get()
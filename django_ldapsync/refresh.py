@@ -0,0 +1,193 @@
+import logging
+import os
+import queue
+import threading
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+
+from .cache import AttributeCache
+from .conf import get_config
+
+logger = logging.getLogger(__name__)
+
+
+def get_refresh_config():
+    return get_config().background_refresh
+
+
+def refresh_user(username):
+    ''' Reads the attributes of a user from LDAP and writes only the mapped fields
+
+    The update bypasses `pre_save`, returns the number of updated rows. This
+    is the function to call from a task queue worker. With
+    `LDAP_SYNC_FINGERPRINTS` an unchanged user is only marked as synced.
+    '''
+
+    from .apps import remember_refresh
+    from .ldap import Ldap
+
+    User = get_user_model()
+    with Ldap() as ldap:
+        attributes = ldap.get_django_attributes_for_user(username, refresh=True)
+    if not attributes:
+        # Server not reachable or user unknown, keep the current values
+        return 0
+    users = User.objects.filter(**{User.USERNAME_FIELD: username})
+    if get_config().fingerprints:
+        from .fingerprints import FINGERPRINT_FIELD, FingerprintTracker
+
+        fingerprints = FingerprintTracker()
+        updated = 0
+        for user_dict in users.values('pk', FINGERPRINT_FIELD):
+            if not fingerprints.matches(user_dict, attributes):
+                updated += User.objects.filter(pk=user_dict['pk']).update(**attributes)
+        fingerprints.save()
+    else:
+        updated = users.update(**attributes)
+    remember_refresh(username)
+    return updated
+
+
+class RefreshBackend(object):
+    ''' Base class of the background refresh backends, `enqueue()` must not block
+
+    Backends are created with the options of `LDAP_SYNC_BACKGROUND_REFRESH`.
+    A task queue backend only has to hand the username to a task calling
+    `refresh_user()`.
+    '''
+
+    def __init__(self, **options):
+        self.options = options
+
+    def enqueue(self, username):
+        ''' Schedules a refresh, returns `False` if it was dropped or already queued '''
+
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class ImmediateRefreshBackend(RefreshBackend):
+    ''' Refreshes in the calling thread, e.g. for tests '''
+
+    def enqueue(self, username):
+        refresh_user(username)
+        return True
+
+
+class ThreadRefreshBackend(RefreshBackend):
+    ''' Bounded in-process queue worked off by daemon threads
+
+    A username is queued at most once at a time. When the queue is full
+    further refreshes are dropped, the user keeps its current attributes until
+    the next save or `ldap_sync`. Queued refreshes are lost when the process
+    exits.
+    '''
+
+    def __init__(self, max_queue=1000, workers=1, handler=None, **options):
+        super().__init__(**options)
+        self.workers = max(1, int(workers))
+        self.handler = handler or refresh_user
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        # Counters
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def enqueue(self, username):
+        key = AttributeCache.normalize(username)
+        with self._lock:
+            if key in self._pending:
+                self.deduplicated += 1
+                return False
+            try:
+                self._queue.put_nowait(username)
+            except queue.Full:
+                self.dropped += 1
+                logger.warning("Background refresh queue full, dropping refresh of %s", username)
+                return False
+            self._pending.add(key)
+            self.enqueued += 1
+            self._start_workers()
+        return True
+
+    def _start_workers(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='django_ldapsync-refresh', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            username = self._queue.get()
+            # Saves arriving from now on need another refresh
+            with self._lock:
+                self._pending.discard(AttributeCache.normalize(username))
+            try:
+                close_old_connections()
+                self.handler(username)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                logger.exception("Background refresh of %s failed", username)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def join(self):
+        ''' Blocks until all queued refreshes are done '''
+
+        self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'enqueued': self.enqueued,
+                'deduplicated': self.deduplicated,
+                'dropped': self.dropped,
+                'failures': self.failures,
+            }
+
+
+_backend = None
+_backend_key = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def get_refresh_backend():
+    ''' Returns the refresh backend of this process for the current settings '''
+
+    global _backend, _backend_key, _backend_pid
+
+    config = get_refresh_config()
+    options = {key: value for key, value in config.items() if key not in ('enabled', 'backend')}
+    key = (config['backend'], tuple(sorted(options.items())))
+    with _backend_lock:
+        # Worker threads do not survive a fork
+        if _backend is None or _backend_key != key or _backend_pid != os.getpid():
+            _backend = import_string(config['backend'])(**options)
+            _backend_key = key
+            _backend_pid = os.getpid()
+        return _backend
+
+
+def schedule_refresh(username, using=None):
+    ''' Queues a refresh once the current transaction is committed
+
+    Otherwise the save running the transaction could overwrite the refreshed
+    attributes with the old ones.
+    '''
+
+    transaction.on_commit(partial(get_refresh_backend().enqueue, username), using=using)
@@ -0,0 +1,206 @@
+import itertools
+import logging
+import threading
+import time
+import weakref
+
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.uri import parse_uri
+
+from .conf import (
+    DEFAULT_LDAP_SERVER_EJECT_SECONDS, DEFAULT_LDAP_SERVER_MAX_FAILURES, DEFAULT_LDAP_SERVER_PROBE_INTERVAL,
+    DEFAULT_LDAP_SERVER_STRATEGY, SERVER_STRATEGIES, SERVER_STRATEGY_LOWEST_LATENCY, SERVER_STRATEGY_ROUND_ROBIN,
+)
+
+# Weight of a new sample in the moving average of the latency
+LATENCY_SMOOTHING = 0.3
+
+logger = logging.getLogger(__name__)
+
+
+class ServerState(object):
+    ''' Health and counters of one LDAP server '''
+
+    __slots__ = ('uri', 'params', 'latency', 'requests', 'failures', 'consecutive_failures', 'ejected_until')
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.params = parse_uri(uri)
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def is_ejected(self, now):
+        return self.ejected_until > now
+
+
+class ServerSelector(object):
+    ''' Chooses the server for new pooled connections and fails over between servers
+
+    `factory` is called with the parsed URI of a server (see `parse_uri()`)
+    and must return a bound connection. Servers failing `max_failures` times
+    in a row, or answering slower than `slow_threshold` seconds on average,
+    are ejected for `eject_seconds`; a background thread probes all servers
+    every `probe_interval` seconds. With a single server nothing is ejected.
+    '''
+
+    def __init__(self, uris, factory, strategy=DEFAULT_LDAP_SERVER_STRATEGY, probe_interval=DEFAULT_LDAP_SERVER_PROBE_INTERVAL,
+                 max_failures=DEFAULT_LDAP_SERVER_MAX_FAILURES, eject_seconds=DEFAULT_LDAP_SERVER_EJECT_SECONDS, slow_threshold=None):
+        if strategy not in SERVER_STRATEGIES:
+            raise ValueError("Unknown server strategy %r" % strategy)
+        self.servers = [ServerState(uri) for uri in uris]
+        self.factory = factory
+        self.strategy = strategy
+        self.probe_interval = probe_interval
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.slow_threshold = slow_threshold
+
+        self._lock = threading.Lock()
+        self._round_robin = itertools.count()
+        self._connections = weakref.WeakKeyDictionary()
+        self._probe_thread = None
+        self._closed = threading.Event()
+
+    def candidates(self):
+        ''' Returns the servers in the order they should be tried, ejected servers last '''
+
+        self._start_probes()
+        now = time.monotonic()
+        with self._lock:
+            healthy = [server for server in self.servers if not server.is_ejected(now)]
+            ejected = sorted((server for server in self.servers if server.is_ejected(now)), key=lambda server: server.ejected_until)
+            if self.strategy == SERVER_STRATEGY_ROUND_ROBIN and healthy:
+                offset = next(self._round_robin) % len(healthy)
+                healthy = healthy[offset:] + healthy[:offset]
+            elif self.strategy == SERVER_STRATEGY_LOWEST_LATENCY:
+                # Servers without samples are tried first to measure them
+                healthy.sort(key=lambda server: server.latency or 0.0)
+        return healthy + ejected
+
+    def connect(self):
+        ''' Opens a connection to the best server, trying the others if it fails '''
+
+        error = None
+        for server in self.candidates():
+            start = time.monotonic()
+            try:
+                connection = self.factory(server.params)
+            except LDAPException as exc:
+                self._record(server, failed=True)
+                logger.warning("LDAP server %s not available: %s", server.uri, exc)
+                error = exc
+                continue
+            self._record(server, latency=time.monotonic() - start)
+            with self._lock:
+                self._connections[connection] = server
+            return connection
+        raise error
+
+    def server_of(self, connection):
+        with self._lock:
+            return self._connections.get(connection)
+
+    def accepts(self, connection):
+        ''' Whether a pooled connection may be reused, connections to ejected servers are dropped '''
+
+        server = self.server_of(connection)
+        now = time.monotonic()
+        if server is None or not server.is_ejected(now):
+            return True
+        # Keep it if there is no better server
+        return all(other.is_ejected(now) for other in self.servers)
+
+    def record(self, connection, latency=None, failed=False):
+        ''' Records an operation on a pooled connection, `latency` is optional '''
+
+        server = self.server_of(connection)
+        if server is not None:
+            self._record(server, latency, failed)
+
+    def _record(self, server, latency=None, failed=False):
+        with self._lock:
+            server.requests += 1
+            now = time.monotonic()
+            if failed:
+                server.failures += 1
+                server.consecutive_failures += 1
+                if server.consecutive_failures >= self.max_failures:
+                    self._eject(server, now, "failed %d times in a row" % server.consecutive_failures)
+                return
+            server.consecutive_failures = 0
+            if latency is not None:
+                if server.latency is None:
+                    server.latency = latency
+                else:
+                    server.latency += LATENCY_SMOOTHING * (latency - server.latency)
+                if self.slow_threshold is not None and server.latency > self.slow_threshold:
+                    self._eject(server, now, "%.3fs average latency" % server.latency)
+
+    def _eject(self, server, now, reason):
+        if len(self.servers) < 2 or server.is_ejected(now):
+            return
+        server.ejected_until = now + self.eject_seconds
+        logger.warning("Ejecting LDAP server %s for %ss: %s", server.uri, self.eject_seconds, reason)
+
+    def probe(self, server):
+        ''' Opens and binds a connection to measure the server, ejected servers are readmitted on success '''
+
+        start = time.monotonic()
+        try:
+            connection = self.factory(server.params)
+        except LDAPException:
+            self._record(server, failed=True)
+            return False
+        latency = time.monotonic() - start
+        try:
+            connection.unbind()
+        except Exception:
+            pass
+        with self._lock:
+            # A fresh sample decides about readmission
+            server.latency = latency if server.latency is None else server.latency + LATENCY_SMOOTHING * (latency - server.latency)
+            server.consecutive_failures = 0
+            if self.slow_threshold is None or server.latency <= self.slow_threshold:
+                server.ejected_until = 0.0
+        return True
+
+    def _start_probes(self):
+        if not self.probe_interval or len(self.servers) < 2:
+            return
+        with self._lock:
+            if self._probe_thread is not None and self._probe_thread.is_alive():
+                return
+            self._probe_thread = threading.Thread(target=self._probe_loop, name='django_ldapsync-probe', daemon=True)
+            self._probe_thread.start()
+
+    def _probe_loop(self):
+        while not self._closed.wait(self.probe_interval):
+            for server in self.servers:
+                try:
+                    self.probe(server)
+                except Exception:
+                    logger.exception("Probing LDAP server %s failed", server.uri)
+
+    def close(self):
+        ''' Stops the background probes '''
+
+        self._closed.set()
+
+    def stats(self):
+        ''' Returns latency, counters and health of every server '''
+
+        now = time.monotonic()
+        with self._lock:
+            return {
+                server.uri: {
+                    'latency': server.latency,
+                    'requests': server.requests,
+                    'failures': server.failures,
+                    'consecutive_failures': server.consecutive_failures,
+                    'ejected': server.is_ejected(now),
+                }
+                for server in self.servers
+            }
@@ -0,0 +1,140 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .cache import AttributeCache
+from .models import SyncShard
+
+DEFAULT_LEASE_SECONDS = 300
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseUnavailable(Exception):
+    ''' Raised when another run holds the lease of a shard '''
+
+
+class LeaseLost(Exception):
+    ''' Raised by `ShardLease.check()` when the lease expired, another run may own the shard '''
+
+
+def parse_shard(value):
+    ''' Parses `K/N` (shard K of N, starting at 1) into `(K, N)` '''
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError("Shard must be given as K/N, not %r" % value)
+    if not 1 <= index <= count:
+        raise ValueError("Shard %d/%d out of range, K must be between 1 and N" % (index, count))
+    return index, count
+
+
+def shard_of(username, count):
+    ''' Returns the shard (1 to `count`) of a user, stable across processes and hosts '''
+
+    return zlib.crc32(AttributeCache.normalize(username).encode('utf-8')) % count + 1
+
+
+class ShardLease(object):
+    ''' Exclusive, expiring lease on a shard stored in `SyncShard`
+
+    While held a background thread renews it every third of `seconds`, so a
+    crashed run blocks the shard for at most `seconds`. The run must call
+    `check()` regularly and stop when the lease is lost.
+    '''
+
+    def __init__(self, shard, seconds=DEFAULT_LEASE_SECONDS):
+        self.shard = shard
+        self.seconds = seconds
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lost = False
+        # Local deadline, also covers a heartbeat which did not get through
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _expires(self):
+        return timezone.now() + datetime.timedelta(seconds=self.seconds)
+
+    def acquire(self):
+        ''' Takes the lease, raises `LeaseUnavailable` if another run holds it '''
+
+        valid_until = time.monotonic() + self.seconds
+        now = timezone.now()
+        SyncShard.objects.get_or_create(shard=self.shard)
+        # Conditional update, only one of several concurrent runs matches
+        taken = SyncShard.objects.filter(shard=self.shard).filter(
+            Q(lease_expires__isnull=True) | Q(lease_expires__lte=now)
+        ).update(owner=self.owner, lease_expires=self._expires(), started=now, finished=None, failed=False)
+        if not taken:
+            current = SyncShard.objects.get(shard=self.shard)
+            raise LeaseUnavailable("Shard %s is locked by %s until %s" % (self.shard, current.owner, current.lease_expires))
+        self._valid_until = valid_until
+
+        self._thread = threading.Thread(target=self._heartbeat, name='django_ldapsync-lease', daemon=True)
+        self._thread.start()
+
+    def renew(self):
+        ''' Extends the lease, returns `False` if it was lost (expired and taken by another run) '''
+
+        valid_until = time.monotonic() + self.seconds
+        renewed = bool(SyncShard.objects.filter(shard=self.shard, owner=self.owner).update(lease_expires=self._expires()))
+        if renewed:
+            self._valid_until = valid_until
+        return renewed
+
+    def check(self):
+        ''' Raises `LeaseLost` if the lease was taken by another run or expired without renewal '''
+
+        if not self.lost and time.monotonic() >= self._valid_until:
+            self.lost = True
+            logger.warning("Lease of shard %s expired", self.shard)
+        if self.lost:
+            raise LeaseLost("Lease of shard %s lost, another run may sync it" % self.shard)
+
+    def _heartbeat(self):
+        try:
+            while not self._stop.wait(self.seconds / 3):
+                if not self.renew():
+                    self.lost = True
+                    logger.warning("Lease of shard %s lost", self.shard)
+                    return
+        finally:
+            connection.close()
+
+    def release(self, users, seconds, failed=False):
+        ''' Gives up the lease and stores the statistics of the run, nothing is stored after the lease was lost '''
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.lost:
+            return
+        SyncShard.objects.filter(shard=self.shard, owner=self.owner).update(
+            owner='', lease_expires=None, finished=timezone.now(), users=users, seconds=seconds, failed=failed,
+        )
+
+
+def shard_summary(count):
+    ''' Returns finished shards, users and combined users per second of the last runs of `count` shards '''
+
+    names = ['%d/%d' % (index, count) for index in range(1, count + 1)]
+    shards = SyncShard.objects.filter(shard__in=names, finished__isnull=False, failed=False)
+    finished = users = 0
+    rate = 0.0
+    for shard in shards:
+        finished += 1
+        users += shard.users
+        if shard.seconds:
+            rate += shard.users / shard.seconds
+    return finished, users, rate
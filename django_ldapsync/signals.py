@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent after every LDAP operation (connect, bind, search, paged_search_page,
+# rebind_retry) with the arguments `operation`, `duration` (seconds),
+# `entries`, `bytes` and `failed`. The sender is the operation name.
+ldap_operation = Signal()
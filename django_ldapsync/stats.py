@@ -0,0 +1,266 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from .signals import ldap_operation
+
+# Upper bounds of the latency histogram in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class OperationStats(object):
+    ''' Counters and latency histogram of one kind of LDAP operation '''
+
+    __slots__ = ('count', 'failures', 'entries', 'bytes', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.entries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'entries': self.entries,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'buckets': list(self.buckets),
+        }
+
+
+class Operation(object):
+    ''' Measurement of a running operation, the caller fills in `entries` and `bytes` '''
+
+    __slots__ = ('name', 'entries', 'bytes', 'failed', 'duration')
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = 0
+        self.bytes = 0
+        self.failed = False
+        self.duration = None
+
+
+class StatsRegistry(object):
+    ''' Thread-safe, in-process registry of the LDAP operation statistics '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, operation, duration, entries=0, size=0, failed=False):
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = OperationStats()
+            stats.count += 1
+            stats.failures += int(failed)
+            stats.entries += entries
+            stats.bytes += size
+            stats.seconds += duration
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        ldap_operation.send(
+            sender=operation, operation=operation, duration=duration,
+            entries=entries, bytes=size, failed=failed,
+        )
+
+    @contextmanager
+    def measure(self, name):
+        ''' Measures the block as one operation, exceptions count as failure '''
+
+        operation = Operation(name)
+        start = time.perf_counter()
+        try:
+            yield operation
+        except BaseException:
+            operation.failed = True
+            raise
+        finally:
+            operation.duration = time.perf_counter() - start
+            self.record(name, operation.duration, operation.entries, operation.bytes, operation.failed)
+
+    def snapshot(self):
+        ''' Returns a copy of all counters by operation '''
+
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in self._operations.items()}
+
+    def total_seconds(self):
+        with self._lock:
+            return sum(stats.seconds for stats in self._operations.values())
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+
+registry = StatsRegistry()
+
+
+def instrument(name):
+    ''' Shortcut for `registry.measure(name)` '''
+
+    return registry.measure(name)
+
+
+def response_size(response):
+    ''' Returns number of entries and raw bytes of a search response '''
+
+    entries = size = 0
+    for entry in response or ():
+        if entry.get('type') != 'searchResEntry':
+            continue
+        entries += 1
+        for values in entry.get('raw_attributes', {}).values():
+            for value in values:
+                size += len(value)
+    return entries, size
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def export_prometheus():
+    ''' Returns all statistics of this process in the Prometheus text format '''
+
+    from .cache import get_attribute_cache
+    from .ldap import get_connection_pool
+    from .throttle import get_rate_limiter
+
+    lines = []
+    operations = registry.snapshot()
+
+    def header(name, kind, text):
+        lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    header('django_ldapsync_operation_seconds', 'histogram', 'Latency of LDAP operations.')
+    for name, stats in sorted(operations.items()):
+        label = 'operation="%s"' % _escape_label(name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats['buckets']):
+            cumulative += count
+            lines.append('django_ldapsync_operation_seconds_bucket{%s,le="%s"} %d' % (label, bound, cumulative))
+        lines.append('django_ldapsync_operation_seconds_sum{%s} %f' % (label, stats['seconds']))
+        lines.append('django_ldapsync_operation_seconds_count{%s} %d' % (label, stats['count']))
+
+    for key, text in (('failures', 'Failed LDAP operations.'), ('entries', 'Entries returned by LDAP operations.'), ('bytes', 'Raw attribute bytes returned by LDAP operations.')):
+        metric = 'django_ldapsync_operation_%s_total' % key
+        header(metric, 'counter', text)
+        for name, stats in sorted(operations.items()):
+            lines.append('%s{operation="%s"} %d' % (metric, _escape_label(name), stats[key]))
+
+    pool = get_connection_pool().stats()
+    for key in ('size', 'idle', 'in_use'):
+        metric = 'django_ldapsync_pool_%s' % key
+        header(metric, 'gauge', 'Connection pool %s.' % key.replace('_', ' '))
+        lines.append('%s %d' % (metric, pool[key]))
+    for key in ('hits', 'misses', 'waits', 'rebinds', 'discarded', 'failures'):
+        metric = 'django_ldapsync_pool_%s_total' % key
+        header(metric, 'counter', 'Connection pool %s.' % key)
+        lines.append('%s %d' % (metric, pool[key]))
+
+    breaker = getattr(get_connection_pool(), 'breaker', None)
+    if breaker is not None:
+        from .breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+
+        circuit = breaker.stats()
+        header('django_ldapsync_circuit_state', 'gauge', 'State of the LDAP circuit breaker.')
+        for state in (STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN):
+            lines.append('django_ldapsync_circuit_state{state="%s"} %d' % (state, circuit['state'] == state))
+        for key, text in (('opened', 'Times the LDAP circuit opened.'), ('rejected', 'LDAP operations rejected by the open circuit.')):
+            metric = 'django_ldapsync_circuit_%s_total' % key
+            header(metric, 'counter', text)
+            lines.append('%s %d' % (metric, circuit[key]))
+
+    selector = getattr(get_connection_pool(), 'selector', None)
+    if selector is not None:
+        servers = sorted(selector.stats().items())
+        header('django_ldapsync_server_latency_seconds', 'gauge', 'Moving average of the LDAP server latency.')
+        for uri, stats in servers:
+            if stats['latency'] is not None:
+                lines.append('django_ldapsync_server_latency_seconds{server="%s"} %f' % (_escape_label(uri), stats['latency']))
+        for key, metric, kind, text in (
+            ('requests', 'django_ldapsync_server_requests_total', 'counter', 'Operations per LDAP server.'),
+            ('failures', 'django_ldapsync_server_failures_total', 'counter', 'Failed operations per LDAP server.'),
+            ('ejected', 'django_ldapsync_server_ejected', 'gauge', 'Whether the LDAP server is ejected.'),
+        ):
+            header(metric, kind, text)
+            for uri, stats in servers:
+                lines.append('%s{server="%s"} %d' % (metric, _escape_label(uri), stats[key]))
+
+    limiter = get_rate_limiter().stats()
+    header('django_ldapsync_throttled_seconds_total', 'counter', 'Time LDAP operations waited for the rate limiter.')
+    lines.append('django_ldapsync_throttled_seconds_total %f' % limiter['throttled_seconds'])
+    for key, text in (('throttled', 'LDAP operations delayed by the rate limiter.'), ('overloads', 'Overload results and slow LDAP operations.')):
+        metric = 'django_ldapsync_%s_total' % key
+        header(metric, 'counter', text)
+        lines.append('%s %d' % (metric, limiter[key]))
+    header('django_ldapsync_rate_limit_factor', 'gauge', 'Current fraction of the configured LDAP rate.')
+    lines.append('django_ldapsync_rate_limit_factor %f' % limiter['factor'])
+
+    cache = get_attribute_cache().stats()
+    for key in ('hits', 'misses'):
+        metric = 'django_ldapsync_cache_%s_total' % key
+        header(metric, 'counter', 'Attribute cache %s by tier.' % key)
+        for tier in ('local', 'shared'):
+            if cache[tier] is not None:
+                lines.append('%s{tier="%s"} %d' % (metric, tier, cache[tier][key]))
+
+    return '\n'.join(lines) + '\n'
+
+
+class RunStats(object):
+    ''' Collects per-phase timings of a management command, LDAP and SQL time '''
+
+    def __init__(self):
+        from .throttle import get_rate_limiter
+
+        self.start = time.perf_counter()
+        self.ldap_seconds_start = registry.total_seconds()
+        self.limiter = get_rate_limiter()
+        self.throttled_seconds_start = self.limiter.throttled_seconds
+        self.sql_seconds = 0.0
+        self.sql_queries = 0
+        self.phases = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        ''' Database execute wrapper, see `connection.execute_wrapper()` '''
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_seconds += time.perf_counter() - start
+            self.sql_queries += 1
+
+    @contextmanager
+    def phase(self, name):
+        ''' Measures the block, the time of repeated phases is summed up '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self, users):
+        ''' Returns the lines of the end-of-run performance summary '''
+
+        wall = time.perf_counter() - self.start
+        ldap_seconds = registry.total_seconds() - self.ldap_seconds_start
+        lines = ['Performance: %d users in %.2fs (%.1f users/s)' % (users, wall, users / wall if wall else 0)]
+        for name, seconds in self.phases.items():
+            lines.append('  %-10s %8.2fs' % (name, seconds))
+        lines.append('  %-10s %8.2fs' % ('LDAP', ldap_seconds))
+        throttled_seconds = self.limiter.throttled_seconds - self.throttled_seconds_start
+        if throttled_seconds > 0:
+            lines.append('  %-10s %8.2fs' % ('Throttled', throttled_seconds))
+        lines.append('  %-10s %8.2fs (%d queries)' % ('SQL', self.sql_seconds, self.sql_queries))
+        return lines
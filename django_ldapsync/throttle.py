@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+
+from ldap3.core.results import RESULT_BUSY, RESULT_TIME_LIMIT_EXCEEDED, RESULT_UNAVAILABLE
+
+from .conf import get_config
+
+# Results asking the client to slow down
+OVERLOAD_RESULTS = frozenset((RESULT_BUSY, RESULT_UNAVAILABLE, RESULT_TIME_LIMIT_EXCEEDED))
+
+# The rate recovers by this fraction of the configured rate per successful operation
+RECOVERY_STEP = 0.05
+
+
+def backoff_delay(attempt, base, maximum):
+    ''' Exponential backoff with full jitter for the `attempt`-th retry (starting at 0) '''
+
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class RateLimiter(object):
+    ''' Token bucket for LDAP operations of a process, slowed down while the server is overloaded
+
+    Without a `rate` operations are only delayed after overload results. An
+    overload result (or an operation slower than `latency_threshold`) halves
+    the rate down to `min_rate` times the configured one and pauses all
+    operations for a backoff delay, successful operations let it recover.
+    '''
+
+    def __init__(self, rate=None, burst=10, latency_threshold=None, min_rate=0.1, backoff_base=0.2, backoff_max=10.0):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.latency_threshold = latency_threshold
+        self.min_rate = min_rate
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._factor = 1.0
+        self._penalties = 0
+        self._pause_until = 0.0
+
+        # Counters
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.overloads = 0
+
+    def acquire(self):
+        ''' Waits until the operation may run, returns the waited seconds '''
+
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._pause_until - now)
+            if self.rate:
+                rate = self.rate * self._factor
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * rate)
+                self._updated = now
+                # Take the token now, a negative balance is the queue of waiting operations
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / rate)
+            if wait > 0:
+                self.throttled += 1
+                self.throttled_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def record(self, result=None, latency=None):
+        ''' Adapts the rate to the result code and latency of a finished operation '''
+
+        overloaded = result in OVERLOAD_RESULTS or (
+            self.latency_threshold is not None and latency is not None and latency > self.latency_threshold
+        )
+        with self._lock:
+            if overloaded:
+                self.overloads += 1
+                self._factor = max(self.min_rate, self._factor / 2)
+                self._pause_until = max(
+                    self._pause_until,
+                    time.monotonic() + backoff_delay(self._penalties, self.backoff_base, self.backoff_max),
+                )
+                self._penalties += 1
+            elif self._penalties or self._factor < 1.0:
+                self._penalties = 0
+                self._factor = min(1.0, self._factor + RECOVERY_STEP)
+        return overloaded
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate * self._factor if self.rate else None,
+                'factor': self._factor,
+                'throttled': self.throttled,
+                'throttled_seconds': self.throttled_seconds,
+                'overloads': self.overloads,
+            }
+
+
+_limiter = None
+_limiter_key = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    ''' Returns the rate limiter of this process for the current settings '''
+
+    global _limiter, _limiter_key
+
+    config = get_config().rate_limit
+    with _limiter_lock:
+        if _limiter is None or _limiter_key != config:
+            _limiter = RateLimiter(
+                rate=config['rate'],
+                burst=config['burst'],
+                latency_threshold=config['latency_threshold'],
+                min_rate=config['min_rate'],
+                backoff_base=config['backoff_base'],
+                backoff_max=config['backoff_max'],
+            )
+            _limiter_key = config
+        return _limiter
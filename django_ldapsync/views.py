@@ -0,0 +1,26 @@
+from django.http import HttpResponse, JsonResponse
+
+from .stats import export_prometheus
+
+
+def metrics(request):
+    ''' Statistics of this process in the Prometheus text format
+
+    Not routed by default, protect the URL when adding it to your urlconf.
+    '''
+
+    return HttpResponse(export_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def health(request):
+    ''' State of the LDAP circuit breaker of this process as JSON, status 503 while it is open
+
+    Does not contact the server. Not routed by default, like `metrics()`.
+    '''
+
+    from .breaker import STATE_CLOSED, STATE_OPEN
+    from .ldap import get_connection_pool
+
+    breaker = getattr(get_connection_pool(), 'breaker', None)
+    circuit = breaker.stats() if breaker is not None else {'state': STATE_CLOSED}
+    return JsonResponse(circuit, status=503 if circuit['state'] == STATE_OPEN else 200)
@@ -1,8 +1,41 @@
+import asyncio
+import datetime
+import os
+import tempfile
+import threading
+import time
 from io import StringIO
+from unittest import mock
 from django.conf import settings
 from django.core import management
+from django.core.exceptions import ImproperlyConfigured
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.contrib.auth.models import Group
+from django.test import Client, SimpleTestCase, TestCase
+from django.utils import timezone
+from django_ldapsync import AsyncLdap, Ldap
+from ldap3.core.exceptions import LDAPException, LDAPOperationResult
+from ldap3.core.results import RESULT_BUSY, RESULT_SUCCESS, RESULT_TIME_LIMIT_EXCEEDED
+from django_ldapsync.breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, CircuitOpen
+from django_ldapsync.apps import needs_ldap_lookup, set_attributes_from_ldap
+from django_ldapsync.cache import AttributeCache, LRUCache, get_attribute_cache
+from django_ldapsync.checkpoint import ORDER_RECENT_LOGIN_FIRST, Checkpoint, inactive_users
+from django_ldapsync.conf import build_config, get_config
+from django_ldapsync.fingerprints import FINGERPRINT_FIELD, FingerprintTracker, compute_fingerprint, stale_users
+from django_ldapsync.ldap import (
+    PAGED_RESULTS_CONTROL, LdapConnectionPool, LdapPoolTimeout, chunked, create_connection, decode_text,
+)
+from django_ldapsync.groups import GroupGraph, clear_group_graphs, get_group_graph, membership_diff
+from django_ldapsync.merge import DbRecord, LdapRecord, UnsortedInput, external_sort, merge_join, verify_sorted
+from django_ldapsync.models import SyncShard, SyncState, UserFingerprint
+from django_ldapsync.prefetch import get_prefetched_attributes, prefetched_attributes, suppress_ldap_lookup
+from django_ldapsync.refresh import ThreadRefreshBackend
+from django_ldapsync.sharding import LeaseLost, LeaseUnavailable, ShardLease, parse_shard, shard_of, shard_summary
+from django_ldapsync.servers import ServerSelector
+from django_ldapsync.signals import ldap_operation
+from django_ldapsync.stats import StatsRegistry, export_prometheus, registry
+from django_ldapsync.throttle import RateLimiter, backoff_delay
+from django_ldapsync.views import health
 
 class LdapTestCase(TestCase):
     def setUp(self):
@@ -50,6 +83,19 @@ class LdapTestCase(TestCase):
         self.assertEquals(user.last_name, settings.LDAP_TEST['expected_lastname'])
         self.assertNotEqual(user.email, '')
 
+    def test_management_command_import_twice(self):
+        ''' Import-Commando mehrfach ausführen, Nutzer und Mitgliedschaften werden nur einmal angelegt '''
+
+        management.call_command('ldap_import', group=settings.LDAP_TEST['expected_group'], stdout=StringIO())
+        user_count = self.USER_MODEL.objects.count()
+        stdout = StringIO()
+        management.call_command('ldap_import', group=settings.LDAP_TEST['expected_group'], stdout=stdout)
+        self.assertEqual(self.USER_MODEL.objects.count(), user_count)
+        self.assertIn("0 users created, 0 memberships added", stdout.getvalue())
+        user = self.USER_MODEL.objects.get(username=settings.LDAP_TEST['username'])
+        self.assertTrue(user.groups.filter(name=settings.LDAP_TEST['expected_group']).exists())
+        self.assertFalse(user.has_usable_password())
+
     def test_management_command_is_active(self):
         ''' Management-Commando testen, Nicht gefundene Nutzer deaktivieren'''
 
@@ -121,6 +167,99 @@ class LdapTestCase(TestCase):
             self.assertIn("Ignoring api-not_in_ldap", output_lines)
             self.assertIn("Ignoring alice", output_lines)
 
+    def test_management_command_bulk_modes(self):
+        ''' Management-Commando testen, Abgleich aller Nutzer in einem Durchlauf '''
+
+        for mode in ('batch', 'scan', 'merge'):
+            with self.settings(LDAP_SYNC_DISABLE_INVALID_USER=True):
+                self.USER_MODEL.objects.all().delete()
+                self.USER_MODEL.objects.create(username=settings.LDAP_TEST['username'],  is_active=False)
+                self.USER_MODEL.objects.create(username='not_in_ldap', is_active=True)
+                self.USER_MODEL.objects.all().update(first_name='', last_name='', email='')
+
+                # Synchronisation durchführen, Nutzer 1 ist aktiv, Nutzer 2 nicht
+                management.call_command('ldap_sync', mode=mode, batch_size=1)
+                user = self.USER_MODEL.objects.get(username=settings.LDAP_TEST['username'])
+                self.assertTrue(user.is_active)
+                self.assertEquals(user.first_name, settings.LDAP_TEST['expected_firstname'])
+                user = self.USER_MODEL.objects.get(username='not_in_ldap')
+                self.assertFalse(user.is_active)
+
+    def test_management_command_incremental(self):
+        ''' Management-Commando testen, nur geänderte Einträge abgleichen '''
+
+        # Erster Lauf ist vollständig und speichert den Stand des Servers
+        self.USER_MODEL.objects.create(username=settings.LDAP_TEST['username'])
+        management.call_command('ldap_sync', incremental=True)
+        self.assertEqual(SyncState.objects.count(), 1)
+
+        # Unveränderte Einträge werden im zweiten Lauf nicht erneut geschrieben
+        self.USER_MODEL.objects.all().update(first_name='')
+        management.call_command('ldap_sync', incremental=True)
+        user = self.USER_MODEL.objects.get(username=settings.LDAP_TEST['username'])
+        self.assertEquals(user.first_name, '')
+
+        # Vollständiger Lauf
+        management.call_command('ldap_sync', incremental=True, full=True)
+        user = self.USER_MODEL.objects.get(username=settings.LDAP_TEST['username'])
+        self.assertEquals(user.first_name, settings.LDAP_TEST['expected_firstname'])
+
+    def test_management_command_workers(self):
+        ''' Management-Commando testen, parallele Abfragen liefern dasselbe Ergebnis '''
+
+        with self.settings(LDAP_SYNC_DISABLE_INVALID_USER=True):
+            self.USER_MODEL.objects.create(username=settings.LDAP_TEST['username'],  is_active=False)
+            self.USER_MODEL.objects.create(username='not_in_ldap', is_active=True)
+            self.USER_MODEL.objects.create(username='api-not_in_ldap', is_active=True)
+            self.USER_MODEL.objects.all().update(first_name='', last_name='', email='')
+
+            stdout = StringIO()
+            management.call_command('ldap_sync', workers=4, verbosity=3, stdout=stdout)
+            user = self.USER_MODEL.objects.get(username=settings.LDAP_TEST['username'])
+            self.assertTrue(user.is_active)
+            self.assertEquals(user.first_name, settings.LDAP_TEST['expected_firstname'])
+            self.assertFalse(self.USER_MODEL.objects.get(username='not_in_ldap').is_active)
+            self.assertTrue(self.USER_MODEL.objects.get(username='api-not_in_ldap').is_active)
+            self.assertIn("Ignoring api-not_in_ldap", stdout.getvalue().splitlines())
+
+    def test_get_dns(self):
+        ''' Mehrere DNs in einer Suche auflösen, unbekannte Namen liefern `None` '''
+
+        ldap = Ldap()
+        group = settings.LDAP_TEST['expected_group']
+        group_dn = ldap.get_dn(group, object_class='group')
+        self.assertIsNotNone(group_dn)
+        dns = ldap.get_dns([group, group.upper(), 'not_in_ldap(*)'])
+        self.assertEqual(dns, {group: group_dn, group.upper(): group_dn, 'not_in_ldap(*)': None})
+
+    def test_group_strategy_graph(self):
+        ''' Gruppenmitglieder über den Gruppen-Graphen auflösen '''
+
+        ldap = Ldap()
+        group_dn = ldap.get_dn(settings.LDAP_TEST['expected_group'])
+        expected = sorted(str(member['sAMAccountName']) for member in ldap.get_group_members(group_dn))
+        with self.settings(LDAP_SYNC_GROUP_STRATEGY='graph'):
+            ldap = Ldap()
+            members = sorted(str(member['sAMAccountName']) for member in ldap.get_group_members(group_dn))
+            self.assertEqual(members, expected)
+            members = ldap.get_members_of_groups([group_dn])[group_dn]
+            self.assertEqual(sorted(str(member['sAMAccountName']) for member in members), expected)
+
+    def test_background_refresh(self):
+        ''' Bestehende Nutzer werden nach dem Speichern im Hintergrund aktualisiert '''
+
+        self.USER_MODEL.objects.create(username=settings.LDAP_TEST['username'])
+        self.USER_MODEL.objects.all().update(first_name='')
+        background_refresh = {'enabled': True, 'backend': 'django_ldapsync.refresh.ImmediateRefreshBackend'}
+        with self.settings(LDAP_SYNC_BACKGROUND_REFRESH=background_refresh):
+            with self.captureOnCommitCallbacks(execute=True):
+                user = self.USER_MODEL.objects.get(username=settings.LDAP_TEST['username'])
+                user.save()
+                self.assertEquals(user.first_name, '')
+
+        user.refresh_from_db()
+        self.assertEquals(user.first_name, settings.LDAP_TEST['expected_firstname'])
+
     def test_invalid_user(self):
         ''' Ungültiger Nutzer anlegen '''
 
@@ -129,3 +268,1023 @@ class LdapTestCase(TestCase):
         self.assertEquals(user.first_name, '')
         self.assertEquals(user.last_name, '')
         self.assertEquals(user.email, '')
+
+    def test_iter_group_members(self):
+        ''' Gruppenmitglieder seitenweise abrufen '''
+
+        ldap = Ldap()
+        group_dn = ldap.get_dn(settings.LDAP_TEST['expected_group'])
+        members = list(ldap.iter_group_members(group_dn, page_size=1))
+        self.assertEqual(len(members), len(ldap.get_group_members(group_dn)))
+        chunks = list(ldap.iter_group_member_chunks(group_dn, 1))
+        self.assertTrue(all(len(chunk) == 1 for chunk in chunks))
+
+    async def test_async_api(self):
+        ''' Asynchrone Abfragen liefern dieselben Ergebnisse '''
+
+        ldap = AsyncLdap()
+        attributes = await ldap.aget_django_attributes_for_user(settings.LDAP_TEST['username'], refresh=True)
+        self.assertEquals(attributes['first_name'], settings.LDAP_TEST['expected_firstname'])
+        group_dn = await ldap.aget_dn(settings.LDAP_TEST['expected_group'])
+        members = [member async for member in ldap.aiter_group_members(group_dn, page_size=1)]
+        self.assertNotEqual(members, [])
+
+
+class FakeConnection(object):
+    closed = False
+
+    def bind(self):
+        self.closed = False
+
+    def unbind(self):
+        self.closed = True
+
+
+class SearchConnection(FakeConnection):
+    ''' Answers every search with the next of `pages`, each `(entries, result, more)` '''
+
+    raise_exceptions = False
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.response = self.result = None
+
+    def search(self, **kwargs):
+        entries, result, more = self.pages.pop(0) if self.pages else ([], RESULT_SUCCESS, False)
+        self.response = [{'type': 'searchResEntry', 'attributes': dict(attributes)} for attributes in entries]
+        self.result = {
+            'result': result, 'description': 'result %d' % result, 'dn': '', 'message': '', 'type': 'searchResDone',
+            'controls': {PAGED_RESULTS_CONTROL: {'value': {'cookie': b'next' if more else b''}}},
+        }
+        return result == RESULT_SUCCESS
+
+
+def ldap_entry(username, first_name):
+    return {'sAMAccountName': username, 'givenName': first_name, 'sn': 'Muster', 'mail': username + '@example.com'}
+
+
+class IncompleteSearchTestCase(TestCase):
+    ''' Fehlerergebnisse des Servers dürfen nicht als fehlende Einträge behandelt werden '''
+
+    def setUp(self):
+        User = get_user_model()
+        for username in ('alice', 'bob'):
+            User.objects.create(username=username, first_name=username, is_active=True)
+        # No backoff pauses after the overload results of these tests
+        patcher = mock.patch('django_ldapsync.ldap.get_rate_limiter', return_value=RateLimiter(backoff_base=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_connection(self, pages):
+        conn = SearchConnection(pages)
+        patcher = mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=LdapConnectionPool(lambda: conn, size=2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return conn
+
+    def test_paged_search(self):
+        ''' Eine abgebrochene Seite löst eine Ausnahme aus, auch ohne `raise_exceptions` '''
+
+        self.use_connection([([ldap_entry('alice', 'Alice')], RESULT_TIME_LIMIT_EXCEEDED, False)])
+        with self.assertRaises(LDAPOperationResult):
+            Ldap().get_django_attributes_for_users()
+
+    def test_truncated_sync(self):
+        ''' Ein abgeschnittenes Suchergebnis bricht den Abgleich ab, ohne Nutzer zu ändern '''
+
+        for mode in ('scan', 'batch'):
+            # RootDSE, then the truncated search
+            self.use_connection([([], RESULT_SUCCESS, False), ([ldap_entry('alice', 'Alice')], RESULT_TIME_LIMIT_EXCEEDED, False)])
+            with self.settings(LDAP_SYNC_DISABLE_INVALID_USER=True):
+                with self.assertRaisesMessage(management.CommandError, 'LDAP search failed'):
+                    management.call_command('ldap_sync', mode=mode, verbosity=0)
+            self.assertEqual(
+                list(get_user_model().objects.order_by('username').values_list('first_name', 'is_active')),
+                [('alice', True), ('bob', True)],
+            )
+
+    def test_truncated_merge(self):
+        ''' Endet der LDAP-Strom vorzeitig, werden die restlichen Nutzer nicht als fehlend deaktiviert '''
+
+        truncated = ([ldap_entry('alice', 'Alice')], RESULT_TIME_LIMIT_EXCEEDED, False)
+        # RootDSE, the unsorted answer to the sorted search, then the client sorted one
+        self.use_connection([([], RESULT_SUCCESS, False), truncated, truncated])
+        with self.settings(LDAP_SYNC_DISABLE_INVALID_USER=True):
+            with self.assertRaisesMessage(management.CommandError, 'LDAP search failed'):
+                management.call_command('ldap_sync', mode='merge', verbosity=0)
+        self.assertEqual(
+            list(get_user_model().objects.order_by('username').values_list('first_name', 'is_active')),
+            [('alice', True), ('bob', True)],
+        )
+
+    def test_truncated_group_members(self):
+        ''' Ist die Mitgliederliste einer Gruppe abgeschnitten, werden keine Mitgliedschaften entfernt '''
+
+        group = Group.objects.create(name='truncated-group')
+        group.user_set.set(get_user_model().objects.all())
+        group_entry = {'cn': 'truncated-group', 'distinguishedName': 'CN=truncated-group,DC=example'}
+        truncated = ([ldap_entry('alice', 'Alice')], RESULT_TIME_LIMIT_EXCEEDED, False)
+        self.use_connection([([group_entry], RESULT_SUCCESS, False), truncated])
+        with self.assertRaisesMessage(management.CommandError, 'LDAP search failed'):
+            management.call_command('ldap_sync_groups', 'truncated-group', strategy='in_chain', verbosity=0, stdout=StringIO())
+        self.assertEqual(sorted(group.user_set.values_list('username', flat=True)), ['alice', 'bob'])
+
+    def test_overloaded_lookup(self):
+        ''' Bleibt der Server nach allen Wiederholungen überlastet, gilt der Nutzer nicht als unbekannt '''
+
+        busy = [([], RESULT_BUSY, False)] * 10
+        self.use_connection(busy)
+        ldap = Ldap()
+        with self.assertRaises(LDAPOperationResult):
+            ldap.get_django_attributes_for_user('bob', refresh=True, required=True)
+        with self.assertLogs('django_ldapsync.ldap', 'WARNING'):
+            self.assertEqual(ldap.get_django_attributes_for_user('bob', refresh=True), {})
+        self.assertIsNone(get_attribute_cache().get('bob'))
+
+        self.use_connection(busy)
+        with self.settings(LDAP_SYNC_DISABLE_INVALID_USER=True):
+            with self.assertRaisesMessage(management.CommandError, 'bob'):
+                management.call_command('ldap_sync', exclude_usernames=['alice'], verbosity=0)
+        self.assertTrue(get_user_model().objects.get(username='bob').is_active)
+
+
+class LdapConnectionPoolTestCase(SimpleTestCase):
+    def test_reuse(self):
+        ''' Zurückgegebene Verbindungen werden wiederverwendet '''
+
+        pool = LdapConnectionPool(FakeConnection, size=2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertIs(first, second)
+        self.assertEqual(pool.stats()['misses'], 1)
+        self.assertEqual(pool.stats()['hits'], 1)
+
+    def test_size_limit(self):
+        ''' Mehr als `size` Verbindungen werden nicht geöffnet '''
+
+        pool = LdapConnectionPool(FakeConnection, size=1, wait_timeout=0.01)
+        with pool.connection():
+            with self.assertRaises(LdapPoolTimeout):
+                pool.acquire()
+
+    def test_discard_on_error(self):
+        ''' Verbindungen mit LDAP-Fehlern werden verworfen '''
+
+        pool = LdapConnectionPool(FakeConnection, size=1)
+        with self.assertRaises(LDAPException):
+            with pool.connection() as conn:
+                raise LDAPException()
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_idle_timeout(self):
+        ''' Zu lange ungenutzte Verbindungen werden ersetzt '''
+
+        pool = LdapConnectionPool(FakeConnection, size=1, idle_timeout=0)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertIsNot(first, second)
+
+
+class RequiredLookupTestCase(SimpleTestCase):
+    def test_pool_timeout(self):
+        ''' Ohne freie Verbindung bricht `ldap_sync` ab, statt den Nutzer als nicht gefunden zu behandeln '''
+
+        from django_ldapsync.management.commands.ldap_sync import Command
+
+        pool = LdapConnectionPool(FakeConnection, size=1, wait_timeout=0.01)
+        held = pool.acquire()
+        with mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=pool):
+            ldap = Ldap()
+            with self.assertLogs('django_ldapsync.ldap', 'WARNING'):
+                self.assertEqual(ldap.get_django_attributes_for_user('pool-timeout-user', refresh=True), {})
+            with self.assertRaises(LdapPoolTimeout):
+                ldap.get_django_attributes_for_user('pool-timeout-user', refresh=True, required=True)
+            with self.assertRaisesMessage(management.CommandError, 'pool-timeout-user'):
+                Command().lookup_user(ldap, 'pool-timeout-user')
+        pool.release(held)
+
+
+class ServerSelectorTestCase(SimpleTestCase):
+    URIS = ['ldap://dc1/dc=example', 'ldap://dc2/dc=example', 'ldap://dc3/dc=example']
+
+    def selector(self, down=(), **kwargs):
+        def factory(params):
+            if params['host'] in down:
+                raise LDAPException('down')
+            connection = FakeConnection()
+            connection.host = params['host']
+            return connection
+        kwargs.setdefault('probe_interval', 0)
+        return ServerSelector(self.URIS, factory, **kwargs)
+
+    def test_failover(self):
+        ''' Ist ein Server nicht erreichbar, wird der nächste verwendet und nach wiederholten Fehlern ausgesetzt '''
+
+        selector = self.selector(down={'dc1'}, max_failures=2)
+        self.assertEqual(selector.connect().host, 'dc2')
+        self.assertFalse(selector.stats()[self.URIS[0]]['ejected'])
+        self.assertEqual(selector.connect().host, 'dc2')
+        self.assertTrue(selector.stats()[self.URIS[0]]['ejected'])
+        self.assertEqual([server.params['host'] for server in selector.candidates()], ['dc2', 'dc3', 'dc1'])
+
+    def test_all_down(self):
+        ''' Sind alle Server nicht erreichbar, wird der letzte Fehler weitergegeben '''
+
+        selector = self.selector(down={'dc1', 'dc2', 'dc3'})
+        with self.assertRaises(LDAPException):
+            selector.connect()
+
+    def test_round_robin(self):
+        ''' Neue Verbindungen werden reihum verteilt '''
+
+        selector = self.selector(strategy='round_robin')
+        self.assertEqual([selector.connect().host for i in range(4)], ['dc1', 'dc2', 'dc3', 'dc1'])
+
+    def test_lowest_latency(self):
+        ''' Der schnellste Server wird bevorzugt, zu langsame Server werden ausgesetzt '''
+
+        selector = self.selector(strategy='lowest_latency', slow_threshold=0.5)
+        connections = [selector.connect() for i in range(3)]
+        self.assertEqual(sorted(connection.host for connection in connections), ['dc1', 'dc2', 'dc3'])
+        latencies = {'dc1': 0.2, 'dc2': 0.05, 'dc3': 0.9}
+        for i in range(5):
+            for connection in connections:
+                selector.record(connection, latency=latencies[connection.host])
+        self.assertEqual(selector.connect().host, 'dc2')
+        self.assertTrue(selector.stats()[self.URIS[2]]['ejected'])
+        dc3 = next(connection for connection in connections if connection.host == 'dc3')
+        self.assertFalse(selector.accepts(dc3))
+
+    def test_probe_readmits(self):
+        ''' Ein erfolgreicher Health-Check nimmt einen ausgesetzten Server wieder auf '''
+
+        down = {'dc1'}
+        selector = self.selector(down=down, max_failures=1)
+        selector.connect()
+        self.assertTrue(selector.stats()[self.URIS[0]]['ejected'])
+        self.assertFalse(selector.probe(selector.servers[0]))
+        down.clear()
+        self.assertTrue(selector.probe(selector.servers[0]))
+        self.assertFalse(selector.stats()[self.URIS[0]]['ejected'])
+        self.assertEqual(selector.connect().host, 'dc1')
+
+    def test_pool(self):
+        ''' Der Pool verwendet Verbindungen zu ausgesetzten Servern nicht weiter '''
+
+        selector = self.selector(max_failures=1)
+        pool = LdapConnectionPool(selector.connect, size=2, selector=selector)
+        with pool.connection() as first:
+            self.assertEqual(first.host, 'dc1')
+        selector.record(first, failed=True)
+        with pool.connection() as second:
+            self.assertEqual(second.host, 'dc2')
+        self.assertTrue(first.closed)
+
+
+class AsyncGateTestCase(SimpleTestCase):
+    def test_gate(self):
+        ''' Offene Iterationen und laufende Abfragen belegen zusammen höchstens `pool_size` Verbindungen '''
+
+        lock = threading.Lock()
+        in_use = []
+        peak = [0]
+
+        def hold():
+            with lock:
+                in_use.append(True)
+                peak[0] = max(peak[0], len(in_use))
+
+        def drop():
+            with lock:
+                in_use.pop()
+
+        class BlockingLdap(object):
+            LDAP_PAGE_SIZE = 1
+
+            def iter_group_member_chunks(self, group_dn, chunk_size, **kwargs):
+                hold()
+                try:
+                    yield [group_dn + '-1']
+                    yield [group_dn + '-2']
+                finally:
+                    drop()
+
+            def get_dn(self, common_name, object_class=None):
+                hold()
+                time.sleep(0.01)
+                drop()
+                return common_name
+
+        async def run():
+            ldap = AsyncLdap()
+            ldap.ldap = BlockingLdap()
+
+            async def members(group_dn):
+                return [member async for member in ldap.aiter_group_members(group_dn)]
+
+            return await asyncio.gather(*[members('g%d' % i) for i in range(3)], *[ldap.aget_dn('u%d' % i) for i in range(5)])
+
+        with mock.patch('django_ldapsync.async_ldap.get_connection_pool', return_value=mock.Mock(size=2)):
+            results = asyncio.run(run())
+        self.assertEqual(results[0], ['g0-1', 'g0-2'])
+        self.assertEqual(results[-1], 'u4')
+        self.assertLessEqual(peak[0], 2)
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    def breaker_pool(self, down, **kwargs):
+        def factory():
+            if down:
+                raise LDAPException('down')
+            return FakeConnection()
+        self.breaker = CircuitBreaker(**kwargs)
+        return LdapConnectionPool(factory, size=2, breaker=self.breaker)
+
+    def test_open_and_close(self):
+        ''' Nach wiederholten Fehlern wird nicht mehr verbunden, eine erfolgreiche Probe schließt den Kreis '''
+
+        down = [True]
+        pool = self.breaker_pool(down, failure_threshold=2, reset_seconds=60)
+        for _ in range(2):
+            with self.assertRaises(LDAPException):
+                pool.acquire()
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        with self.assertRaises(CircuitOpen):
+            pool.acquire()
+        self.assertEqual(pool.stats()['failures'], 2)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+        down.clear()
+        self.breaker.reset_seconds = 0
+        self.assertEqual(self.breaker.state, STATE_HALF_OPEN)
+        pool.release(pool.acquire())
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+
+    def test_single_probe(self):
+        ''' Im halb offenen Zustand wird nur eine Anfrage durchgelassen, ihr Fehler öffnet den Kreis wieder '''
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+        with mock.patch('django_ldapsync.breaker.time.monotonic', return_value=100.0):
+            breaker.record_failure()
+        with mock.patch('django_ldapsync.breaker.time.monotonic', return_value=130.0):
+            breaker.allow()
+            with self.assertRaises(CircuitOpen):
+                breaker.allow()
+            # Operations on connections already held are not blocked
+            breaker.check()
+            breaker.record_failure()
+            self.assertEqual(breaker.stats()['state'], STATE_OPEN)
+            self.assertEqual(breaker.stats()['retry_in'], 30.0)
+        self.assertEqual(breaker.opened, 2)
+
+    def test_probe_connects(self):
+        ''' Die Probe öffnet eine neue Verbindung, ihr Ergebnis entscheidet sofort über den Zustand '''
+
+        down = []
+        pool = self.breaker_pool(down, failure_threshold=1, reset_seconds=0)
+        pool.release(pool.acquire())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, STATE_HALF_OPEN)
+        # The idle connection is not reused, `is_available()` alone closes the circuit
+        conn = pool.acquire()
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+        self.assertEqual(pool.stats()['misses'], 2)
+        pool.release(conn)
+
+        self.breaker.record_failure()
+        down.append(True)
+        with self.assertRaises(LDAPException):
+            pool.acquire()
+        # Once more by the failed probe
+        self.assertEqual(self.breaker.opened, 3)
+
+    def test_probe_pool_timeout(self):
+        ''' Bekommt die Probe keine Verbindung, darf sofort die nächste Anfrage prüfen '''
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.5)
+        pool = LdapConnectionPool(FakeConnection, size=1, wait_timeout=0.01, breaker=breaker)
+        held = pool.acquire()
+        breaker.record_failure()
+        time.sleep(0.5)
+        with self.assertRaises(LdapPoolTimeout):
+            pool.acquire()
+        self.assertTrue(breaker.allow())
+        pool.release(held)
+
+    def test_release_on_circuit_open(self):
+        ''' Eine wegen des offenen Kreises abgewiesene Suche gibt die Verbindung unbeschädigt zurück '''
+
+        pool = self.breaker_pool([], failure_threshold=1, reset_seconds=60)
+        with mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=pool):
+            ldap = Ldap()
+            with self.assertRaises(CircuitOpen):
+                with ldap.borrow_connection() as conn:
+                    with self.assertLogs('django_ldapsync.breaker', 'WARNING'):
+                        self.breaker.record_failure()
+                    ldap._search(conn, search_base='', search_filter='(objectClass=*)')
+        self.assertFalse(conn.closed)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertEqual(pool.stats()['discarded'], 0)
+
+    def test_overload_results(self):
+        ''' Antworten eines überlasteten Servers zählen als Fehler '''
+
+        busy, success = ([], RESULT_BUSY, False), ([], RESULT_SUCCESS, False)
+        conn = SearchConnection([busy, success, busy, busy])
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+        pool = LdapConnectionPool(lambda: conn, size=1, breaker=self.breaker)
+        with mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=pool), \
+                mock.patch('django_ldapsync.ldap.get_rate_limiter', return_value=RateLimiter(backoff_base=0)):
+            ldap = Ldap()
+            with ldap.borrow_connection() as conn:
+                for i in range(2):
+                    ldap._search(conn, search_base='', search_filter='(objectClass=*)')
+                self.assertEqual(self.breaker.state, STATE_CLOSED)
+                with self.assertLogs('django_ldapsync.breaker', 'WARNING'):
+                    ldap._search(conn, search_base='', search_filter='(objectClass=*)')
+                    ldap._search(conn, search_base='', search_filter='(objectClass=*)')
+            self.assertEqual(self.breaker.state, STATE_OPEN)
+            with self.assertRaises(CircuitOpen):
+                ldap.get_django_attributes_for_user('overloaded-user', refresh=True, required=True)
+
+    def test_fail_fast(self):
+        ''' Bei offenem Kreis liefert `Ldap` sofort keine Attribute, das Speichern behält die vorhandenen '''
+
+        pool = self.breaker_pool([True], failure_threshold=1)
+        with mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=pool):
+            with self.assertLogs('django_ldapsync.breaker', 'WARNING'):
+                self.assertIsNone(Ldap().connection)
+            ldap = Ldap()
+            self.assertEqual(ldap.get_django_attributes_for_user('circuit-open-user'), {})
+            self.assertFalse(ldap.is_available())
+            response = health(None)
+        self.assertEqual(pool.stats()['failures'], 1)
+        self.assertEqual(response.status_code, 503)
+
+
+class PreSavePolicyTestCase(SimpleTestCase):
+    def setUp(self):
+        self.USER_MODEL = get_user_model()
+
+    def test_update_fields(self):
+        ''' Speichern ohne synchronisierte Felder fragt das LDAP nicht ab '''
+
+        user = self.USER_MODEL(username='testuser')
+        self.assertFalse(needs_ldap_lookup(user, update_fields=['last_login']))
+        self.assertTrue(needs_ldap_lookup(user, update_fields=['last_login', 'email']))
+
+    def test_policy_create(self):
+        ''' Mit der Einstellung `create` werden nur neue Nutzer abgefragt '''
+
+        user = self.USER_MODEL(username='testuser')
+        with self.settings(LDAP_SYNC_PRE_SAVE_POLICY='create'):
+            self.assertTrue(needs_ldap_lookup(user))
+            user._state.adding = False
+            self.assertFalse(needs_ldap_lookup(user))
+
+
+    def test_policy_stale_remember(self):
+        ''' Mit `stale` gilt ein Nutzer nur nach einer erfolgreichen, vollständigen Abfrage als aktuell '''
+
+        user = self.USER_MODEL(username='stale-user')
+        user._state.adding = False
+        pool = LdapConnectionPool(FakeConnection, size=1, wait_timeout=0.01)
+        held = pool.acquire()
+        caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with self.settings(LDAP_SYNC_PRE_SAVE_POLICY='stale', CACHES=caches):
+            with mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=pool):
+                with self.assertLogs('django_ldapsync.apps', 'WARNING'):
+                    set_attributes_from_ldap(self.USER_MODEL, user)
+            self.assertTrue(needs_ldap_lookup(user))
+            with prefetched_attributes({'stale-user': {'email': 'stale@example.com'}}):
+                set_attributes_from_ldap(self.USER_MODEL, user, update_fields=['email'])
+                self.assertEqual(user.email, 'stale@example.com')
+                self.assertTrue(needs_ldap_lookup(user))
+                set_attributes_from_ldap(self.USER_MODEL, user)
+            self.assertFalse(needs_ldap_lookup(user))
+        pool.release(held)
+
+
+class ShardingTestCase(TestCase):
+    def test_shard_of(self):
+        ''' Nutzer werden stabil und gleichmäßig auf die Shards verteilt '''
+
+        self.assertEqual(parse_shard('2/3'), (2, 3))
+        self.assertRaises(ValueError, parse_shard, '0/3')
+        self.assertRaises(ValueError, parse_shard, 'x')
+        self.assertEqual(shard_of('MMuster@domain', 3), shard_of('mmuster', 3))
+        counts = [0, 0, 0]
+        for i in range(3000):
+            counts[shard_of('user%d' % i, 3) - 1] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts), counts)
+
+    def test_lease(self):
+        ''' Ein Shard kann nur von einem Lauf gleichzeitig bearbeitet werden '''
+
+        first = ShardLease('1/2', seconds=60)
+        first.acquire()
+        self.assertRaises(LeaseUnavailable, ShardLease('1/2').acquire)
+        first.release(users=100, seconds=2.0)
+
+        other = ShardLease('2/2')
+        other.acquire()
+        self.assertEqual(shard_summary(2), (1, 100, 50.0))
+        other.release(users=300, seconds=3.0)
+        self.assertEqual(shard_summary(2), (2, 400, 150.0))
+        self.assertEqual(SyncShard.objects.get(shard='1/2').owner, '')
+
+    def test_lease_lost(self):
+        ''' Ein Lauf ohne gültige Lease schreibt nichts mehr, auch keine Statistik '''
+
+        from django_ldapsync.management.commands.ldap_sync import Command
+
+        lease = ShardLease('1/3', seconds=60)
+        lease.acquire()
+        command = Command()
+        command.lease = lease
+        command.check_lease()
+        # Heartbeat did not get through, another run took the shard
+        SyncShard.objects.filter(shard='1/3').update(owner='other', lease_expires=None)
+        with mock.patch('django_ldapsync.sharding.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertRaises(LeaseLost, command.check_lease)
+        self.assertFalse(lease.renew())
+        lease.release(users=10, seconds=1.0)
+        self.assertEqual(SyncShard.objects.get(shard='1/3').owner, 'other')
+        self.assertEqual(SyncShard.objects.get(shard='1/3').users, 0)
+
+
+class CheckpointTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        User = get_user_model()
+        self.users = [
+            User.objects.create(username='old', last_login=now - datetime.timedelta(days=400)),
+            User.objects.create(username='never'),
+            User.objects.create(username='recent', last_login=now),
+            User.objects.create(username='same', last_login=now),
+        ]
+
+    def iter_pass(self, checkpoint, stop=None):
+        usernames = []
+        for user in checkpoint.filter(get_user_model().objects.all()):
+            if len(usernames) == stop:
+                checkpoint.save()
+                break
+            usernames.append(user.username)
+            checkpoint.advance(user.pk, user.last_login)
+        else:
+            checkpoint.finish()
+        return usernames
+
+    def test_resume(self):
+        ''' Ein unterbrochener Durchlauf wird hinter dem letzten Nutzer fortgesetzt '''
+
+        for stop in (1, 2, 3):
+            self.assertEqual(
+                self.iter_pass(Checkpoint('recent', ORDER_RECENT_LOGIN_FIRST), stop) + self.iter_pass(Checkpoint('recent', ORDER_RECENT_LOGIN_FIRST)),
+                ['recent', 'same', 'old', 'never'],
+            )
+        checkpoint = Checkpoint('recent', ORDER_RECENT_LOGIN_FIRST)
+        self.assertEqual(checkpoint.record.pass_number, 3)
+        self.assertFalse(checkpoint.resuming)
+
+        self.assertEqual(self.iter_pass(Checkpoint('pk', save_every=10), 2), ['old', 'never'])
+        self.assertEqual(Checkpoint('pk').record.processed, 2)
+        self.assertEqual(self.iter_pass(Checkpoint('pk')), ['recent', 'same'])
+
+    def test_string_pk(self):
+        ''' Der Fortsetzungspunkt funktioniert auch mit nicht-numerischen Primärschlüsseln '''
+
+        from django.contrib.sessions.models import Session
+
+        for key in ('key-a', 'key-b', 'key-c'):
+            Session.objects.create(session_key=key, session_data='', expire_date=timezone.now())
+        checkpoint = Checkpoint('sessions')
+        checkpoint.advance(checkpoint.filter(Session.objects.all()).first().pk)
+        checkpoint.save()
+        self.assertEqual(list(Checkpoint('sessions').filter(Session.objects.all()).values_list('pk', flat=True)), ['key-b', 'key-c'])
+
+    def test_inactive(self):
+        ''' Inaktive Nutzer werden nur in jedem n-ten Durchlauf abgeglichen '''
+
+        checkpoint = Checkpoint('pk')
+        self.assertTrue(checkpoint.sweeps_inactive(7))
+        checkpoint.finish()
+        self.assertFalse(checkpoint.sweeps_inactive(7))
+        inactive = get_user_model().objects.filter(inactive_users(timezone.now() - datetime.timedelta(days=90)))
+        self.assertEqual(sorted(inactive.values_list('username', flat=True)), ['never', 'old'])
+
+
+class FingerprintTestCase(TestCase):
+    def test_fingerprint(self):
+        ''' Der Fingerabdruck hängt nur von den Werten ab, nicht von der Reihenfolge '''
+
+        attributes = {'first_name': 'Max', 'last_name': 'Muster', 'is_active': True}
+        fingerprint = compute_fingerprint(attributes)
+        self.assertEqual(len(fingerprint), 32)
+        self.assertEqual(compute_fingerprint(dict(reversed(list(attributes.items())))), fingerprint)
+        self.assertNotEqual(compute_fingerprint(dict(attributes, is_active=False)), fingerprint)
+        self.assertNotEqual(compute_fingerprint({}), fingerprint)
+
+    def test_tracker(self):
+        ''' Unveränderte Nutzer werden übersprungen und nur als synchronisiert markiert '''
+
+        User = get_user_model()
+        users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        attributes = {'first_name': 'Max'}
+
+        def user_dicts():
+            return User.objects.order_by('pk').values('pk', FINGERPRINT_FIELD)
+
+        tracker = FingerprintTracker(batch_size=2)
+        self.assertFalse(any(tracker.matches(user_dict, attributes) for user_dict in user_dicts()))
+        tracker.save()
+        self.assertEqual(UserFingerprint.objects.count(), 3)
+        self.assertEqual(User.objects.filter(stale_users(60)).count(), 0)
+
+        UserFingerprint.objects.filter(user=users[0]).update(synced=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(list(User.objects.filter(stale_users(3600))), [users[0]])
+
+        tracker = FingerprintTracker()
+        skipped = [tracker.matches(user_dict, attributes if user_dict['pk'] != users[1].pk else {}) for user_dict in user_dicts()]
+        self.assertEqual(skipped, [True, False, True])
+        tracker.save()
+        self.assertEqual(User.objects.filter(stale_users(3600)).count(), 0)
+        self.assertEqual(UserFingerprint.objects.get(user=users[1]).fingerprint, compute_fingerprint({}))
+
+        tracker = FingerprintTracker(skip=False)
+        self.assertFalse(tracker.matches(user_dicts()[0], attributes))
+        self.assertEqual(len(tracker), 1)
+
+
+class RateLimiterTestCase(SimpleTestCase):
+    def test_token_bucket(self):
+        ''' Nach dem Burst werden Operationen auf die Rate begrenzt '''
+
+        limiter = RateLimiter(rate=200, burst=2)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertGreater(limiter.acquire(), 0)
+        stats = limiter.stats()
+        self.assertEqual(stats['throttled'], 1)
+        self.assertGreater(stats['throttled_seconds'], 0)
+
+    def test_overload(self):
+        ''' Bei Überlast wird die Rate halbiert und pausiert, Erfolge erholen sie wieder '''
+
+        limiter = RateLimiter(rate=1000, min_rate=0.2, backoff_base=0.01, backoff_max=0.01, latency_threshold=1.0)
+        self.assertTrue(limiter.record(51))
+        self.assertTrue(limiter.record(0, latency=2.0))
+        self.assertTrue(limiter.record(3))
+        self.assertEqual(limiter.stats()['factor'], 0.2)
+        self.assertEqual(limiter.stats()['overloads'], 3)
+        self.assertFalse(limiter.record(0, latency=0.1))
+        self.assertGreater(limiter.stats()['factor'], 0.2)
+
+    def test_backoff(self):
+        ''' Wartezeiten wachsen exponentiell bis zum Maximum '''
+
+        for attempt in range(10):
+            delay = backoff_delay(attempt, 0.1, 1.0)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(1.0, 0.1 * 2 ** attempt))
+
+
+class ConfigTestCase(SimpleTestCase):
+    def test_compiled(self):
+        ''' Die Einstellungen werden einmal gelesen und bei Änderungen neu aufgebaut '''
+
+        config = get_config()
+        self.assertIs(get_config(), config)
+        self.assertEqual(config.timeout, settings.LDAP_SYNC_CONNECTION.get('timeout', 5))
+        self.assertIn('sAMAccountName', config.search_attributes)
+        self.assertEqual(config.max_lengths['email'], get_user_model()._meta.get_field('email').max_length)
+        self.assertFalse(config.incremental)
+        with self.settings(LDAP_SYNC_PAGE_SIZE=7, LDAP_SYNC_INCREMENTAL=True):
+            self.assertEqual(get_config().page_size, 7)
+            self.assertTrue(get_config().incremental)
+            self.assertEqual(Ldap().LDAP_PAGE_SIZE, 7)
+        self.assertIsNot(get_config(), config)
+
+    def test_invalid(self):
+        ''' Fehlerhafte Einstellungen werden beim Aufbau erkannt '''
+
+        with self.settings(LDAP_SYNC_USER_ATTRIBUTES={'unknown': 'mail'}):
+            self.assertRaises(ImproperlyConfigured, build_config)
+        with self.settings(LDAP_SYNC_GROUP_STRATEGY='nested'):
+            self.assertRaises(ImproperlyConfigured, build_config)
+        with self.settings(LDAP_SYNC_INCREMENTAL='yes'):
+            self.assertRaises(ImproperlyConfigured, build_config)
+        connection = dict(settings.LDAP_SYNC_CONNECTION, uri='http://server/dc=example')
+        with self.settings(LDAP_SYNC_CONNECTION=connection):
+            self.assertRaises(ImproperlyConfigured, build_config)
+        connection = dict(settings.LDAP_SYNC_CONNECTION, server_info='all')
+        with self.settings(LDAP_SYNC_CONNECTION=connection):
+            self.assertRaises(ImproperlyConfigured, build_config)
+
+
+class SchemaCacheTestCase(SimpleTestCase):
+    PARAMS = {'host': 'dc1.example.com', 'port': 389, 'ssl': False}
+
+    def connect(self, **kwargs):
+        ''' Opens a connection whose bind "downloads" the offline AD schema of ldap3 '''
+
+        from ldap3 import OFFLINE_AD_2012_R2, SCHEMA
+
+        downloads = []
+
+        class FakeConnection(object):
+            def __init__(self, server, **kwargs):
+                self.server = server
+
+            def open(self):
+                pass
+
+            def bind(self):
+                if self.server.get_info == SCHEMA:
+                    downloads.append(self.server.host)
+                    self.server.get_info = OFFLINE_AD_2012_R2
+                    self.server.get_info_from_server(None)
+                return True
+
+        with mock.patch('django_ldapsync.ldap.Connection', FakeConnection):
+            connection = create_connection(self.PARAMS, 'user', 'password', 5, **kwargs)
+        return connection, len(downloads)
+
+    def test_cache(self):
+        ''' Das Schema wird einmal gelesen und danach aus der Datei geladen '''
+
+        with tempfile.TemporaryDirectory() as directory:
+            schema_file = os.path.join(directory, 'schema.json')
+            connection, downloads = self.connect(server_info='cache', schema_file=schema_file)
+            self.assertEqual(downloads, 1)
+            self.assertTrue(os.path.exists(schema_file))
+            # Another process loads the file
+            with mock.patch.dict('django_ldapsync.ldap._schemas', clear=True):
+                connection, downloads = self.connect(server_info='cache', schema_file=schema_file)
+            self.assertEqual(downloads, 0)
+            self.assertIn('givenName', connection.server.schema.attribute_types)
+
+        connection, downloads = self.connect(server_info='none')
+        self.assertEqual(downloads, 0)
+        self.assertIsNone(connection.server.schema)
+        connection, downloads = self.connect()
+        self.assertEqual(downloads, 1)
+
+    def test_shared_directory(self):
+        ''' In einem für andere beschreibbaren Verzeichnis wird das Schema weder gespeichert noch geladen '''
+
+        self.assertFalse(build_config().schema_file.startswith(tempfile.gettempdir()))
+        with tempfile.TemporaryDirectory() as directory:
+            os.chmod(directory, 0o777)
+            schema_file = os.path.join(directory, 'schema.json')
+            with self.assertLogs('django_ldapsync.ldap', 'WARNING'):
+                self.connect(server_info='cache', schema_file=schema_file)
+            self.assertEqual(os.listdir(directory), [])
+            with open(schema_file, 'w') as planted:
+                planted.write('{}')
+            with mock.patch.dict('django_ldapsync.ldap._schemas', clear=True):
+                connection, downloads = self.connect(server_info='cache', schema_file=schema_file)
+            self.assertEqual(downloads, 1)
+
+    def test_decode_text(self):
+        ''' Gemappte Attribute werden ohne Schema direkt dekodiert '''
+
+        connection, _ = self.connect(server_info='none', formatter={'givenName': decode_text})
+        self.assertIs(connection.server.custom_formatter['givenName'], decode_text)
+        self.assertEqual(decode_text(b'M\xc3\xbcller'), 'Müller')
+        self.assertEqual(decode_text(b'\xff'), '\ufffd')
+
+
+class PrefetchTestCase(SimpleTestCase):
+    def setUp(self):
+        self.USER_MODEL = get_user_model()
+        patcher = mock.patch.object(Ldap, 'get_django_attributes_for_user', side_effect=AssertionError('LDAP lookup'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prefetched(self):
+        ''' Vorab gelesene Attribute werden ohne LDAP-Abfrage übernommen '''
+
+        user = self.USER_MODEL(username='testuser')
+        with prefetched_attributes({'TestUser@domain': {'first_name': 'Test', 'email': 'test@example.com'}}):
+            set_attributes_from_ldap(self.USER_MODEL, user)
+        self.assertEqual(user.first_name, 'Test')
+        self.assertEqual(user.email, 'test@example.com')
+        self.assertIsNone(get_prefetched_attributes('testuser'))
+
+    def test_suppress(self):
+        ''' Innerhalb von `suppress_ldap_lookup()` bleiben die Attribute unverändert '''
+
+        user = self.USER_MODEL(username='testuser', first_name='Alt')
+        with suppress_ldap_lookup():
+            set_attributes_from_ldap(self.USER_MODEL, user)
+        self.assertEqual(user.first_name, 'Alt')
+
+    def test_context_local(self):
+        ''' Andere Threads und asyncio-Tasks sehen die Daten nicht '''
+
+        seen = []
+        with prefetched_attributes({'testuser': {'first_name': 'Test'}}):
+            thread = threading.Thread(target=lambda: seen.append(get_prefetched_attributes('testuser')))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [None])
+
+        async def task(name):
+            with prefetched_attributes({'testuser': {'first_name': name}}):
+                await asyncio.sleep(0.01)
+                return get_prefetched_attributes('testuser')['first_name']
+
+        async def main():
+            return await asyncio.gather(task('A'), task('B'))
+
+        self.assertEqual(asyncio.run(main()), ['A', 'B'])
+
+
+class ThreadRefreshBackendTestCase(SimpleTestCase):
+    def test_deduplicate(self):
+        ''' Ein Nutzer steht höchstens einmal in der Warteschlange '''
+
+        started = threading.Event()
+        release = threading.Event()
+        refreshed = []
+
+        def handler(username):
+            started.set()
+            release.wait(5)
+            refreshed.append(username)
+
+        backend = ThreadRefreshBackend(max_queue=2, handler=handler)
+        self.assertTrue(backend.enqueue('alice'))
+        started.wait(5)
+        # `alice` wird gerade verarbeitet und darf erneut eingereiht werden
+        self.assertTrue(backend.enqueue('Alice'))
+        self.assertFalse(backend.enqueue('alice@domain'))
+        self.assertTrue(backend.enqueue('bob'))
+        self.assertFalse(backend.enqueue('carol'))
+        release.set()
+        backend.join()
+
+        self.assertEqual(refreshed, ['alice', 'Alice', 'bob'])
+        stats = backend.stats()
+        self.assertEqual(stats['deduplicated'], 1)
+        self.assertEqual(stats['dropped'], 1)
+
+
+class AttributeCacheTestCase(SimpleTestCase):
+    def test_lru(self):
+        ''' Älteste Einträge werden verdrängt '''
+
+        cache = LRUCache(max_entries=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', None), None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_negative_and_invalidate(self):
+        ''' Unbekannte Nutzer werden gecacht, Einträge können invalidiert werden '''
+
+        cache = AttributeCache(timeout=60, negative_timeout=60, max_entries=10)
+        self.assertIsNone(cache.get('unknown'))
+        cache.set('unknown', {})
+        self.assertEqual(cache.get('UNKNOWN@domain'), {})
+        cache.invalidate('unknown')
+        self.assertIsNone(cache.get('unknown'))
+
+
+class GroupGraphTestCase(SimpleTestCase):
+    def test_expand(self):
+        ''' Verschachtelte Gruppen werden aufgelöst, Zyklen beendet '''
+
+        graph = GroupGraph({
+            'CN=A': ['CN=B', 'CN=u1'],
+            'CN=B': ['cn=a', 'CN=C', 'CN=u2'],
+            'CN=C': ['CN=u3', 'CN=u1'],
+            'CN=D': [],
+        })
+        self.assertEqual(graph.expand('cn=a'), {'CN=u1', 'CN=u2', 'CN=u3'})
+        self.assertEqual(graph.expand('CN=D'), set())
+        self.assertEqual(graph.expand('CN=unknown'), set())
+        self.assertEqual(graph.expand_many(['CN=C', 'CN=B']), {
+            'CN=C': {'CN=u1', 'CN=u3'},
+            'CN=B': {'CN=u1', 'CN=u2', 'CN=u3'},
+        })
+
+    def test_incomplete_build(self):
+        ''' Ein unvollständig gelesener Gruppengraph wird nicht gecacht '''
+
+        group = {'distinguishedName': 'CN=A', 'member': ['CN=u1']}
+        conn = SearchConnection([([group], RESULT_TIME_LIMIT_EXCEEDED, False), ([group], RESULT_SUCCESS, False)])
+        pool = LdapConnectionPool(lambda: conn, size=1)
+        clear_group_graphs()
+        with mock.patch('django_ldapsync.ldap.get_connection_pool', return_value=pool), \
+                mock.patch('django_ldapsync.ldap.get_rate_limiter', return_value=RateLimiter(backoff_base=0)):
+            ldap = Ldap()
+            with self.assertRaises(LDAPOperationResult):
+                get_group_graph(ldap)
+            self.assertEqual(get_group_graph(ldap).expand('CN=A'), {'CN=u1'})
+        clear_group_graphs()
+
+    def test_membership_diff(self):
+        ''' Fehlende Mitgliedschaften werden hinzugefügt, überzählige entfernt '''
+
+        self.assertEqual(membership_diff(
+            {'a': {1, 2}, 'b': {3}, 'new': {4}, 'empty': set()},
+            {'a': {2, 5}, 'b': {3}, 'empty': {6}, 'other': {7}},
+        ), {
+            'a': ({1}, {5}),
+            'new': ({4}, set()),
+            'empty': (set(), {6}),
+        })
+
+
+class MergeTestCase(SimpleTestCase):
+    def test_external_sort(self):
+        ''' Größere Mengen werden blockweise über temporäre Dateien sortiert '''
+
+        records = [LdapRecord('user%03d' % number, ()) for number in reversed(range(25))]
+        keys = [record.key for record in external_sort(iter(records), chunk_size=10)]
+        self.assertEqual(keys, sorted(record.key for record in records))
+        keys = [record.key for record in external_sort(iter(records[:5]), chunk_size=10)]
+        self.assertEqual(keys, sorted(record.key for record in records[:5]))
+
+    def test_merge_join(self):
+        ''' Nutzer aus der Datenbank werden den LDAP-Nutzern zugeordnet '''
+
+        db_records = [DbRecord(key, (key,)) for key in ('a', 'b', 'b', 'd')]
+        ldap_records = [LdapRecord(key, (('username', key),)) for key in ('b', 'c', 'd', 'e')]
+        pairs = [
+            (db_record.key, ldap_record.key if ldap_record else None)
+            for db_record, ldap_record in merge_join(iter(db_records), iter(ldap_records))
+        ]
+        self.assertEqual(pairs, [('a', None), ('b', 'b'), ('b', 'b'), ('d', 'd')])
+
+    def test_merge_join_incomplete(self):
+        ''' Bricht der LDAP-Strom ab, werden die restlichen Datenbank-Einträge nicht als fehlend geliefert '''
+
+        def ldap_records():
+            yield LdapRecord('a', ())
+            raise LDAPException('time limit exceeded')
+
+        db_records = [DbRecord(key, (key,)) for key in ('a', 'b', 'c')]
+        pairs = []
+        with self.assertRaises(LDAPException):
+            for db_record, ldap_record in merge_join(iter(db_records), ldap_records()):
+                pairs.append((db_record.key, ldap_record.key if ldap_record else None))
+        self.assertEqual(pairs, [('a', 'a')])
+
+    def test_verify_sorted(self):
+        ''' Unsortierte Eingaben werden erkannt '''
+
+        records = [LdapRecord(key, ()) for key in ('a', 'c', 'b')]
+        with self.assertRaises(UnsortedInput):
+            list(verify_sorted(records, 'ldap'))
+
+
+class ChunkedTestCase(SimpleTestCase):
+    def test_chunked(self):
+        ''' Iterables werden in Blöcke aufgeteilt '''
+
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+
+class StatsRegistryTestCase(SimpleTestCase):
+    def test_record(self):
+        ''' Operationen werden gezählt und als Signal gesendet '''
+
+        stats = StatsRegistry()
+        received = []
+        handler = lambda sender, **kwargs: received.append(kwargs)
+        ldap_operation.connect(handler)
+        try:
+            with stats.measure('search') as operation:
+                operation.entries, operation.bytes = 2, 100
+            with self.assertRaises(LDAPException):
+                with stats.measure('search'):
+                    raise LDAPException()
+        finally:
+            ldap_operation.disconnect(handler)
+
+        snapshot = stats.snapshot()['search']
+        self.assertEqual(snapshot['count'], 2)
+        self.assertEqual(snapshot['failures'], 1)
+        self.assertEqual(snapshot['entries'], 2)
+        self.assertEqual(snapshot['bytes'], 100)
+        self.assertEqual(sum(snapshot['buckets']), 2)
+        self.assertEqual([kwargs['failed'] for kwargs in received], [False, True])
+
+    def test_prometheus(self):
+        ''' Export im Prometheus-Textformat '''
+
+        registry.record('bind', 0.003)
+        text = export_prometheus()
+        self.assertIn('django_ldapsync_operation_seconds_bucket{operation="bind",le="0.005"}', text)
+        self.assertIn('django_ldapsync_pool_size ', text)